@@ -48,6 +48,7 @@ setup(name='e17p',
       'e17p.base', 'e17p.base.ff', 'e17p.base.codec',
       'e17p.ui', 'e17p.ui.data',
       'e17p.fantranslation',
+      'e17p.bench',
       'e17p.never7', 'e17p.never7.ff',
       'e17p.ever17', 'e17p.ever17.ff',
       'e17p.remember11', 'e17p.remember11.ff',
@@ -16,38 +16,240 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 # Simple framework to simplify overrides from associated C modules, when available.
+#
+# Every function registered through an AIFuncs instance can have implementations in several tiers, tried in order of
+# preference:
+#  c: C extension module; the registering module's name prefixed with '_' (e.g. _rle for rle)
+#  np: NumPy implementation; the registering module's name prefixed with '_' and suffixed with '_np' (e.g. _cps_np)
+#  py: The registered pure python function itself, which is always available.
+#
+# The tier preference can be changed at runtime through set_tiers() and set_tier(), or on startup through the E17P_AIF
+# environment variable; this is a comma-separated list of tier names, optionally followed by <function name>=<tier>
+# entries pinning individual functions (e.g. 'E17P_AIF=np,py,e17_rle_unpack=c').
+# Setting E17P_AIF_STATS to a non-empty value enables collection of per-function call counts and cumulative call times,
+# and writes a report to stderr on exit.
+
+import functools
+import sys
+import time
+
+TIERS = ('c', 'np', 'py')
+_tier_suffixes = {'c': '', 'np': '_np'}
 
 class _Container:
    pass
 
+class _AIFConfig:
+   def __init__(self):
+      self.tiers = TIERS
+      self.pins = {}
+      self.stats = False
+      self.aifs = []
+   
+   @staticmethod
+   def _check_tier(tier):
+      if not (tier in TIERS):
+         raise ValueError('Unknown AIF tier {!r}; expected one of {}.'.format(tier, TIERS))
+   
+   def load_env(self, spec):
+      tiers = []
+      for s in spec.split(','):
+         s = s.strip()
+         if (s == ''):
+            continue
+         if ('=' in s):
+            (name, tier) = s.split('=', 1)
+            self._check_tier(tier)
+            self.pins[name] = tier
+         else:
+            self._check_tier(s)
+            tiers.append(s)
+      if (tiers):
+         self.tiers = tuple(tiers)
+   
+   def get_funcs(self):
+      for aifs in self.aifs:
+         for func in aifs.funcs.values():
+            yield func
+   
+   def update(self):
+      for func in self.get_funcs():
+         func.select(self.pins.get(func.__name__, self.tiers))
+
+_config = _AIFConfig()
+
+
+class AIFunc:
+   """Dispatcher for a function with several alternative implementations."""
+   def __init__(self, module, func):
+      functools.update_wrapper(self, func)
+      self.module = module
+      # Dict mapping tier names to implementations
+      self.impls = {'py': func}
+      self.tier = 'py'
+      self.func = func
+      self.reset_stats()
+   
+   def reset_stats(self):
+      self.calls = 0
+      self.time = 0.0
+   
+   def select(self, tiers):
+      """Make first available implementation from specified tier sequence active; returns the selected tier.
+      
+      The python implementation is used if none of the tiers is available."""
+      if (isinstance(tiers, str)):
+         tiers = (tiers,)
+      for tier in tiers:
+         if (tier in self.impls):
+            break
+      else:
+         tier = 'py'
+      self.tier = tier
+      self.func = self.impls[tier]
+      return tier
+   
+   def __call__(self, *args, **kwargs):
+      if not (_config.stats):
+         return self.func(*args, **kwargs)
+      
+      ts = time.perf_counter()
+      try:
+         return self.func(*args, **kwargs)
+      finally:
+         self.time += time.perf_counter() - ts
+         self.calls += 1
+   
+   def __reduce__(self):
+      return (get_func, (self.module, self.__name__))
+   
+   def __repr__(self):
+      return '<{} {}.{} tier={!r} impls={}>'.format(type(self).__name__, self.module, self.__name__, self.tier,
+         sorted(self.impls))
+
+
 class AIFuncs:
    def __init__(self, name=None):
-      import sys
       import inspect
       # We import the specified module name (or the caller's module prefixed with '_', if None) from the caller's context.
       # This is fairly hackish, but probably makes for the most convenient interface we can easily build.
       
       caller_globals = inspect.stack()[1][0].f_globals
+      self.module = caller_globals['__name__']
       if (name is None):
-         name_split = caller_globals['__name__'].split('.')
+         name_split = self.module.split('.')
          name_split[-1] = '_' + name_split[-1]
          name = '.'.join(name_split)
       
-      try:
-         __import__(name, globals=caller_globals)
-      except ImportError:
-         self.aim = None
-      else:
-         self.aim = sys.modules[name]
+      # Dict mapping tier names to implementation modules
+      self.mods = {}
+      for (tier, suffix) in _tier_suffixes.items():
+         mname = name + suffix
+         try:
+            __import__(mname, globals=caller_globals)
+         except ImportError:
+            continue
+         self.mods[tier] = sys.modules[mname]
       
+      self.aim = self.mods.get('c')
       self.py = _Container()
+      self.funcs = {}
       del(caller_globals)
-
+      _config.aifs.append(self)
+   
    def add(self, func):
-      """Add function with alternative implementation."""
+      """Add function with alternative implementations; returns a dispatcher for it."""
       name = func.__name__
       setattr(self.py, name, func)
-      if not (self.aim is None):
-         func = getattr(self.aim, name)
-         
-      return func
+      rv = AIFunc(self.module, func)
+      for (tier, mod) in self.mods.items():
+         impl = getattr(mod, name, None)
+         if not (impl is None):
+            rv.impls[tier] = impl
+      
+      rv.select(_config.pins.get(name, _config.tiers))
+      self.funcs[name] = rv
+      return rv
+
+
+def get_func(module, name):
+   """Return dispatcher for function registered by specified module."""
+   __import__(module)
+   for aifs in _config.aifs:
+      if (aifs.module == module):
+         return aifs.funcs[name]
+   raise KeyError((module, name))
+
+def get_funcs():
+   """Return list of dispatchers for all registered functions."""
+   return list(_config.get_funcs())
+
+def set_tiers(tiers):
+   """Set tier preference order for all functions not pinned through set_tier()."""
+   tiers = tuple(tiers)
+   for tier in tiers:
+      _config._check_tier(tier)
+   _config.tiers = tiers
+   _config.update()
+
+def set_tier(name, tier=None):
+   """Pin function of specified name to tier; if tier is None, revert it to the global preference order."""
+   if (tier is None):
+      _config.pins.pop(name, None)
+   else:
+      _config._check_tier(tier)
+      _config.pins[name] = tier
+   _config.update()
+
+def set_stats(enabled=True):
+   """Enable or disable collection of call counts and times."""
+   _config.stats = enabled
+
+def reset_stats():
+   for func in _config.get_funcs():
+      func.reset_stats()
+
+def report(f=None):
+   """Write table of all registered functions, their active implementations and call statistics to f (default: stdout)."""
+   if (f is None):
+      f = sys.stdout
+   
+   f.write('{:40} {:4} {:10} {:>10} {:>10}\n'.format('function', 'tier', 'available', 'calls', 'time'))
+   for func in _config.get_funcs():
+      avail = ','.join(tier for tier in TIERS if (tier in func.impls))
+      f.write('{:40} {:4} {:10} {:10d} {:10.3f}\n'.format('{}.{}'.format(func.module, func.__name__), func.tier, avail,
+         func.calls, func.time))
+
+def _load_env():
+   import os
+   spec = os.environ.get('E17P_AIF')
+   if not (spec is None):
+      try:
+         _config.load_env(spec)
+      except ValueError as exc:
+         # Don't take down every tool over a bad setting; fall back to the defaults.
+         _config.tiers = TIERS
+         _config.pins = {}
+         sys.stderr.write('e17p: ignoring invalid E17P_AIF value {!r}: {}\n'.format(spec, exc))
+   
+   if (os.environ.get('E17P_AIF_STATS')):
+      import atexit
+      _config.stats = True
+      atexit.register(report, sys.stderr)
+
+_load_env()
+
+
+def _main():
+   import optparse
+   op = optparse.OptionParser(usage='%prog [options] [module ...]')
+   op.add_option('-t', '--tiers', default=None, help='Comma-separated tier preference order to apply before reporting.')
+   (opts, args) = op.parse_args()
+   
+   if not (opts.tiers is None):
+      set_tiers(opts.tiers.split(','))
+   
+   # Import modules providing accelerated implementations, so they show up in the report.
+   for mname in (args or ('e17p.ever17.ff.rle', 'e17p.ever17.ff.cps', 'e17p.base.codec.msadpcm')):
+      __import__(mname)
+   report()
@@ -17,7 +17,13 @@
 
 # MSADPCM support.
 
-from ..file_data import DataRefFile
+from array import array
+import struct
+import sys
+
+from ..file_data import DataRef, DataRefFile
+from ..aif import AIFuncs
+_aifs = AIFuncs()
 
 # Straightforward MSADPCM decoder implementation based on <http://wiki.multimedia.cx/index.php?title=Microsoft_ADPCM>.
 _dt_adapt = (230, 230, 230, 230, 307, 409, 512, 614, 768, 614, 512, 409, 307, 230, 230, 230)
@@ -30,27 +36,131 @@ def _nibble_u2s(n):
    
    return n
 
-def _adpcmdec(pred, delta, s1, s2):
-   yield s2
-   c1 = _dt_coeff1[pred]
-   c2 = _dt_coeff2[pred]
-   nibble = 0
-   while (True):
-      nibble = (yield s1)
-      
-      pred = (s1*c1 + s2*c2)
-      (pred2, pred_mod) = divmod(pred, 256)
-      pred = pred2 + ((pred2 < 0) and bool(pred_mod))     # manually round towards zero
-      
-      pred += _nibble_u2s(nibble)*delta
-      
-      (delta2, delta_mod) = divmod(_dt_adapt[nibble]*delta, 256)
-      delta = delta2 + ((delta2 < 0) and bool(delta_mod)) # manually round towards zero
-      delta = max(delta,16)
-      delta %= 2**31
+_dt_nibble = tuple(_nibble_u2s(n) for n in range(16))
+
+def adpcm_get_sample_count(size, channels, blocksize):
+   """Return number of samples (over all channels) encoded in size bytes of MSADPCM data."""
+   bhdr_sz = 7*channels
+   (blocks, rem) = divmod(size, blocksize)
+   rv = blocks*(blocksize - bhdr_sz)*2
+   if (rem):
+      if (rem < bhdr_sz):
+         raise ValueError('Truncated block header: Got {}/{} bytes.'.format(rem, bhdr_sz))
+      rv += (rem - bhdr_sz)*2
+      blocks += 1
+   return rv + blocks*2*channels
+
+@_aifs.add
+def adpcm_decode(data, stereo, blocksize):
+   """Decode MSADPCM data; returns buffer object of little-endian 16bit PCM samples."""
+   data = memoryview(data)
+   size = len(data)
+   channels = stereo + 1
+   bhdr_sz = 7*channels
+   out = array('h', (0,))*adpcm_get_sample_count(size, channels, blocksize)
+   i = 0
+   adapt = _dt_adapt
+   nibble = _dt_nibble
+   
+   # The loops below inline the per-sample decoding step; spelled out for channel a:
+   #   p = (s1a*c1a + s2a*c2a)/256 (rounded towards zero) + nibble*da, clamped to int16
+   #   da = max(adapt[nibble]*da/256, 16) % 2**31
+   for off in range(0, size, blocksize):
+      if (stereo):
+         (pa, pb, da, db, s1a, s1b, s2a, s2b) = struct.unpack_from('<BBhhhhhh', data, off)
+         out[i:i+4] = array('h', (s2a, s2b, s1a, s1b))
+      else:
+         (pa, da, s1a, s2a) = struct.unpack_from('<Bhhh', data, off)
+         out[i:i+2] = array('h', (s2a, s1a))
+         pb = pa
+      i += 2*channels
+      (c1a, c2a) = (_dt_coeff1[pa], _dt_coeff2[pa])
+      (c1b, c2b) = (_dt_coeff1[pb], _dt_coeff2[pb])
       
-      s2 = s1
-      s1 = max(min(pred, 32767), -32768)      
+      if (stereo):
+         for b in data[off+bhdr_sz:off+blocksize]:
+            n = b >> 4
+            p = s1a*c1a + s2a*c2a
+            if (p < 0):
+               p = -(-p >> 8)
+            else:
+               p >>= 8
+            p += nibble[n]*da
+            if (p > 32767):
+               p = 32767
+            elif (p < -32768):
+               p = -32768
+            da = (adapt[n]*da) >> 8
+            if (da < 16):
+               da = 16
+            elif (da > 0x7fffffff):
+               da &= 0x7fffffff
+            s2a = s1a
+            s1a = out[i] = p
+            
+            n = b & 15
+            p = s1b*c1b + s2b*c2b
+            if (p < 0):
+               p = -(-p >> 8)
+            else:
+               p >>= 8
+            p += nibble[n]*db
+            if (p > 32767):
+               p = 32767
+            elif (p < -32768):
+               p = -32768
+            db = (adapt[n]*db) >> 8
+            if (db < 16):
+               db = 16
+            elif (db > 0x7fffffff):
+               db &= 0x7fffffff
+            s2b = s1b
+            s1b = out[i+1] = p
+            i += 2
+      else:
+         for b in data[off+bhdr_sz:off+blocksize]:
+            n = b >> 4
+            p = s1a*c1a + s2a*c2a
+            if (p < 0):
+               p = -(-p >> 8)
+            else:
+               p >>= 8
+            p += nibble[n]*da
+            if (p > 32767):
+               p = 32767
+            elif (p < -32768):
+               p = -32768
+            da = (adapt[n]*da) >> 8
+            if (da < 16):
+               da = 16
+            elif (da > 0x7fffffff):
+               da &= 0x7fffffff
+            s2a = s1a
+            s1a = out[i] = p
+            
+            n = b & 15
+            p = s1a*c1a + s2a*c2a
+            if (p < 0):
+               p = -(-p >> 8)
+            else:
+               p >>= 8
+            p += nibble[n]*da
+            if (p > 32767):
+               p = 32767
+            elif (p < -32768):
+               p = -32768
+            da = (adapt[n]*da) >> 8
+            if (da < 16):
+               da = 16
+            elif (da > 0x7fffffff):
+               da &= 0x7fffffff
+            s2a = s1a
+            s1a = out[i+1] = p
+            i += 2
+   
+   if (sys.byteorder != 'little'):
+      out.byteswap()
+   return out
 
 
 class DataRefADPCM(DataRefFile):
@@ -60,36 +170,52 @@ class DataRefADPCM(DataRefFile):
       self.blocksize = blocksize
    
    def get_pcm(self):
-      from struct import pack,unpack
-      data = memoryview(self.get_data())
-      out = []
-      bhdr_sz = 7*(self.stereo + 1)
-      
-      while (data):
-         if (self.stereo):
-            (pred0, pred1, delta0, delta1, s10, s11, s20, s21) = unpack('<BBhhhhhh', data[:bhdr_sz])
-            d0 = _adpcmdec(pred0, delta0, s10, s20).send
-            d1 = _adpcmdec(pred1, delta1, s11, s21).send
-            out.extend((d0(None),d1(None),d0(None),d1(None)))
-         
-         else:
-            (pred, delta, s1, s2) = unpack('<Bhhh', data[:bhdr_sz])
-            d0 = d1 = _adpcmdec(pred, delta, s1, s2).send
-            out.extend((d0(None),d0(None)))
-         
-         for b in data[bhdr_sz:self.blocksize]:
-            v = ord(b)
-            out.append(d0(v >> 4))
-            out.append(d1(v & 0xf))
-         
-         data = data[self.blocksize:]
-         
-      rv = b''.join(pack('<h',v) for v in out)
-      return rv
+      """Return buffer object of little-endian 16bit PCM samples."""
+      return adpcm_decode(self.get_data(), self.stereo, self.blocksize)
+   
+   def get_pcm_size(self):
+      """Return size of decoded PCM data in bytes."""
+      return 2*adpcm_get_sample_count(self.size, self.stereo + 1, self.blocksize)
+   
+   def iter_pcm(self, blocks=1):
+      """Yield decoded PCM data, decoding the specified number of ADPCM blocks at a time."""
+      bl = self.blocksize*blocks
+      for off in range(0, self.size, bl):
+         yield adpcm_decode(self.get_view(min(bl, self.size-off), off), self.stereo, self.blocksize)
+   
+   def get_pcm_reader(self):
+      """Return file-like object that decodes PCM data lazily as it's read from."""
+      from ..file_data import IterFile
+      return IterFile(self.iter_pcm())
+   
+   def get_pcm_stream_dref(self):
+      """Like get_pcm_dref(), but only decodes data as it's read."""
+      return DataRefADPCMStream(self)
    
    def get_pcm_dref(self):
       from io import BytesIO
-      d = self.get_pcm()
+      d = memoryview(self.get_pcm()).cast('B')
       bio = BytesIO(d)
       
       return DataRefFile(bio, 0, len(d))
+
+
+class DataRefADPCMStream(DataRef):
+   """Dref of PCM data decoded from MSADPCM data on demand; serializers can retrieve it piecewise through iter_data()."""
+   def __init__(self, src):
+      self.src = src
+   
+   def get_size(self):
+      return self.src.get_pcm_size()
+   
+   def get_data(self):
+      return memoryview(self.src.get_pcm()).cast('B')
+   
+   def iter_data(self):
+      return self.src.iter_pcm()
+   
+   def get_reader(self):
+      return self.src.get_pcm_reader()
+   
+   def __format__(self, fs):
+      return '{0}({1})'.format(type(self).__name__, self.src)
@@ -15,9 +15,10 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-# MS BMP image output support
+# MS BMP image output support, and conversion of BMP-layout image data to PNG
 
 import struct
+import zlib
 
 class SubprocessError(Exception):
    pass
@@ -119,10 +120,226 @@ class BMPImage:
       out(subhdr)
       out(self.data)
    
-   def write_png(self, out):
+   def get_rows_rgb(self):
+      """Return image data as top-down, unpadded rows of RGB(A) pixels."""
+      opp = self.color_depth//8
+      (ill, _) = rgb_get_lengths(opp, self.width, self.height)
+      rl = self.width*opp
+      m = memoryview(self.data)
+      rv = bytearray(rl*self.height)
+      o = 0
+      for i in range((self.height-1)*ill, -1, -ill):
+         rv[o:o+rl] = m[i:i+rl]
+         o += rl
+      # BGR(A) -> RGB(A)
+      (rv[0::opp], rv[2::opp]) = (rv[2::opp], rv[0::opp])
+      return rv
+   
+   def write_png(self, out, writer=None):
+      if (writer is None):
+         writer = PNGWriter()
+      writer.write(self, out)
+   
+   def write_png_imconvert(self, out):
+      """Legacy PNG output: Convert BMP data by piping it through an external convert(1) process."""
       from io import BytesIO
       bmp_buf = BytesIO()
       self.write_bmp(bmp_buf.write)
       ic = IMConvert(['bmp:-', 'png:-'])
       (png_data,stderr) = ic.run(bmp_buf.getvalue())
-      out(png_data)
\ No newline at end of file
+      out(png_data)
+
+
+# ---------------------------------------------------------------- PNG output
+# Row filters are computed over the entire image at once, by doing bytewise arithmetic on big integers built from the
+# image data: each byte is a lane, and the top bit of every lane is handled separately to keep carries and borrows from
+# crossing lane boundaries.
+def _swar_consts(n):
+   h = int.from_bytes(b'\x80'*n, 'big')
+   return (h, h >> 7)
+
+def _bytes_sub(x, y, h):
+   """Return bytes (x[i] - y[i]) % 256, for n-byte integers x and y."""
+   return ((x | h) - (y & ~h)) ^ ((x ^ y ^ h) & h)
+
+def _bytes_avg(x, y, l):
+   """Return bytes (x[i] + y[i]) // 2, for integers x and y."""
+   return (x & y) + (((x ^ y) >> 1) & (l*0x7f))
+
+def _paeth_row(row, prior, opp):
+   rv = bytearray(len(row))
+   for i in range(len(row)):
+      if (i >= opp):
+         a = row[i-opp]
+         c = prior[i-opp]
+      else:
+         a = c = 0
+      b = prior[i]
+      p = a + b - c
+      pa = abs(p - a)
+      pb = abs(p - b)
+      pc = abs(p - c)
+      if ((pa <= pb) and (pa <= pc)):
+         pred = a
+      elif (pb <= pc):
+         pred = b
+      else:
+         pred = c
+      rv[i] = (row[i] - pred) & 0xff
+   return rv
+
+# Cost function for adaptive filter selection: sum of absolute values of filtered bytes, interpreted as signed.
+_filter_cost_table = bytes(min(i, 256-i) for i in range(256))
+
+class PNGWriter:
+   """Encoder for PNG images from BMPImage instances with 24bit RGB or 32bit RGBA data."""
+   FILTER_NONE = 0
+   FILTER_SUB = 1
+   FILTER_UP = 2
+   FILTER_AVERAGE = 3
+   FILTER_PAETH = 4
+   # Pick the filter type producing the smallest absolute sum for each row. Paeth is computed per-byte in python, and
+   # therefore not considered here.
+   FILTER_ADAPTIVE = 5
+   
+   FILTERS_ADAPTIVE = (FILTER_NONE, FILTER_SUB, FILTER_UP, FILTER_AVERAGE)
+   
+   COLOR_TYPES = {24: 2, 32: 6}
+   
+   def __init__(self, level=6, filter_type=FILTER_ADAPTIVE, threads=1, chunk_size=1 << 20):
+      if not (0 <= filter_type <= self.FILTER_ADAPTIVE):
+         raise ValueError('Invalid filter type {!r}.'.format(filter_type))
+      self.level = level
+      self.filter_type = filter_type
+      self.threads = threads
+      self.chunk_size = chunk_size
+      self._executor = None
+   
+   def close(self):
+      if not (self._executor is None):
+         self._executor.shutdown()
+         self._executor = None
+   
+   def __enter__(self):
+      return self
+   
+   def __exit__(self, *args):
+      self.close()
+   
+   def filter_rows(self, raw, rl, opp):
+      """Return PNG filtered data for raw image data of rl byte rows, including the per-row filter type bytes."""
+      n = len(raw)
+      height = n//rl
+      if (self.filter_type == self.FILTER_ADAPTIVE):
+         types = self.FILTERS_ADAPTIVE
+      else:
+         types = (self.filter_type,)
+      
+      fdata = {}
+      if (self.FILTER_NONE in types):
+         fdata[self.FILTER_NONE] = raw
+      
+      if (set(types) - set((self.FILTER_NONE,))):
+         (h, l) = _swar_consts(n)
+         x = int.from_bytes(raw, 'big')
+         # Left and upper neighbours of every byte
+         left = bytearray(opp) + raw[:-opp]
+         for i in range(0, n, rl):
+            left[i:i+opp] = bytes(opp)
+         a = int.from_bytes(left, 'big')
+         del(left)
+         b = x >> (rl*8)
+         
+         for ft in types:
+            if (ft == self.FILTER_SUB):
+               v = _bytes_sub(x, a, h)
+            elif (ft == self.FILTER_UP):
+               v = _bytes_sub(x, b, h)
+            elif (ft == self.FILTER_AVERAGE):
+               v = _bytes_sub(x, _bytes_avg(a, b, l), h)
+            else:
+               continue
+            fdata[ft] = v.to_bytes(n, 'big')
+      
+      if (self.FILTER_PAETH in types):
+         pd = bytearray(n)
+         prior = bytes(rl)
+         for i in range(0, n, rl):
+            row = raw[i:i+rl]
+            pd[i:i+rl] = _paeth_row(row, prior, opp)
+            prior = row
+         fdata[self.FILTER_PAETH] = pd
+      
+      rv = bytearray((rl+1)*height)
+      o = 0
+      for i in range(0, n, rl):
+         if (len(types) == 1):
+            ft = types[0]
+         else:
+            ft = min(types, key=lambda t: sum(fdata[t][i:i+rl].translate(_filter_cost_table)))
+         rv[o] = ft
+         rv[o+1:o+1+rl] = fdata[ft][i:i+rl]
+         o += rl + 1
+      return rv
+   
+   def _get_executor(self):
+      if (self._executor is None):
+         from concurrent.futures import ThreadPoolExecutor
+         self._executor = ThreadPoolExecutor(self.threads)
+      return self._executor
+   
+   def _compress_piece(self, data, off, last):
+      if (off > 0):
+         # Prime with the preceding window, to compress about as well as a single deflate stream.
+         c = zlib.compressobj(self.level, zlib.DEFLATED, -zlib.MAX_WBITS, zlib.DEF_MEM_LEVEL, zlib.Z_DEFAULT_STRATEGY,
+            data[max(off-32768, 0):off])
+      else:
+         c = zlib.compressobj(self.level, zlib.DEFLATED, -zlib.MAX_WBITS)
+      rv = c.compress(data[off:off+self.chunk_size])
+      rv += c.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+      return rv
+   
+   def compress(self, data):
+      """Return zlib stream for data.
+      
+      With more than one thread, data is split into pieces which are deflated in parallel, and concatenated into a
+      single stream."""
+      if ((self.threads <= 1) or (len(data) <= self.chunk_size)):
+         return zlib.compress(data, self.level)
+      
+      m = memoryview(data)
+      offs = range(0, len(data), self.chunk_size)
+      futures = [self._get_executor().submit(self._compress_piece, m, off, off + self.chunk_size >= len(data))
+         for off in offs]
+      
+      level = self.level
+      if (level < 0):
+         level = 6
+      flevel = (0 if (level < 2) else 1 if (level < 6) else 2 if (level == 6) else 3)
+      cmf = 0x78
+      flg = flevel << 6
+      flg += 31 - ((cmf << 8) + flg) % 31
+      
+      rv = [bytes((cmf, flg))]
+      rv.extend(f.result() for f in futures)
+      rv.append(struct.pack('>L', zlib.adler32(data)))
+      return b''.join(rv)
+   
+   @staticmethod
+   def _make_chunk(ctype, data):
+      return b''.join((struct.pack('>L', len(data)), ctype, data, struct.pack('>L', zlib.crc32(data, zlib.crc32(ctype)))))
+   
+   def write(self, img, out):
+      try:
+         color_type = self.COLOR_TYPES[img.color_depth]
+      except KeyError:
+         raise ValueError('Unsupported color depth {!r} for PNG output.'.format(img.color_depth))
+      if not (img.width and img.height):
+         raise ValueError('Invalid image dimensions {}x{} for PNG output.'.format(img.width, img.height))
+      opp = img.color_depth//8
+      
+      fdata = self.filter_rows(img.get_rows_rgb(), img.width*opp, opp)
+      out(b'\x89PNG\r\n\x1a\n')
+      out(self._make_chunk(b'IHDR', struct.pack('>LLBBBBB', img.width, img.height, 8, color_type, 0, 0, 0)))
+      out(self._make_chunk(b'IDAT', self.compress(fdata)))
+      out(self._make_chunk(b'IEND', b''))
\ No newline at end of file
@@ -59,6 +59,11 @@ class RegistryDict(dict):
       return build
 
 class _RIFFDataSize(int):
+   def get_padding(self):
+      if (self % 2):
+         return b'\x00'
+      return b''
+   
    def write_padding(self, out):
       if (self % 2):
          return out(b'\x00')
@@ -67,6 +72,37 @@ class _RIFFDataSize(int):
 class RIFFChunkBase:
    def get_chunk_header(self, data_size):
       return (struct.pack('>L', self.cid) + struct.pack('<L', data_size))
+   
+   # Serialization is implemented by iter_parts(), which yields chunk headers as bytes objects and payloads as drefs.
+   def iter_data(self):
+      """Yield serialized chunk in pieces."""
+      return _iter_parts_data(self.iter_parts())
+   
+   def write_to_file(self, out):
+      rv = 0
+      for data in self.iter_data():
+         rv += out(data)
+      return rv
+   
+   def write_to_fileobj(self, f_out):
+      """Write serialized chunk to binary file object; payloads are copied without reading them into memory, where possible."""
+      return _write_parts(f_out, self.iter_parts())
+
+def _iter_parts_data(parts):
+   for part in parts:
+      if (isinstance(part, DataRef)):
+         yield from iter_dref_data(part)
+      else:
+         yield part
+
+def _write_parts(f_out, parts):
+   rv = 0
+   for part in parts:
+      if (isinstance(part, DataRef)):
+         rv += write_dref(f_out, part)
+      else:
+         rv += f_out.write(part)
+   return rv
 
 @registry_setup_default
 class RIFFChunk(RIFFChunkBase):
@@ -78,12 +114,11 @@ class RIFFChunk(RIFFChunkBase):
    def get_data_size(self):
       return _RIFFDataSize(self.dref.get_size())
    
-   def write_to_file(self, out):
+   def iter_parts(self):
       ds = self.get_data_size()
-      rv = out(self.get_chunk_header(ds))
-      rv += out(self.dref.get_data())
-      rv += ds.write_padding(out)
-      return rv
+      yield self.get_chunk_header(ds)
+      yield self.dref
+      yield ds.get_padding()
    
    def __repr__(self):
       return '{}({}, {})'.format(type(self).__name__, self.cid, self.dref)
@@ -102,13 +137,12 @@ class RIFFChunk_Listlike(RIFFChunkBase):
    def get_data_size(self):
       return _RIFFDataSize(self.contents.get_data_size() + 4)
    
-   def write_to_file(self, out):
+   def iter_parts(self):
       ds = self.get_data_size()
-      rv = out(self.get_chunk_header(ds))
-      rv += out(self.form_type.get_bytes())
-      rv += self.contents.write_to_file(out)
-      rv += ds.write_padding(out)
-      return rv
+      yield self.get_chunk_header(ds)
+      yield self.form_type.get_bytes()
+      yield from self.contents.iter_parts()
+      yield ds.get_padding()
    
    def __repr__(self):
       return '{}({}, {})'.format(type(self).__name__, self.form_type, self.contents)
@@ -168,7 +202,7 @@ class RIFFChunk_Wave_fmt(RIFFChunkBase):
       rv += len(self.fsd)
       return _RIFFDataSize(rv)
    
-   def write_to_file(self, out):
+   def iter_parts(self):
       hdr = struct.pack(self.hdr_fmt, self.fmt, self.channels, self.sfreq, self.abyterate, self.blockalign)
       
       if (self.fmt in (self.FMT_MS_PCM, self.FMT_MS_ADPCM)):
@@ -178,13 +212,11 @@ class RIFFChunk_Wave_fmt(RIFFChunkBase):
          raise ValueError('Unknown Wave fmt {:d}.'.format(self.fmt))
       
       ds = self.get_data_size()
-      rv = out(self.get_chunk_header(ds))
-      rv += out(hdr)
-      rv += out(hdr2)
-      rv += out(self.fsd)
-      rv += ds.write_padding(out)
-      
-      return rv
+      yield self.get_chunk_header(ds)
+      yield hdr
+      yield hdr2
+      yield self.fsd
+      yield ds.get_padding()
 
 
 class RIFFChunkList(list):
@@ -215,11 +247,28 @@ class RIFFChunkList(list):
    def get_data_size(self):
       return _RIFFDataSize(sum((e.get_data_size() for e in self)) + len(self)*self.riff_chunk_header_size)
    
+   def iter_parts(self):
+      for e in self:
+         yield from e.iter_parts()
+   
+   def iter_data(self):
+      """Yield serialized chunks in pieces."""
+      return _iter_parts_data(self.iter_parts())
+   
    def write_to_file(self, out):
       rv = 0
       for e in self:
          rv += e.write_to_file(out)
       return rv
+   
+   def write_to_fileobj(self, f_out):
+      """Write serialized chunks to binary file object; payloads are copied without reading them into memory, where
+         possible."""
+      return _write_parts(f_out, self.iter_parts())
+   
+   def get_reader(self):
+      """Return file-like object that serializes the chunks as it's read from."""
+      return IterFile(self.iter_data())
 
 class RIFFFile(RIFFChunkList):
    @classmethod
@@ -244,7 +293,7 @@ def _main():
       print(rifff)
       if (opts.remux):
          f2 = open(fn + b'.e17p.tmp', 'wb')
-         rifff.write_to_file(f2.write)
+         rifff.write_to_fileobj(f2)
 
 if (__name__ == '__main__'):
    _main()
@@ -16,7 +16,10 @@
 
 # Media container I/O: Base types
 
+import io
+import os
 import struct
+import sys
 
 class ContainerError(Exception):
    pass
@@ -36,7 +39,7 @@ class DataRefFile(DataRef):
       self.off = off
       self.size = size
    
-   def get_data(self, l=None, off=None):
+   def _get_range(self, l, off):
       if (off is None):
          off = 0
       
@@ -45,15 +48,39 @@ class DataRefFile(DataRef):
       elif ((l + off) > self.size):
          raise ValueError('Attempted to read {:d} bytes ({:d}/{:d}) from domain of length {:d}.'.format(l+off, off, l, self.size))
       
-      off += self.off
+      return (l, off + self.off)
+   
+   def get_data(self, l=None, off=None):
+      (l, off) = self._get_range(l, off)
       self.f.seek(off)
       
       return self.f.read(l)
    
+   def get_view(self, l=None, off=None):
+      """Return read-only memoryview of data; this is zero-copy if the underlying file supports it."""
+      (l, off) = self._get_range(l, off)
+      try:
+         gv = self.f.get_view
+      except AttributeError:
+         self.f.seek(off)
+         return memoryview(self.f.read(l)).toreadonly()
+      
+      return gv(l, off)
+   
    def get_dref_plain(self):
       """Return dref to access this data in plaintext (i.e. unobfuscated and decompressed at this layer)."""
       return self
    
+   def get_detached(self):
+      """Return copy of this dref backed by an in-memory copy of its data.
+      
+      Unlike the original, the copy can safely be used concurrently with other users of the underlying file."""
+      from copy import copy
+      rv = copy(self)
+      rv.f = BufferFile(self.get_data())
+      rv.off = 0
+      return rv
+   
    def get_size(self):
       return self.size
    
@@ -64,6 +91,202 @@ class DataRefFile(DataRef):
    def __format__(self, fs):
       return '{0}{1}'.format(type(self).__name__, (self.f, self.off, self.size))
 
+def iter_dref_data(dref):
+   """Yield data of dref in pieces; drefs with an iter_data() method are read piecewise."""
+   try:
+      iter_data = dref.iter_data
+   except AttributeError:
+      yield dref.get_data()
+   else:
+      yield from iter_data()
+
+def _copy_file_range(fd_in, fd_out, off_in, off_out, count):
+   return os.copy_file_range(fd_in, fd_out, count, off_in, off_out)
+
+def _sendfile(fd_in, fd_out, off_in, off_out, count):
+   os.lseek(fd_out, off_out, os.SEEK_SET)
+   return os.sendfile(fd_out, fd_in, off_in, count)
+
+# In-kernel copy functions, in order of preference
+_fd_copy_funcs = []
+if (hasattr(os, 'copy_file_range')):
+   _fd_copy_funcs.append(_copy_file_range)
+if (hasattr(os, 'sendfile') and sys.platform.startswith('linux')):
+   # Other platforms restrict sendfile() output to sockets.
+   _fd_copy_funcs.append(_sendfile)
+
+def _fd_copy(copy, fd_in, off_in, fd_out, off_out, count):
+   rv = 0
+   while (rv < count):
+      try:
+         l = copy(fd_in, fd_out, off_in+rv, off_out+rv, count-rv)
+      except OSError:
+         if (rv == 0):
+            raise
+         break
+      if (l == 0):
+         break
+      rv += l
+   return rv
+
+def write_dref(f_out, dref, block_size=1 << 20):
+   """Write data of dref to binary file object f_out; returns number of bytes written.
+   
+   Data of plain DataRefFile instances over real files is copied in-kernel through os.copy_file_range() or os.sendfile()
+   if f_out is a real file too; otherwise, it's copied in blocks of at most block_size bytes, read through positional reads
+   where possible. Other drefs are written as returned by iter_dref_data()."""
+   if (hasattr(dref, 'iter_data') or not (isinstance(dref, DataRefFile) and
+         (type(dref).get_data is DataRefFile.get_data))):
+      rv = 0
+      for data in iter_dref_data(dref):
+         rv += f_out.write(data)
+      return rv
+   
+   (off_in, size) = (dref.off, dref.size)
+   try:
+      fd_in = dref.f.fileno()
+   except (AttributeError, ValueError, OSError):
+      # io.UnsupportedOperation is a subclass of both ValueError and OSError.
+      fd_in = None
+   
+   rv = 0
+   if not (fd_in is None):
+      try:
+         f_out.flush()
+         fd_out = f_out.fileno()
+         off_out = f_out.tell()
+      except (AttributeError, ValueError, OSError):
+         fd_out = None
+      
+      if not (fd_out is None):
+         for copy in _fd_copy_funcs:
+            try:
+               rv += _fd_copy(copy, fd_in, off_in+rv, fd_out, off_out+rv, size-rv)
+            except OSError:
+               continue
+            if (rv == size):
+               break
+         f_out.seek(off_out + rv)
+   
+   while (rv < size):
+      l = min(block_size, size-rv)
+      if (fd_in is None):
+         data = dref.get_view(l, rv)
+      else:
+         data = os.pread(fd_in, l, off_in+rv)
+         if (len(data) == 0):
+            raise ValueError('Unexpected EOF at offset {:d} in {!r}.'.format(off_in+rv, dref.f))
+      rv += f_out.write(data)
+   return rv
+
+
+class BufferFile:
+   """Read-only file-like interface to an in-memory buffer.
+   
+   Unlike BytesIO, this never copies the buffer and hands out zero-copy views of its contents on request; views don't
+   depend on the file position, so any number of readers can share a single instance."""
+   def __init__(self, buf, f=None):
+      self._buf = memoryview(buf).toreadonly()
+      self._f = f
+      self._off = 0
+   
+   @classmethod
+   def map_file(cls, f):
+      """Build instance backed by a read-only memory mapping of the specified file."""
+      import mmap
+      m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+      return cls(m, f)
+   
+   def get_view(self, l, off):
+      return self._buf[off:off+l]
+   
+   def read(self, l=-1):
+      off = self._off
+      if ((l is None) or (l < 0)):
+         l = len(self._buf) - off
+      rv = self._buf[off:off+l].tobytes()
+      self._off += len(rv)
+      return rv
+   
+   def readinto(self, b):
+      off = self._off
+      data = self._buf[off:off+len(b)]
+      l = len(data)
+      b[:l] = data
+      self._off += l
+      return l
+   
+   def seek(self, off, whence=0):
+      if (whence == 1):
+         off += self._off
+      elif (whence == 2):
+         off += len(self._buf)
+      elif (whence != 0):
+         raise ValueError('Invalid whence value {!r}.'.format(whence))
+      if (off < 0):
+         raise ValueError('Negative seek position {:d}.'.format(off))
+      self._off = off
+      return off
+   
+   def tell(self):
+      return self._off
+   
+   def fileno(self):
+      """Return file descriptor of the mapped file, if any."""
+      if (self._f is None):
+         from io import UnsupportedOperation
+         raise UnsupportedOperation('{!r} is not backed by a file.'.format(self))
+      return self._f.fileno()
+   
+   def __len__(self):
+      return len(self._buf)
+   
+   def __repr__(self):
+      return '<{} {:d} bytes at {:#x}: {!r}>'.format(type(self).__name__, len(self._buf), id(self), self._f)
+
+class IterFile(io.RawIOBase):
+   """Read-only, unseekable file-like interface to an iterable of buffer objects.
+   
+   Elements are only retrieved from the iterable as reads require them, so data can be produced lazily; at most one
+   element is held at any time."""
+   def __init__(self, it):
+      super().__init__()
+      self._it = iter(it)
+      self._buf = memoryview(b'')
+      self._off = 0
+   
+   def readable(self):
+      return True
+   
+   def readinto(self, b):
+      b = memoryview(b).cast('B')
+      rv = 0
+      while (rv < len(b)):
+         if not (self._buf):
+            try:
+               self._buf = memoryview(next(self._it)).cast('B')
+            except StopIteration:
+               self._it = iter(())
+               break
+            continue
+         
+         data = self._buf[:len(b)-rv]
+         l = len(data)
+         b[rv:rv+l] = data
+         self._buf = self._buf[l:]
+         rv += l
+      self._off += rv
+      return rv
+   
+   def tell(self):
+      return self._off
+   
+   def close(self):
+      self._buf = memoryview(b'')
+      self._it = iter(())
+      super().close()
+
+
 #class DataRefBytes(DataRef, bytes):
    #def __init__(self, *args, **kwargs):
       #bytes.__init__(self)
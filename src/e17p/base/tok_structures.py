@@ -31,13 +31,39 @@ class UnknownTokenError(KeyError):
    pass
 
 class TTHierarchy(dict):
+   # Flat dispatch table: list of 256 build callables (or None for unknown opcodes), indexed by opcode byte. Compiled
+   # on first use, and dropped whenever the hierarchy is modified.
+   _table = None
    def reg(self, val):
       self[val.type] = val
       return val
    
+   def __setitem__(self, key, val):
+      self._table = None
+      super().__setitem__(key, val)
+   
+   def __delitem__(self, key):
+      self._table = None
+      super().__delitem__(key)
+   
    def __getinitargs__(self):
       return (tuple(self.items()),)
    
+   def __getstate__(self):
+      rv = self.__dict__.copy()
+      rv.pop('_table', None)
+      return rv
+   
+   def get_table(self):
+      """Return flat dispatch table for this hierarchy level."""
+      rv = self._table
+      if (rv is None):
+         rv = [None]*256
+         for (tt, b) in self.items():
+            rv[tt] = b.build
+         self._table = rv
+      return rv
+   
    def get_types(self):
       rv = set()
       for arg in self.values():
@@ -48,14 +74,13 @@ class TTHierarchy(dict):
       if (get_dref):
          off_0 = f.get_off()
       
-      tt = ord(f.read(1))
+      tt = f.read(1)[0]
       
-      try:
-         b = self[tt]
-      except KeyError as exc:
-         raise UnknownTokenError('Unknown opcode {:02x}.'.format(tt)) from exc
+      b = (self._table or self.get_table())[tt]
+      if (b is None):
+         raise UnknownTokenError('Unknown opcode {:02x}.'.format(tt))
       
-      rv = b.build(f, *args, **kwargs)
+      rv = b(f, *args, **kwargs)
       
       if (get_dref):
          size = f.get_off() - off_0
@@ -165,8 +190,61 @@ class BaseTokenType(tuple):
          raise ValueError('Invalid fmt {!r}.'.format(fmt))
       return '-'.join('{:02x}'.format(st) for st in self)
 
-class BaseToken:
-   _dref = None
+class _TokenMeta(type):
+   """Metaclass giving token classes empty __slots__ unless they declare their own.
+   
+   This keeps token instances free of a __dict__; token classes need to list any attributes they add in __slots__."""
+   def __new__(mcls, name, bases, ns, **kwargs):
+      ns.setdefault('__slots__', ())
+      return super().__new__(mcls, name, bases, ns, **kwargs)
+
+class BaseToken(metaclass=_TokenMeta):
+   # _dref is stored as (file, offset, size) for plain DataRefFile instances, and as (dref, None, None) otherwise; there
+   # can be millions of tokens around, and most of them don't need a dref object of their own until it's asked for.
+   __slots__ = ('data', '_dref_f', '_dref_off', '_dref_size')
+   
+   def _get_dref(self):
+      try:
+         f = self._dref_f
+      except AttributeError:
+         return None
+      off = self._dref_off
+      if (off is None):
+         return f
+      return DataRefFile(f, off, self._dref_size)
+   
+   def _set_dref(self, dref):
+      if (type(dref) is DataRefFile):
+         self._dref_f = dref.f
+         self._dref_off = dref.off
+         self._dref_size = dref.size
+      else:
+         self._dref_f = dref
+         self._dref_off = self._dref_size = None
+   
+   _dref = property(_get_dref, _set_dref)
+   
+   def __getstate__(self):
+      rv = {}
+      for cls in type(self).__mro__:
+         for name in cls.__dict__.get('__slots__', ()):
+            if (name.startswith('_dref_') or (name in rv)):
+               continue
+            # Go through the slot descriptor directly; subclasses may shadow slot names with class attributes.
+            try:
+               rv[name] = cls.__dict__[name].__get__(self)
+            except AttributeError:
+               pass
+      rv.update(getattr(self, '__dict__', ()))
+      dref = self._dref
+      if not (dref is None):
+         rv['_dref'] = dref
+      return rv
+   
+   def __setstate__(self, state):
+      for (name, val) in state.items():
+         setattr(self, name, val)
+   
    def _get_off(self):
       return self._dref.off
    
@@ -243,9 +321,26 @@ class BaseToken:
       return set((cls.get_type(),))
 
 
+_structs = {}
+def _get_struct(fmt):
+   try:
+      return _structs[fmt]
+   except KeyError:
+      rv = _structs[fmt] = struct.Struct(fmt)
+      return rv
+
 class TokenizerDataRef(DataRefFile):
    segment_name = None
    _end_forced = None
+   # If true, get_tokens() loads the token data into memory once, and subsequent reads are served from there; otherwise,
+   # every read is passed to the underlying file.
+   buffered = True
+   # While buffering: memoryview of data, and offsets of its start and end in the underlying file
+   _buf = None
+   _buf_off = 0
+   _buf_end = 0
+   # Dict mapping tokenizer classes to (dispatch table, text byte table) tuples; see _get_text_tok_table().
+   _text_tok_tables = {}
    def __init__(self, *args, **kwargs):
       super().__init__(*args, **kwargs)
       self._off_lim = self.off + self.size
@@ -263,12 +358,60 @@ class TokenizerDataRef(DataRefFile):
       """Return extra callgraph edges related to this node."""
       return ()
    
+   def _load_buf(self, off):
+      """Start buffered reading of data from specified offset on."""
+      try:
+         gv = self.f.get_view
+         # Zero-copy; cover the remainder of the file, since reads are allowed to cross the domain wall.
+         end = len(self.f)
+      except (AttributeError, TypeError):
+         self.f.seek(off)
+         self._buf = memoryview(self.f.read(max(self._off_lim - off, 0)))
+      else:
+         self._buf = gv(end - off, off)
+      self._buf_off = off
+      self._buf_end = off + len(self._buf)
+   
+   def _extend_buf(self, end):
+      """Extend buffered data to at least the specified offset, if the underlying file has that much data."""
+      self.f.seek(self._buf_end)
+      data = self.f.read(max(end - self._buf_end, 4096))
+      if (len(data) == 0):
+         return
+      self._buf = memoryview(self._buf.tobytes() + data)
+      self._buf_end += len(data)
+   
+   def _release_buf(self):
+      self._buf = None
+      self._buf_off = self._buf_end = 0
+   
+   def _advance(self, l):
+      """Advance buffered read position by l bytes; returns previous position as offset into buffer.
+      
+      This can replace the buffer, so callers must not access it before calling this."""
+      off = self._off
+      end = off + l
+      if (end > self._buf_end):
+         self._extend_buf(end)
+         if (end > self._buf_end):
+            raise ValueError('Read beyond domain wall.')
+      if (off > self._off_lim):
+         raise ValueError('Read beyond domain wall.')
+      self._off = end
+      return off - self._buf_off
+   
    def read_bval(self, fmt):
-      from struct import calcsize, unpack
-      d = struct.calcsize(fmt)
-      return unpack(fmt, self.read(d))
+      s = _get_struct(fmt)
+      if (self._buf is None):
+         return s.unpack(self.read(s.size))
+      off = self._advance(s.size)
+      return s.unpack_from(self._buf, off)
 
    def read(self, l):
+      if not (self._buf is None):
+         off = self._advance(l)
+         return self._buf[off:off+l].tobytes()
+      
       rv = self.f.read(l)
       if ((len(rv) != l) or (self._off > self._off_lim)):
          raise ValueError('Read beyond domain wall.')
@@ -276,7 +419,8 @@ class TokenizerDataRef(DataRefFile):
       return rv
 
    def seek_back(self, i):
-      self.f.seek(-1*i,1)
+      if (self._buf is None):
+         self.f.seek(-1*i,1)
       self._off -= i
 
    def set_end(self):
@@ -315,9 +459,12 @@ class TokenizerDataRef(DataRefFile):
    
    def read_from_off_mark(self):
       """Return data starting from marked offset, and clear mark"""
-      self.f.seek(self._off_bookmark)
-      l = self._off - self._off_bookmark
+      off = self._off_bookmark
+      l = self._off - off
       self._off_bookmark = None
+      if not (self._buf is None):
+         return self._buf[off-self._buf_off:off-self._buf_off+l].tobytes()
+      self.f.seek(off)
       return self.f.read(l)
    
    def _get_tokdata_off(self):
@@ -326,13 +473,64 @@ class TokenizerDataRef(DataRefFile):
    def _build_token(self, *args, **kwargs):
       return self.TH.build(self, *args, **kwargs)
    
+   def _get_text_tok_table(self):
+      """Return table of 256 bools indicating which leading bytes start a text token, or None if there are none.
+      
+      Bytes are marked if they don't start any opcode, and char_is_text_tok() accepts them; this lets get_tokens()
+      dispatch to read_string() directly, instead of failing opcode lookup first."""
+      cls = type(self)
+      try:
+         (th_tab_c, rv) = self._text_tok_tables[cls]
+      except KeyError:
+         pass
+      else:
+         if ((th_tab_c is None) or (th_tab_c is self.TH.get_table())):
+            return rv
+      
+      rv = [bool(self.char_is_text_tok(bytes((i,)))) for i in range(256)]
+      if (True in rv):
+         th_tab = self.TH.get_table()
+         rv = [(t and (th_tab[i] is None)) for (i, t) in enumerate(rv)]
+      else:
+         # Nothing to do; and don't rely on TH providing a dispatch table in this case.
+         (th_tab, rv) = (None, None)
+      self._text_tok_tables[cls] = (th_tab, rv)
+      return rv
+   
+   def _peek_u8(self):
+      """Return value of byte at current offset without consuming it, or None if it isn't readily available."""
+      if (self._buf is None):
+         return None
+      try:
+         return self._buf[self._off - self._buf_off]
+      except IndexError:
+         return None
+   
+   def _read_text_token(self):
+      off_0 = self._off
+      (val,_) = self.read_string()
+      self.seek_back(1)
+      tok = self.TTYPE_STR(val)
+      tok._dref = DataRefFile(self.f, off_0, self._off-off_0)
+      return tok
+   
    # High-level tokenization functions
    def get_tokens(self, get_dref=False):      
       self._off = self._get_tokdata_off()
-      self.f.seek(self._off)
+      if (self.buffered):
+         self._load_buf(self._off)
+      else:
+         self.f.seek(self._off)
       tokens = []
+      text_tab = self._get_text_tok_table()
       try:
          while (self._off < self._off_lim):
+            if not (text_tab is None):
+               c = self._peek_u8()
+               if (not (c is None) and text_tab[c]):
+                  tokens.append(self._read_text_token())
+                  continue
+            
             ol = self._off
             try:
                tok = self._build_token(get_dref=get_dref)
@@ -340,21 +538,20 @@ class TokenizerDataRef(DataRefFile):
                break
             except UnknownTokenError as exc:
                self._off = ol
-               self.f.seek(ol)
+               if (self._buf is None):
+                  self.f.seek(ol)
                tc = self.read(1)
                if not (self.char_is_text_tok(tc)):
                   raise
                self.seek_back(1)
-               off_0 = self._off
-               (val,_) = self.read_string()
-               self.seek_back(1)
-               tok = self.TTYPE_STR(val)
-               tok._dref = DataRefFile(self.f, off_0, self._off-off_0)
+               tok = self._read_text_token()
             
             tokens.append(tok)
       except Exception as exc:
          exc.tokens = tokens
          raise
+      finally:
+         self._release_buf()
       return tokens
    
    def char_is_text_tok(self, c):
@@ -362,16 +559,31 @@ class TokenizerDataRef(DataRefFile):
 
 
 class TokenizerDataRefLE(TokenizerDataRef):
+   _s_u8 = struct.Struct('<B')
+   _s_u16 = struct.Struct('<H')
+   _s_s16 = struct.Struct('<h')
    def read_u8(self):
-      (val,) = struct.unpack('<B', self.read(1))
+      if (self._buf is None):
+         (val,) = self._s_u8.unpack(self.read(1))
+      else:
+         off = self._advance(1)
+         val = self._buf[off]
       return val
 
    def read_u16(self):
-      (val,) = struct.unpack('<H', self.read(2))
+      if (self._buf is None):
+         (val,) = self._s_u16.unpack(self.read(2))
+      else:
+         off = self._advance(2)
+         (val,) = self._s_u16.unpack_from(self._buf, off)
       return val
 
    def read_s16(self):
-      (val,) = struct.unpack('<h', self.read(2))
+      if (self._buf is None):
+         (val,) = self._s_s16.unpack(self.read(2))
+      else:
+         off = self._advance(2)
+         (val,) = self._s_s16.unpack_from(self._buf, off)
       return val
 
 # ---------------------------------------------------------------- Human-readable token dump structures
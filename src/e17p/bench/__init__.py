@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+#Copyright 2010 Sebastian Hagen
+# This file is part of E17p.
+#
+# E17p is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# E17p is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Codec benchmarks on synthetic data.
+#
+# Every benchmark case times all available implementations of one codec function; for functions registered through
+# AIFuncs, that's one implementation for each available tier (see base.aif).
+
+import time
+
+class BenchCase:
+   def __init__(self, name, setup):
+      self.name = name
+      self._setup = setup
+      self._data = None
+   
+   def get_data(self):
+      """Return (impls, prepare, size) tuple: a dict of implementations, a function returning a fresh argument tuple for
+         each run, and the size of the processed data in bytes."""
+      if (self._data is None):
+         self._data = self._setup()
+      return self._data
+   
+   def run(self, repeat, tiers=None):
+      (impls, prepare, size) = self.get_data()
+      rv = []
+      for (impl_name, func) in sorted(impls.items()):
+         if not ((tiers is None) or (impl_name in tiers)):
+            continue
+         times = []
+         for _ in range(repeat):
+            args = prepare()
+            ts = time.perf_counter()
+            func(*args)
+            times.append(time.perf_counter() - ts)
+         t_best = min(times)
+         rv.append({'case': self.name, 'impl': impl_name, 'size': size, 'times': times, 'best': t_best,
+            'mbps': size/max(t_best, 1E-9)/1E6})
+      return rv
+
+
+def get_cases(size, entropy, seed):
+   """Return list of benchmark cases processing roughly size bytes of data each."""
+   import random
+   from io import BytesIO
+   from . import synth
+   
+   def rng(name):
+      return random.Random('{}:{}'.format(seed, name))
+   
+   # Pick image dimensions close to size in bytes, for the given octets per pixel.
+   def get_dim(opp):
+      width = 640
+      return (width, max(size//(width*opp), 1))
+   
+   def setup_rle():
+      from ..ever17.ff.rle import e17_rle_pack, e17_rle_unpack
+      packed = bytes(e17_rle_pack(synth.gen_bytes(rng('rle'), size, entropy)))
+      return (dict(e17_rle_unpack.impls), lambda: (packed, size), size)
+   
+   def setup_cps_unobfuscate():
+      from ..ever17.ff.cps import DataRefCPSE17
+      (w, h) = get_dim(3)
+      cps = synth.gen_cps(rng('cps'), synth.gen_prt(rng('prt'), w, h, 24, False, entropy))
+      return (dict(DataRefCPSE17.cps_unobfuscate.impls), lambda: (bytearray(cps),), len(cps))
+   
+   def setup_cps_mix_alpha():
+      from ..ever17.ff.cps import CPSImageE17
+      (w, h) = get_dim(4)
+      img = CPSImageE17.build_from_data(synth.gen_prt(rng('prt_a'), w, h, 24, True, entropy))
+      args = (img.image_data, img.alpha_data, img.width, img.height, img.line_length)
+      return (dict(CPSImageE17.cps_mix_alpha.impls), lambda: args, w*h*4)
+   
+   def setup_cps_map_palette():
+      from ..ever17.ff.cps import CPSImageE17
+      (w, h) = get_dim(3)
+      img = CPSImageE17.build_from_data(synth.gen_prt(rng('prt_p'), w, h, 8, False, entropy))
+      args = (img.image_data, img.palette_data, img.width, img.height)
+      return (dict(CPSImageE17.cps_map_palette.impls), lambda: args, w*h*3)
+   
+   def setup_r11_unpack():
+      from ..remember11.ff.compression import R11PackedDataRefFile
+      packed = synth.r11_pack(synth.gen_bytes(rng('r11'), size, entropy))
+      dref = R11PackedDataRefFile(BytesIO(packed), 0, len(packed))
+      return ({'py': R11PackedDataRefFile.unpack}, lambda: (dref,), size)
+   
+   def setup_adpcm():
+      from ..base.codec.msadpcm import adpcm_decode
+      blocksize = 512
+      # MS ADPCM decodes to four times its input size.
+      blocks = max(size//(4*blocksize), 1)
+      data = synth.gen_adpcm(rng('adpcm'), blocks, True, blocksize, entropy)
+      return (dict(adpcm_decode.impls), lambda: (data, True, blocksize), 4*len(data))
+   
+   def setup_t2p():
+      from ..remember11.ff.t2p import DataRefT2P
+      (w, h) = get_dim(4)
+      data = synth.gen_t2p(rng('t2p'), w, h, entropy)
+      dref = DataRefT2P(BytesIO(data), 0, len(data))
+      return ({'py': DataRefT2P._rgba2bmp}, lambda: (dref,), len(data))
+   
+   return [
+      BenchCase('e17_rle_unpack', setup_rle),
+      BenchCase('cps_unobfuscate', setup_cps_unobfuscate),
+      BenchCase('cps_mix_alpha', setup_cps_mix_alpha),
+      BenchCase('cps_map_palette', setup_cps_map_palette),
+      BenchCase('r11_unpack', setup_r11_unpack),
+      BenchCase('adpcm_decode', setup_adpcm),
+      BenchCase('t2p_rgba2bmp', setup_t2p),
+   ]
+
+def write_samples(outdir, size, entropy, seed):
+   """Write one synthetic file of each supported type to outdir."""
+   import os.path
+   import random
+   from . import synth
+   
+   rng = random.Random(seed)
+   (w, h) = (320, max(size//(320*3), 1))
+   prt = synth.gen_prt(rng, w, h, 24, False, entropy)
+   prt_a = synth.gen_prt(rng, w, h, 24, True, entropy)
+   prt_p = synth.gen_prt(rng, w, h, 8, False, entropy)
+   waf_blocks = max(size//2048, 1)
+   files = {
+      'bg.dat': synth.gen_lnk([
+         (b'bg_rgb.cps', synth.gen_cps(rng, prt), False),
+         (b'bg_plain.cps', synth.gen_cps(rng, prt, compress=False), False),
+         (b'bg_pal.cps', synth.gen_cps(rng, prt_p), False),
+      ]),
+      'chara.dat': synth.gen_lnk([(b'ch_alpha.cps', synth.gen_cps(rng, prt_a), False)]),
+      'voice.dat': synth.gen_lnk([
+         (b'v_mono.waf', synth.gen_waf(rng, waf_blocks, entropy=entropy), True),
+         (b'v_stereo.waf', synth.gen_waf(rng, waf_blocks, True, entropy=entropy), True),
+      ]),
+      'sample.prt': prt,
+      'sample.cps': synth.gen_cps(rng, prt_a),
+      'sample.waf': synth.gen_waf(rng, waf_blocks, entropy=entropy),
+      'sample.t2p': synth.gen_t2p(rng, w, h, entropy),
+      'sample.afs': synth.gen_afs([
+         (b'SAMPLE.T2P', synth.gen_t2p(rng, w, h, entropy), True),
+         (b'SAMPLE.BIN', synth.gen_bytes(rng, size, entropy), True),
+      ]),
+   }
+   for (fn, data) in sorted(files.items()):
+      fn = os.path.join(outdir, fn)
+      print('--> {} ({} bytes)'.format(fn, len(data)))
+      with open(fn, 'wb') as f:
+         f.write(data)
+
+def get_meta(opts):
+   import platform
+   import sys
+   return {
+      'time': time.time(),
+      'python': sys.version,
+      'platform': platform.platform(),
+      'size': opts.size,
+      'entropy': opts.entropy,
+      'seed': opts.seed,
+      'repeat': opts.repeat,
+   }
+
+def _main():
+   import json
+   import optparse
+   import sys
+   
+   op = optparse.OptionParser()
+   op.add_option('-s', '--size', type=int, default=1 << 18, help='Approximate amount of data to process per case, in bytes.')
+   op.add_option('-e', '--entropy', type=float, default=0.5, help='Fraction of random data in synthetic input (0 to 1).')
+   op.add_option('-r', '--repeat', type=int, default=3, help='Number of timed runs per implementation.')
+   op.add_option('--seed', default='e17p', help='Seed for synthetic data generation.')
+   op.add_option('-t', '--tiers', default=None, help='Comma-separated list of implementation tiers to time.')
+   op.add_option('-k', '--cases', default=None, help='Only run cases whose name contains this string.')
+   op.add_option('-o', '--outfile', default=None, help='Write JSON results to specified file.')
+   op.add_option('-c', '--compare', default=None, metavar='FILE', help='Compare results with earlier JSON results file.')
+   op.add_option('--write-samples', default=None, metavar='PATH', help='Write synthetic sample files to directory and exit.')
+   (opts, args) = op.parse_args()
+   
+   if not (opts.write_samples is None):
+      write_samples(opts.write_samples, opts.size, opts.entropy, opts.seed)
+      return
+   
+   if (opts.compare is None):
+      res_old = {}
+   else:
+      with open(opts.compare, 'rt') as f:
+         res_old = dict(((r['case'], r['impl']), r) for r in json.load(f)['results'])
+   
+   if (opts.tiers is None):
+      tiers = None
+   else:
+      tiers = opts.tiers.split(',')
+   
+   results = []
+   for case in get_cases(opts.size, opts.entropy, opts.seed):
+      if not ((opts.cases is None) or (opts.cases in case.name)):
+         continue
+      for r in case.run(opts.repeat, tiers):
+         results.append(r)
+         line = '{:20} {:6} {:10d} bytes {:10.4f}s {:10.2f} MB/s'.format(r['case'], r['impl'], r['size'], r['best'],
+            r['mbps'])
+         r_old = res_old.get((r['case'], r['impl']))
+         if not (r_old is None):
+            line += '  ({:+.1%})'.format(r_old['best']/r['best'] - 1)
+         print(line)
+         sys.stdout.flush()
+   
+   if not (opts.outfile is None):
+      with open(opts.outfile, 'wt') as f:
+         json.dump({'meta': get_meta(opts), 'results': results}, f, indent=1, sort_keys=True)
@@ -0,0 +1,218 @@
+#!/usr/bin/env python3
+#Copyright 2010 Sebastian Hagen
+# This file is part of E17p.
+#
+# E17p is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# E17p is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Generators for synthetic, but valid, instances of the file formats we parse.
+#
+# All generators take a random.Random instance, so output is reproducible for a given seed. The entropy arguments (0 to
+# 1) control the fraction of output that's random, as opposed to runs and repeats of earlier data.
+
+import struct
+
+def gen_bytes(rng, size, entropy=0.5):
+   """Return size bytes of data mixing random segments with byte runs and repeats of earlier data."""
+   rv = bytearray()
+   while (len(rv) < size):
+      l = rng.randint(1, 64)
+      if ((rng.random() < entropy) or (len(rv) < 4)):
+         rv += bytes(rng.getrandbits(8) for _ in range(l))
+      elif (rng.random() < 0.5):
+         rv += bytes((rng.getrandbits(8),))*l
+      else:
+         d = rng.randint(1, min(len(rv), 1024))
+         for _ in range(l):
+            rv.append(rv[-d])
+   del(rv[size:])
+   return bytes(rv)
+
+def _gen_pixels(rng, width, height, opp, entropy):
+   """Return image data with rows of opp-byte pixels, and with horizontal spans of equal pixels."""
+   rv = bytearray()
+   for y in range(height):
+      row = bytearray()
+      while (len(row) < width*opp):
+         px = bytes(rng.getrandbits(8) for _ in range(opp))
+         if (rng.random() < entropy):
+            l = 1
+         else:
+            l = rng.randint(1, 32)
+         row += px*l
+      rv += row[:width*opp]
+   return rv
+
+# ---------------------------------------------------------------- Ever17
+def gen_prt(rng, width, height, color_depth=24, alpha=False, entropy=0.5):
+   """Return PRT image data of specified dimensions."""
+   from ..base.ff.bmp import rgb_get_lengths
+   opp = color_depth // 8
+   if (color_depth == 8):
+      palette = bytes(rng.getrandbits(8) for _ in range(1024))
+   else:
+      palette = b''
+   
+   off_palette = 36
+   off_data = off_palette + len(palette)
+   hdr = struct.pack('<4sHHHHHHLLLLL', b'PRT\x00', 0x66, color_depth, off_palette, off_data, width, height, bool(alpha),
+      0, 0, 0, 0)
+   
+   (ill, rgbd_len) = rgb_get_lengths(opp, width, height)
+   pixels = _gen_pixels(rng, width, height, opp, entropy)
+   body = bytearray(rgbd_len)
+   for y in range(height):
+      body[y*ill:y*ill+width*opp] = pixels[y*width*opp:(y+1)*width*opp]
+   
+   rv = hdr + palette + body
+   if (alpha):
+      rv += _gen_pixels(rng, width, height, 1, entropy)
+   return rv
+
+def cps_obfuscate(data, key):
+   """Inverse of DataRefCPSE17.cps_unobfuscate(); the obfuscation key is stored in the last word of data before the
+      trailer."""
+   data = bytearray(data)
+   v_off = len(data)
+   data += struct.pack('<LL', key, v_off + 0x7534682)
+   data_len = len(data)
+   vlim = 1 << 32
+   val_obf = (key + v_off + 0x3786425) % vlim
+   for i_i in range(0x10, data_len-4, 4):
+      if (i_i != v_off):
+         (v,) = struct.unpack('<L', data[i_i:i_i+4])
+         data[i_i:i_i+4] = struct.pack('<L', (v + val_obf + data_len) % vlim)
+      val_obf = (val_obf * 0x41c64e6d + 0x9b06) % vlim
+   return data
+
+def gen_cps(rng, prt, compress=True):
+   """Return CPS file wrapping specified PRT data."""
+   from ..ever17.ff.rle import e17_rle_pack
+   if (compress):
+      body = e17_rle_pack(prt)
+   else:
+      body = prt
+   # Obfuscation works on 32bit words; pad body accordingly.
+   body = bytes(body) + b'\x00'*(-len(body) % 4)
+   size = 20 + len(body) + 8
+   hdr = struct.pack('<4sL2sBxLL', b'CPS\x00', size, b'\x66\x00', int(compress), len(prt), 0)
+   return cps_obfuscate(hdr + body, rng.getrandbits(32))
+
+def gen_lnk(chunks, optimal=False):
+   """Return LNK archive built from sequence of (name, data, compress) tuples."""
+   from ..ever17.ff.lnk import lnd_pack
+   table = bytearray(struct.pack('<4sL8x', b'LNK\x00', len(chunks)))
+   body = bytearray()
+   for (name, data, compress) in chunks:
+      if (compress):
+         data = lnd_pack(data, optimal=optimal)
+      table += struct.pack('<LL24s', len(body), 2*len(data) + bool(compress), name)
+      body += data
+   return table + body
+
+def gen_adpcm(rng, blocks, stereo=False, blocksize=512, entropy=0.5):
+   """Return MS ADPCM data consisting of the specified number of blocks."""
+   rv = bytearray()
+   channels = stereo + 1
+   bhdr_sz = 7*channels
+   for _ in range(blocks):
+      preds = [rng.randint(0, 6) for _ in range(channels)]
+      deltas = [rng.randint(16, 1024) for _ in range(channels)]
+      samples = [rng.randint(-2048, 2047) for _ in range(2*channels)]
+      rv += struct.pack('<{0}B{0}h{0}h{0}h'.format(channels), *(preds + deltas + samples))
+      # Small nibble values keep the signal from saturating.
+      nl = 2*(blocksize - bhdr_sz)
+      nibbles = [(rng.randint(0, 15) if (rng.random() < entropy) else rng.choice((0, 1, 15))) for _ in range(nl)]
+      rv += bytes(((nibbles[i] << 4) | nibbles[i+1]) for i in range(0, nl, 2))
+   return rv
+
+def gen_waf(rng, blocks, stereo=False, sfreq=22050, blocksize=512, entropy=0.5):
+   """Return WAF file with MS ADPCM content."""
+   channels = stereo + 1
+   body = gen_adpcm(rng, blocks, stereo, blocksize, entropy)
+   spb = (blocksize - 7*channels)*2//channels + 2
+   fsd = struct.pack('<HHH', 4, spb, 7).ljust(34, b'\x00')
+   ass = sfreq * blocksize // spb
+   hdr = struct.pack('<4sHHLLH34sL', b'WAF\x00', 0, channels, sfreq, ass, blocksize, fsd, len(body))
+   return hdr + body
+
+# ---------------------------------------------------------------- Remember11
+def r11_pack(data):
+   """Compress data into R11 (LZSS) format, as understood by R11PackedDataRefFile.unpack()."""
+   data = bytes(data)
+   n = len(data)
+   rv = bytearray(struct.pack('<L', n))
+   head = {}
+   i = 0
+   items = []
+   
+   def flush():
+      mask = 0
+      for (j, item) in enumerate(items):
+         if (len(item) == 1):
+            mask |= 1 << j
+      rv.append(mask)
+      for item in items:
+         rv.extend(item)
+      del(items[:])
+   
+   while (i < n):
+      key = data[i:i+3]
+      j = head.get(key)
+      l = 0
+      if ((j is not None) and (i - j <= 0x1000)):
+         lim = min(18, n-i)
+         while ((l < lim) and (data[j+l] == data[i+l])):
+            l += 1
+      
+      if (l >= 3):
+         raw = (j - 18) & 0xfff
+         items.append(bytes((raw & 0xff, ((raw >> 4) & 0xf0) | (l-3))))
+      else:
+         l = 1
+         items.append(data[i:i+1])
+      
+      for k in range(i, min(i+l, n-2)):
+         head[data[k:k+3]] = k
+      i += l
+      if (len(items) == 8):
+         flush()
+   
+   if (items):
+      flush()
+   return rv
+
+def gen_t2p(rng, width, height, entropy=0.5):
+   """Return T2P (TIM2) image of specified dimensions."""
+   opp = 4
+   body = _gen_pixels(rng, width, height, opp, entropy)
+   hdr_len = struct.calcsize('<4sHH8sL5sHxLHHHH24s')
+   size = hdr_len + len(body)
+   hdr = struct.pack('<4sHH8sL5sHxLHHHH24s', b'TIM2', opp, 0, b'', size-16, b'', 0, 0, 0, 0, width, height, b'')
+   return hdr + body
+
+def gen_afs(chunks):
+   """Return AFS archive built from sequence of (name, data, compress) tuples."""
+   from io import BytesIO
+   from ..base.file_data import DataRefFile
+   from ..remember11.ff.afs import AFSParser, AFSAuxData, _AFSChunk
+   
+   cl = []
+   for (name, data, compress) in chunks:
+      if (compress):
+         data = r11_pack(data)
+      cl.append(_AFSChunk(name, DataRefFile(BytesIO(data), 0, len(data)), AFSAuxData(b'\x00'*16)))
+   
+   bio = BytesIO()
+   AFSParser(cl).write_to_file(bio)
+   return bio.getvalue()
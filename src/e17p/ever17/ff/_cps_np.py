@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+#Copyright 2010 Sebastian Hagen
+# This file is part of E17p.
+#
+# E17p is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# E17p is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# NumPy implementations of E17 CPS processing functions; see cps.py for the reference versions.
+
+import struct
+
+import numpy
+from numpy.lib.stride_tricks import as_strided
+
+_vlim = 1 << 32
+
+def _lcg_stream(x0, count, a, c):
+   """Return uint32 array of the first count values of the LCG x' = a*x + c (mod 2**32), starting at x0.
+   
+   This doubles the computed prefix in each step, using the affine map for the corresponding number of LCG steps."""
+   rv = numpy.empty(count, dtype=numpy.uint32)
+   if (count == 0):
+      return rv
+   rv[0] = x0 % _vlim
+   # (am, cm) maps x_i to x_(i+m)
+   (am, cm) = (a, c)
+   m = 1
+   while (m < count):
+      k = min(m, count - m)
+      rv[m:m+k] = rv[:k]*numpy.uint32(am) + numpy.uint32(cm)
+      (am, cm) = ((am*am) % _vlim, (am*cm + cm) % _vlim)
+      m += k
+   return rv
+
+def _get_rows(buf, height, row_len, ll):
+   """Return read-only (height, row_len) uint8 array view of image data with lines of ll bytes."""
+   a = numpy.frombuffer(buf, dtype=numpy.uint8)
+   if ((height > 0) and (len(a) < (height-1)*ll + row_len)):
+      raise ValueError('Insufficient input data: Got {}/{} bytes.'.format(len(a), (height-1)*ll + row_len))
+   return as_strided(a, shape=(height, row_len), strides=(ll, 1), writeable=False)
+
+def cps_unobfuscate(data):
+   v_off = struct.unpack(b'<L', data[-4:])[0] - 0x7534682
+   if (v_off == 0):
+      return data
+   
+   val_obf = struct.unpack(b'<L', data[v_off:v_off+4])[0] + v_off + 0x3786425
+   data_len = len(data)
+   if (data_len < 20):
+      return data
+   
+   # Words start at 0x10 and continue while their offset is below the trailer, even if that means they overlap it.
+   count = (data_len - 4 - 0x10 + 3)//4
+   words = numpy.frombuffer(data, dtype='<u4', count=count, offset=0x10)
+   keys = _lcg_stream(val_obf, count, 0x41c64e6d, 0x9b06)
+   keys += numpy.uint32(data_len % _vlim)
+   
+   (j, j_mod) = divmod(v_off - 0x10, 4)
+   if ((j_mod == 0) and (0 <= j < count)):
+      # Skip obfuscation information
+      keys[j] = 0
+   words -= keys
+   
+   # Release our buffer export before resizing.
+   del(words)
+   del(data[-4:])
+   return data
+
+def cps_mix_alpha(m_body, m_alpha, width, height, ill):
+   pixel_count = width*height
+   if (len(m_alpha) < pixel_count):
+      raise ValueError('Insufficient alpha data: Got {}/{} bytes.'.format(len(m_alpha), pixel_count))
+   
+   rgba_data = bytearray(pixel_count*4)
+   out = numpy.frombuffer(rgba_data, dtype=numpy.uint8).reshape(height, width, 4)
+   out[:,:,:3] = _get_rows(m_body, height, width*3, ill).reshape(height, width, 3)
+   # Alpha lines are stored bottom-up, at the end of the buffer.
+   alpha = numpy.frombuffer(m_alpha, dtype=numpy.uint8)
+   out[:,:,3] = alpha[len(alpha)-pixel_count:].reshape(height, width)[::-1]
+   del(out)
+   return memoryview(rgba_data)
+
+def cps_map_palette(m_body, m_palette, width, height):
+   ill = ((width+3)//4)*4
+   oll = ((width*3+3)//4)*4
+   
+   rv = bytearray(oll*height)
+   palette = numpy.frombuffer(m_palette, dtype=numpy.uint8).reshape(-1, 4)[:,:3]
+   out = numpy.frombuffer(rv, dtype=numpy.uint8).reshape(height, oll)
+   out[:,:width*3] = palette[_get_rows(m_body, height, width, ill)].reshape(height, width*3)
+   del(out)
+   return rv
@@ -26,6 +26,67 @@ from ...base.ff.bmp import BMPImage, IMConvert, rgb_get_lengths
 from ...base.aif import AIFuncs
 _aifs = AIFuncs()
 
+class PRTHeader:
+   # Maximum header length, over all header types
+   HDR_LEN = 36
+   
+   def __init__(self, tv, color_depth, off_palette, off_data, width, height, alpha, base_l_off, base_width, base_height):
+      self.tv = tv
+      self.color_depth = color_depth
+      self.off_palette = off_palette
+      self.off_data = off_data
+      self.width = width
+      self.height = height
+      self.alpha = alpha
+      self.base_l_off = base_l_off
+      self.base_width = base_width
+      self.base_height = base_height
+      self.palette = None
+   
+   def __repr__(self):
+      return '<{} {}x{}x{} alpha={} palette={} base_l_off={}>'.format(type(self).__name__, self.width, self.height,
+         self.color_depth, bool(self.alpha), self.has_palette(), (self.base_l_off, self.base_width))
+   
+   def has_palette(self):
+      return (self.off_data > self.off_palette)
+   
+   def set_palette(self, m):
+      """Extract palette from (a prefix of) PRT data, if we have one."""
+      if not (self.has_palette()):
+         return
+      m_palette = m[self.off_palette:self.off_data]
+      if (len(m_palette) != (1 << self.color_depth)*4):
+         raise ValueError('Invalid pallette size {} for color depth {}.'.format(len(m_palette), self.color_depth))
+      self.palette = m_palette
+   
+   @classmethod
+   def build_from_data(cls, m):
+      """Parse header from (a prefix of) PRT data."""
+      if (m[:4] != b'PRT\x00'):
+         raise ValueError('Unexpected preamble {!r}.'.format(bytes(m[:4])))
+      
+      (tv,) = struct.unpack(b'<H', m[4:6])
+      
+      if (tv == 0x66):
+         (color_depth,off_palette,off_data,width,height,alpha,base_l_off,u2,width2,height2) = struct.unpack(b'<HHHHHLLLLL', m[6:36])
+      elif (tv == 0x65):
+         (color_depth,off_palette,off_data,width,height,alpha) = struct.unpack(b'<HHHHHL', m[6:20])
+         height2 = width2 = base_l_off = u2 = 0
+      else:
+         raise ValueError('Unexpected type val {:x}.'.format(tv))
+      
+      # Update on seperately stored actual image dimensions
+      base_width = width
+      base_height = height
+      if (width2 != 0):
+         width = width2
+      
+      if (height2 != 0):
+         height = height2
+      
+      return cls(tv, color_depth, off_palette, off_data, width, height, alpha, base_l_off, base_width, base_height)
+
+
 class CPSImageE17:
    def __init__(self, width, height, color_depth, line_length, opp, base_l_off, image_data, alpha_data, palette_data):
       self.width = width
@@ -54,37 +115,11 @@ class CPSImageE17:
    @classmethod
    def build_from_data(cls, data):
       m = memoryview(data)
+      hdr = PRTHeader.build_from_data(m)
+      hdr.set_palette(m)
+      (color_depth, width, height, alpha) = (hdr.color_depth, hdr.width, hdr.height, hdr.alpha)
       
-      if (m[:4] != b'PRT\x00'):
-         raise ValueError('Unexpected preamble {!r}.'.format(data[:4]))
-      
-      (tv,) = struct.unpack(b'<H', m[4:6])
-      
-      if (tv == 0x66):
-         (color_depth,off_palette,off_data,width,height,alpha,base_l_off,u2,width2,height2) = struct.unpack(b'<HHHHHLLLLL', m[6:36])
-      elif (tv == 0x65):
-         (color_depth,off_palette,off_data,width,height,alpha) = struct.unpack(b'<HHHHHL', m[6:20])
-         height2 = width2 = base_l_off = u2 = 0
-      else:
-         raise ValueError('Unexpected type val {:x}.'.format(tv))
-      
-      if (off_data > off_palette):
-         m_palette = m[off_palette:off_data]
-         if (len(m_palette) != (1 << color_depth)*4):
-            raise ValueError('Invalid pallette size {} for color depth {}.'.format(len(m_palette), color_depth))
-      else:
-         m_palette = None
-      
-      m_body = m[off_data:]
-      # Update on seperately stored actual image dimensions
-      base_width = width
-      base_height = height
-      if (width2 != 0):
-         width = width2
-      
-      if (height2 != 0):
-         height = height2
-      
+      m_body = m[hdr.off_data:]
       pixel_count = width*height
       (opp, cd_mod) = divmod(color_depth, 8)
       
@@ -99,7 +134,7 @@ class CPSImageE17:
          m_alpha = None
       m_body = m_body[:rgbd_len]
       
-      return cls(width, height, color_depth, ill, opp, (base_l_off, base_width), m_body, m_alpha, m_palette)
+      return cls(width, height, color_depth, ill, opp, (hdr.base_l_off, hdr.base_width), m_body, m_alpha, hdr.palette)
    
    @staticmethod
    @_aifs.add
@@ -115,7 +150,7 @@ class CPSImageE17:
          i_i = line_off
          for x in range(width):
             rgba_data[o_i:o_i+3] = m_body[i_i:i_i+3]
-            rgba_data[o_i+3:o_i+4] = m_alpha[-y*width - width + x]
+            rgba_data[o_i+3] = m_alpha[-y*width - width + x]
             i_i += 3
             o_i += 4
          line_off += ill
@@ -134,7 +169,7 @@ class CPSImageE17:
       o = 0
       i = 0
       for _ in range(height):
-         rv[o:o+3*width] = b''.join((bytes(m_palette[4*ord(b):4*ord(b)+3])) for b in m_body[i:i+width])
+         rv[o:o+3*width] = b''.join((bytes(m_palette[4*b:4*b+3])) for b in m_body[i:i+width])
          i += ill
          o += oll
       return rv
@@ -168,6 +203,8 @@ class CPSImageE17:
 class DataRefCPSE17(DataRefFile):
    CPS_CLS = CPSImageE17
    HDR_LEN = 20
+   # Decoded image cache (imgcache.CPSImageCache instance) used by get_img(), if any.
+   img_cache = None
    
    def __init__(self, *args, **kwargs):
       super().__init__(*args, **kwargs)
@@ -200,6 +237,18 @@ class DataRefCPSE17(DataRefFile):
          raise ValueError('Unknown cmp_type {}.'.format(cmp_type_raw))
       self.cmp_type = cmp_type
    
+   def get_idx_data(self):
+      """Return tuple of ints sufficient to rebuild this instance with build_from_idx_data()."""
+      return (self.cmp_type, self.size_plain)
+   
+   @classmethod
+   def build_from_idx_data(cls, src, data):
+      """Build instance from similar dref and get_idx_data() output, without reading the header again."""
+      rv = cls.__new__(cls)
+      DataRefFile.__init__(rv, src.f, src.off, src.size)
+      (rv.cmp_type, rv.size_plain) = data
+      return rv
+   
    def __str__(self):
       return '< {} image type {} length {}({}) @ {}({}:{}):>'.format(type(self).__name__, self.cmp_type, self.size_plain,
          self.size, self.f, self.off, self.off+self.size)
@@ -211,7 +260,7 @@ class DataRefCPSE17(DataRefFile):
    
    
    def get_content_unobfuscated(self):
-      data = bytearray(self.get_data())
+      data = bytearray(self.get_view())
       self.cps_unobfuscate(data)
       return data
 
@@ -264,10 +313,96 @@ class DataRefCPSE17(DataRefFile):
       rv = e17_rle_unpack(din[20:], out_sz)
       return rv
    
+   def iter_content_decompressed(self, block_size=1 << 16):
+      """Yield decompressed content in blocks of (at most) block_size bytes."""
+      if (self.cmp_type == 0):
+         m = memoryview(self.get_content_unobfuscated())[20:self.size_plain+20]
+         for off in range(0, len(m), block_size):
+            yield m[off:off+block_size]
+         return
+      if (self.cmp_type != 1):
+         raise ValueError('Unknown cmp_type {!r}.'.format(self.cmp_type))
+      
+      from .rle import e17_rle_unpack_iter
+      din = memoryview(self.get_content_unobfuscated())
+      pieces = (din[off:off+block_size] for off in range(20, len(din), block_size))
+      for block in e17_rle_unpack_iter(pieces, self.size_plain, block_size):
+         yield block
+   
+   def _iter_content_unobfuscated(self, block_size=4096):
+      """Yield unobfuscated data following the CPS header in pieces, reading only as much as is consumed.
+      
+      This yields the same data as get_content_unobfuscated()[20:], for well-formed files."""
+      size = self.size
+      v_off = struct.unpack(b'<L', self.get_data(4, size-4))[0] - 0x7534682
+      if (v_off == 0):
+         # Not obfuscated; note that in this case the trailer isn't stripped, either.
+         for off in range(self.HDR_LEN, size, block_size):
+            yield self.get_data(min(block_size, size-off), off)
+         return
+      if not (0 <= v_off <= size-4):
+         raise ValueError('Invalid obfuscation data offset {:d} for file of size {:d}.'.format(v_off, size))
+      
+      vlim = 1 << 32
+      val_obf = (struct.unpack(b'<L', self.get_data(4, v_off))[0] + v_off + 0x3786425) % vlim
+      # Words start at 0x10, and continue while their offset is below the trailer.
+      off_lim = size - 4
+      bs = max(block_size//4, 1)*4
+      for off in range(0x10, off_lim, bs):
+         wc = (min(bs, off_lim - off) + 3)//4
+         words = list(struct.unpack('<{:d}L'.format(wc), self.get_data(wc*4, off)))
+         for i in range(wc):
+            if (off + 4*i != v_off):
+               words[i] = (words[i] - val_obf - size) % vlim
+            val_obf = (val_obf * 0x41c64e6d + 0x9b06) % vlim
+         
+         data = struct.pack('<{:d}L'.format(wc), *words)
+         # Trim CPS header and trailer.
+         yield data[max(self.HDR_LEN - off, 0):off_lim - off]
+   
+   def get_prt_header(self, palette=True):
+      """Return PRTHeader for contained image, decoding only as much data as necessary.
+      
+      If palette is true, the returned header also carries the palette of paletted images."""
+      if not (self.cmp_type in (0, 1)):
+         raise ValueError('Unknown cmp_type {!r}.'.format(self.cmp_type))
+      
+      from .rle import E17RLEDecoder
+      pieces = self._iter_content_unobfuscated(1024)
+      dec = E17RLEDecoder(self.size_plain, limit=0)
+      data = bytearray()
+      
+      def decode_to(limit):
+         limit = min(limit, self.size_plain)
+         if (self.cmp_type == 0):
+            while (len(data) < limit):
+               data.extend(next(pieces))
+            return
+         
+         dec.set_limit(limit)
+         while not (dec.is_done()):
+            data.extend(b''.join(dec.feed(next(pieces))))
+         data.extend(dec.finish())
+      
+      try:
+         decode_to(PRTHeader.HDR_LEN)
+         rv = PRTHeader.build_from_data(memoryview(data))
+         if (palette and rv.has_palette()):
+            decode_to(rv.off_data)
+            rv.set_palette(memoryview(data))
+      except StopIteration:
+         raise ValueError('CPS data exhausted at {:d}/{:d} bytes of output.'.format(len(data), self.size_plain))
+      return rv
+   
    def get_bmp(self):
       return self.get_img().get_bmp()
    
    def get_img(self):
+      if (self.img_cache is None):
+         return self._get_img()
+      return self.img_cache.get_img(self, self._get_img)
+   
+   def _get_img(self):
       d = self.get_content_decompressed()
       return self.CPS_CLS.build_from_data(d)
 
@@ -278,11 +413,13 @@ class DataRefCPSE17(DataRefFile):
       import sys
       op = optparse.OptionParser()
       op.add_option('-d', '--decompress', default=False, dest='decompress', action='store_true', help='Attempt to decompress files.')
+      op.add_option('-H', '--header', default=False, action='store_true', help='Print PRT header data.')
       op.add_option('-q', '--deobfuscate', default=False, dest='deobfuscate', action='store_true', help='Dump deobfuscated file data.')
       op.add_option('-o', '--outdir', default=None, dest='outdir', metavar='PATH', help='Directory to write output files to.')
       #op.add_option('-i', '--sanity-check-override', default=False, action='store_true', dest='insanity', help="Don't skip undecodable files.")
       op.add_option('-b', '--bmp', default=False, dest='bmp_out', action='store_true', help='Write image data to BMP files.')
       op.add_option('-p', '--png', default=False, dest='png_out', action='store_true', help='Write image data to PNG files.')
+      op.add_option('--imconvert', default=False, action='store_true', help='Use external convert(1) binary for PNG output.')
       op.add_option('--lnk', default=False, dest='lnk', action='store_true', help='Parse input from LNK archive instead of presplitted scr files.')
       (opts, args) = op.parse_args()
       
@@ -301,7 +438,7 @@ class DataRefCPSE17(DataRefFile):
       
       need_img = opts.bmp_out or opts.png_out
       
-      if (opts.png_out):
+      if (opts.png_out and opts.imconvert):
          (env_ok,exc) = IMConvert.test_environment()
          if not (env_ok):
             print("ERROR: You requested PNG output, and I'm unable to find a working convert(1) binary. Test call failed with: {!r}.".format(exc))
@@ -334,6 +471,9 @@ class DataRefCPSE17(DataRefFile):
 
       for (fn,cps) in get_drefs():
          print('-------- Processing {}: {}.'.format(fn, cps))
+         if (opts.header):
+            print(cps.get_prt_header(palette=False))
+         
          if (opts.deobfuscate):
             data_out = cps.get_content_unobfuscated()
             f2 = get_of(fn, b'.u')
@@ -353,7 +493,10 @@ class DataRefCPSE17(DataRefFile):
          
          if (opts.png_out):
             f2 = get_of(fn, b'.png')
-            img.write_png(f2.write)
+            if (opts.imconvert):
+               img.write_png_imconvert(f2.write)
+            else:
+               img.write_png(f2.write)
 
 data_handler_reg(b'cps')(DataRefCPSE17.build_from_similar)
 _main = DataRefCPSE17._main
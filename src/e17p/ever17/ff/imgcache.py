@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+#Copyright 2010 Sebastian Hagen
+# This file is part of E17p.
+#
+# E17p is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# E17p is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Persistent cache of decoded CPS images.
+#
+# Every entry is a file holding a small header followed by the final (palette-mapped / alpha-merged) pixel rows of one
+# image, as returned by CPSImageE17.get_rgba(). Entries are named by a hash of the identity (device, inode, size and
+# mtime) of the file containing the CPS data, and the offset and size of the CPS data within it; hits are served from
+# read-only memory mappings of the entry files.
+# The cache is kept below a size budget by evicting the least recently used entries; the entry file mtimes serve as
+# usage timestamps.
+
+import hashlib
+import os
+import struct
+
+class CPSImageCache:
+   MAGIC = b'E17pIMC\x00'
+   VERSION = 1
+   
+   hdr_fmt = '<8sLLLBB2xLLLQ'
+   hdr_sz = struct.calcsize(hdr_fmt)
+   # Pixel data starts at this offset in each entry file.
+   DATA_OFF = 64
+   SUFFIX = '.img'
+   
+   def __init__(self, path, size_limit=256 << 20):
+      self.path = path
+      self.size_limit = size_limit
+      os.makedirs(path, exist_ok=True)
+      # Dict mapping entry filenames to (mtime, size) tuples; read lazily.
+      self._entries = None
+      self._size = 0
+   
+   def _get_fn(self, key):
+      return os.path.join(self.path, key + self.SUFFIX)
+   
+   @staticmethod
+   def get_key(dref):
+      """Return cache key for specified CPS dref, or None if its backing file can't be identified."""
+      try:
+         st = os.fstat(dref.f.fileno())
+      except (AttributeError, ValueError, OSError):
+         # io.UnsupportedOperation is a subclass of both ValueError and OSError.
+         return None
+      kd = struct.pack('<QQQQQQ', st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns, dref.off, dref.size)
+      return hashlib.sha1(kd).hexdigest()
+   
+   def _load_entries(self):
+      self._entries = {}
+      self._size = 0
+      for de in os.scandir(self.path):
+         if not (de.name.endswith(self.SUFFIX)):
+            continue
+         try:
+            st = de.stat()
+         except OSError:
+            continue
+         self._entries[de.name] = (st.st_mtime_ns, st.st_size)
+         self._size += st.st_size
+      self._evict()
+   
+   def _discard(self, name):
+      try:
+         os.unlink(os.path.join(self.path, name))
+      except OSError:
+         pass
+      (_, size) = self._entries.pop(name, (0, 0))
+      self._size -= size
+   
+   def _evict(self):
+      if (self._size <= self.size_limit):
+         return
+      for (name, (mtime, size)) in sorted(self._entries.items(), key=lambda e: e[1][0]):
+         self._discard(name)
+         if (self._size <= self.size_limit):
+            break
+   
+   def get(self, key, cls):
+      """Return cached image as instance of cls (CPSImageE17 or a subclass), or None on a cache miss."""
+      import mmap
+      fn = self._get_fn(key)
+      try:
+         f = open(fn, 'rb')
+      except OSError:
+         return None
+      
+      with f:
+         try:
+            m = memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+            (magic, version, width, height, color_depth, opp, ll, base_off, base_width, dlen) = \
+               struct.unpack(self.hdr_fmt, m[:self.hdr_sz])
+         except (ValueError, OSError, struct.error):
+            magic = None
+         
+         if ((magic != self.MAGIC) or (version != self.VERSION) or (len(m) != self.DATA_OFF + dlen)):
+            # Damaged or outdated; drop it.
+            if (self._entries is None):
+               self._load_entries()
+            self._discard(os.path.basename(fn))
+            return None
+      
+      # Mark entry as recently used.
+      try:
+         os.utime(fn)
+      except OSError:
+         pass
+      else:
+         if not (self._entries is None):
+            self._entries[os.path.basename(fn)] = (os.stat(fn).st_mtime_ns, len(m))
+      
+      return cls(width, height, color_depth, ll, opp, (base_off, base_width), m[self.DATA_OFF:], None, None)
+   
+   def put(self, key, img):
+      """Store final pixel data of image in cache; returns an equivalent image instance sharing that data."""
+      from ...base.ff.bmp import rgb_get_lengths
+      (width, height, color_depth, data) = img.get_rgba()
+      opp = color_depth//8
+      (ll, _) = rgb_get_lengths(opp, width, height)
+      (base_off, base_width) = img._base_l_off
+      rv = type(img)(width, height, color_depth, ll, opp, img._base_l_off, data, None, None)
+      
+      data = memoryview(data)
+      hdr = struct.pack(self.hdr_fmt, self.MAGIC, self.VERSION, width, height, color_depth, opp, ll, base_off, base_width,
+         len(data))
+      
+      if (self._entries is None):
+         self._load_entries()
+      fn = self._get_fn(key)
+      fn_tmp = '{}.{:d}.tmp'.format(fn, os.getpid())
+      try:
+         with open(fn_tmp, 'wb') as f:
+            f.write(hdr.ljust(self.DATA_OFF, b'\x00'))
+            f.write(data)
+         os.replace(fn_tmp, fn)
+         st = os.stat(fn)
+      except OSError:
+         # The cache is only an optimization; carry on without it.
+         try:
+            os.unlink(fn_tmp)
+         except OSError:
+            pass
+         return rv
+      
+      name = os.path.basename(fn)
+      (_, size_old) = self._entries.get(name, (0, 0))
+      self._entries[name] = (st.st_mtime_ns, st.st_size)
+      self._size += st.st_size - size_old
+      self._evict()
+      return rv
+   
+   def get_img(self, dref, build):
+      """Return image for dref from cache, or build it by calling build() and store the result."""
+      key = self.get_key(dref)
+      if (key is None):
+         return build()
+      
+      rv = self.get(key, dref.CPS_CLS)
+      if (rv is None):
+         rv = self.put(key, build())
+      return rv
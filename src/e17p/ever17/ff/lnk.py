@@ -19,7 +19,7 @@
 
 import struct
 from ...base.file_data import *
-from .rle import e17_rle_unpack
+from .rle import e17_rle_unpack, e17_rle_unpack_iter, e17_rle_pack
 
 # -------------------------------------------------------------------------------- parser DS
 class LNKChunk(DataRefFile):
@@ -35,19 +35,8 @@ class LNKChunk(DataRefFile):
    lnd_hdr_fmt = '<4sHHLL'
    lnd_hdr_sz = struct.calcsize(lnd_hdr_fmt)
    def _decompress_lnd_chunk(self):
-      from io import BytesIO
-      
-      self.f.seek(self.off)
-      data = bytearray(self.size)
-      self.f.readinto(data)
-      mdata = memoryview(data)
-      (preamble, uk1, uk2, size_plain, uk3) = struct.unpack(self.lnd_hdr_fmt, mdata[:self.lnd_hdr_sz])
-      if (preamble != b'lnd\x00'):
-         raise ValueError('Unexpected lnd preamble {!r}.'.format(preamble))
-      
-      bd_plain = e17_rle_unpack(mdata[self.lnd_hdr_sz:], size_plain)
-      bd_f = BytesIO(bd_plain)
-      return DataRefFile(bd_f, 0, len(bd_plain))
+      bd_plain = lnd_unpack(self.get_view())
+      return DataRefFile(BufferFile(bd_plain), 0, len(bd_plain))
    
    def get_dref_plain(self):
       if (self.is_compressed):
@@ -57,9 +46,76 @@ class LNKChunk(DataRefFile):
    def get_data_plain(self):
       return self.get_dref_plain().get_data()
    
+   def _get_lnd_hdr(self):
+      rv = struct.unpack(self.lnd_hdr_fmt, self.get_view(self.lnd_hdr_sz))
+      if (rv[0] != b'lnd\x00'):
+         raise ValueError('Unexpected lnd preamble {!r}.'.format(rv[0]))
+      return rv
+   
+   def get_size_plain(self):
+      """Return size of plain chunk data, without decompressing it."""
+      if not (self.is_compressed):
+         return self.size
+      return self._get_lnd_hdr()[3]
+   
+   def iter_data_plain(self, block_size=1 << 16):
+      """Yield plain chunk data in blocks of (at most) block_size bytes.
+      
+      Unlike get_dref_plain(), this decompresses incrementally and never holds the entire output in memory."""
+      if not (self.is_compressed):
+         for off in range(0, self.size, block_size):
+            yield self.get_view(min(block_size, self.size-off), off)
+         return
+      
+      (preamble, uk1, uk2, size_plain, uk3) = self._get_lnd_hdr()
+      
+      def get_pieces():
+         for off in range(self.lnd_hdr_sz, self.size, block_size):
+            yield self.get_view(min(block_size, self.size-off), off)
+      
+      for block in e17_rle_unpack_iter(get_pieces(), size_plain, block_size):
+         yield block
+   
+   def set_data_plain(self, data, compress=None, optimal=False):
+      """Replace chunk content with specified plain data.
+      
+      If compress is None, this chunk's compression state is kept. Header fields of existing lnd chunks are preserved."""
+      if (compress is None):
+         compress = self.is_compressed
+      if (compress):
+         if (self.is_compressed):
+            hdr = struct.unpack(self.lnd_hdr_fmt, self.get_view(self.lnd_hdr_sz))
+         else:
+            hdr = None
+         data = lnd_pack(data, hdr, optimal)
+      
+      self.f = BufferFile(data)
+      self.off = 0
+      self.size = len(data)
+      self.is_compressed = compress
+   
    def __repr__(self):
       return '{}{}'.format(type(self).__name__, (self.f, self.off, self.size, self.name, self.is_compressed))
-      
+
+
+def lnd_unpack(data):
+   """Decompress lnd chunk data, as stored in LNK archives."""
+   (preamble, uk1, uk2, size_plain, uk3) = struct.unpack(LNKChunk.lnd_hdr_fmt, data[:LNKChunk.lnd_hdr_sz])
+   if (preamble != b'lnd\x00'):
+      raise ValueError('Unexpected lnd preamble {!r}.'.format(preamble))
+   
+   return e17_rle_unpack(memoryview(data)[LNKChunk.lnd_hdr_sz:], size_plain)
+
+def lnd_pack(data, hdr=None, optimal=False):
+   """Compress data into lnd chunk format; hdr is an optional header tuple to copy unknown fields from."""
+   if (hdr is None):
+      (uk1, uk2, uk3) = (0, 0, 0)
+   else:
+      (_, uk1, uk2, _, uk3) = hdr
+   rv = bytearray(struct.pack(LNKChunk.lnd_hdr_fmt, b'lnd\x00', uk1, uk2, len(data), uk3))
+   rv += e17_rle_pack(data, optimal)
+   return rv
+
 
 class LNKParser:
    def __init__(self, chunks):
@@ -70,7 +126,11 @@ class LNKParser:
          yield(c)
    
    @classmethod
-   def build_from_file(cls, f):
+   def build_from_file(cls, f, use_mmap=False):
+      # With use_mmap, all chunks share a single read-only mapping of the file; their get_view() calls are zero-copy.
+      if (use_mmap):
+         f = BufferFile.map_file(f)
+      f.seek(0)
       # LNK files start with a static 4 byte preamble, followed by a 4 LE uint specifying the number of contained chunks,
       # followed by 8 bytes of unknown (and possibly always zero) data.
       preamble = f.read(4)
@@ -111,6 +171,19 @@ class LNKParser:
       
       return cls(chunks)
    
+   @staticmethod
+   def read_table(f):
+      """Read and return raw LNK header and chunk metadata table from beginning of file."""
+      f.seek(0)
+      hdr = f.read(16)
+      if (hdr[:4] != b'LNK\x00'):
+         raise ValueError('Unexpected preamble {0!r}.'.format(hdr[:4]))
+      (fc,) = struct.unpack(b'<L', hdr[4:8])
+      rv = hdr + f.read(fc*32)
+      if (len(rv) != 16 + fc*32):
+         raise ValueError('Truncated chunk table: got {:d}/{:d} bytes.'.format(len(rv), 16 + fc*32))
+      return rv
+   
    def write(self, f_out):
       from struct import pack
       f_out.write(b'LNK\x00')
@@ -124,18 +197,83 @@ class LNKParser:
       
       for chunk in self._chunks:
          f_out.write(chunk.get_data())
+   
+   def extract_parallel(self, get_ofn, decompress, jobs, read_sz=1<<24):
+      """Write chunks to files, decompressing them in a pool of worker processes.
+      
+      Chunk data is read in large sequential reads in order of chunk offset; output files are written in batches
+      as their reads are processed. Returns (chunk count, bytes read, bytes written) tuple."""
+      import collections
+      from concurrent.futures import ProcessPoolExecutor
+      
+      # Group chunks into runs of roughly read_sz bytes each.
+      chunks = sorted(self._chunks, key=lambda c: (id(c.f), c.off))
+      batches = []
+      batch = []
+      bsz = 0
+      for chunk in chunks:
+         if (batch and ((chunk.f is not batch[0].f) or (bsz + chunk.size > read_sz))):
+            batches.append(batch)
+            batch = []
+            bsz = 0
+         batch.append(chunk)
+         bsz += chunk.size
+      if (batch):
+         batches.append(batch)
+      
+      bytes_in = 0
+      bytes_out = 0
+      pending = collections.deque()
+      
+      def write_batch(rl):
+         nonlocal bytes_out
+         for (chunk, ofn, data) in rl:
+            if not (isinstance(data, memoryview)):
+               data = data.result()
+            print('--->>> {!r} ({} bytes)'.format(ofn, len(data)))
+            with open(ofn, 'wb') as of:
+               of.write(data)
+            bytes_out += len(data)
+      
+      with ProcessPoolExecutor(jobs) as ex:
+         for batch in batches:
+            b_off = batch[0].off
+            b_len = batch[-1].off + batch[-1].size - b_off
+            bdata = DataRefFile(batch[0].f, b_off, b_len).get_view()
+            bytes_in += b_len
+            
+            rl = []
+            for chunk in batch:
+               data = bdata[chunk.off-b_off:chunk.off-b_off+chunk.size]
+               if (decompress and chunk.is_compressed):
+                  data = ex.submit(lnd_unpack, data.tobytes())
+               rl.append((chunk, get_ofn(chunk), data))
+            pending.append(rl)
+            
+            # Keep the workers busy, but don't hold more than a few batches in memory.
+            while (len(pending) > jobs):
+               write_batch(pending.popleft())
+         
+         while (pending):
+            write_batch(pending.popleft())
       
+      return (len(chunks), bytes_in, bytes_out)
+
 
 def _main():
    import optparse
    import os
    import os.path
    import sys
+   import time
    
    op = optparse.OptionParser()
    op.add_option('-x', '--extract', action='store_true', default=False, help='Dump raw files from LNK archive.')
    op.add_option('-n', '--no-decompress', dest='decompress', action='store_false', default=True, help='Do not files from LNK arhive on extraction.')
    op.add_option('-o', '--outdir', action='store', help='Directory to write output to.')
+   op.add_option('-m', '--mmap', action='store_true', default=False, help='Access LNK archives through memory mappings.')
+   op.add_option('-j', '--jobs', type=int, default=None, help='Extract using specified number of worker processes.')
+   op.add_option('-s', '--stream', action='store_true', default=False, help='Decompress incrementally, with bounded memory use.')
    
    (opts,args) = op.parse_args()
    
@@ -145,7 +283,26 @@ def _main():
    
    for fn in args:
       f = open(fn, 'rb')
-      lp = LNKParser.build_from_file(f)
+      lp = LNKParser.build_from_file(f, use_mmap=opts.mmap)
+      if not (opts.jobs is None):
+         for chunk in lp:
+            print('-------- {0!r}: size: {1} compression: {2}'.format(chunk.name, chunk.get_size(), int(chunk.is_compressed)))
+         if not (opts.extract):
+            continue
+         
+         def get_ofn(chunk):
+            ofn = os.path.basename(chunk.name)
+            if not (outdir is None):
+               ofn = os.path.join(outdir, ofn)
+            return ofn
+         
+         ts = time.time()
+         (cc, bytes_in, bytes_out) = lp.extract_parallel(get_ofn, opts.decompress, opts.jobs)
+         td = max(time.time() - ts, 1E-6)
+         print('======== Extracted {} chunks in {:.2f}s: read {:.2f} MB ({:.2f} MB/s), wrote {:.2f} MB ({:.2f} MB/s).'.format(
+            cc, td, bytes_in/1E6, bytes_in/1E6/td, bytes_out/1E6, bytes_out/1E6/td))
+         continue
+      
       for chunk in lp:
          sfn = chunk.name
          print('-------- {0!r}: size: {1} compression: {2}'.format(sfn, chunk.get_size(), int(chunk.is_compressed)))
@@ -153,10 +310,20 @@ def _main():
             ofn = os.path.basename(sfn)
             if not (outdir is None):
                ofn = os.path.join(outdir, ofn)
+            if (opts.stream):
+               of = open(ofn, 'wb')
+               if (opts.decompress):
+                  l = sum(of.write(block) for block in chunk.iter_data_plain())
+               else:
+                  l = of.write(chunk.get_view())
+               of.close()
+               print('--->>> {!r} ({} bytes)'.format(ofn, l))
+               continue
+            
             if (opts.decompress):
                data = chunk.get_data_plain()
             else:
-               data = chunk.get_data()
+               data = chunk.get_view()
             
             print('--->>> {!r} ({} bytes)'.format(ofn, len(data)))
             of = open(ofn, 'wb')
@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+#Copyright 2010 Sebastian Hagen
+# This file is part of E17p.
+#
+# E17p is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# E17p is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Persistent chunk index for sets of LNK archives.
+#
+# The index stores the chunk table of every archive along with the type its chunks were identified as by the data
+# handler registry, and any header fields that type needs to rebuild its instances without touching the chunk data.
+# Per-archive entries are invalidated by archive size, mtime and a hash of the LNK chunk table.
+
+import hashlib
+import os
+import struct
+
+from .lnk import LNKChunk, LNKParser
+
+class LNKIndexError(ValueError):
+   pass
+
+class _LNKIndexArchive:
+   def __init__(self, size, mtime, table_hash, chunks):
+      self.size = size
+      self.mtime = mtime
+      self.table_hash = table_hash
+      # Sequence of (name, off, size, is_compressed, type name, type data) tuples
+      self.chunks = chunks
+   
+   def get_lnk(self, f):
+      return LNKParser([LNKChunk(f, off, size, name, is_compressed) for (name, off, size, is_compressed, tn, td)
+         in self.chunks])
+   
+   def get_types(self):
+      return dict((c[0], c[4:]) for c in self.chunks)
+
+
+class LNKIndex:
+   MAGIC = b'E17pLNKI'
+   VERSION = 1
+   
+   hdr_fmt = '<8sLL'
+   hdr_sz = struct.calcsize(hdr_fmt)
+   ahdr_fmt = '<HQQ20sL'
+   ahdr_sz = struct.calcsize(ahdr_fmt)
+   chdr_fmt = '<24sLLBBB'
+   chdr_sz = struct.calcsize(chdr_fmt)
+   
+   # Chunk flags
+   CF_COMPRESSED = 1
+   CF_HAVE_DATA = 2
+   
+   def __init__(self, archives=None):
+      if (archives is None):
+         archives = {}
+      self._archives = archives
+      self.dirty = False
+   
+   @classmethod
+   def build_from_file(cls, f):
+      data = memoryview(f.read())
+      (magic, version, ac) = struct.unpack(cls.hdr_fmt, data[:cls.hdr_sz])
+      if (magic != cls.MAGIC):
+         raise LNKIndexError('Unexpected preamble {!r}.'.format(magic))
+      if (version != cls.VERSION):
+         raise LNKIndexError('Unsupported index version {!r}.'.format(version))
+      
+      off = cls.hdr_sz
+      archives = {}
+      for i in range(ac):
+         (fnl, size, mtime, table_hash, cc) = struct.unpack(cls.ahdr_fmt, data[off:off+cls.ahdr_sz])
+         off += cls.ahdr_sz
+         fn = data[off:off+fnl].tobytes()
+         off += fnl
+         
+         chunks = []
+         for j in range(cc):
+            (name, coff, csize, flags, tnl, dl) = struct.unpack(cls.chdr_fmt, data[off:off+cls.chdr_sz])
+            off += cls.chdr_sz
+            tn = data[off:off+tnl].tobytes().decode('ascii')
+            off += tnl
+            if (flags & cls.CF_HAVE_DATA):
+               dfmt = '<{:d}q'.format(dl)
+               td = struct.unpack(dfmt, data[off:off+8*dl])
+               off += 8*dl
+            else:
+               td = None
+            chunks.append((name.rstrip(b'\x00'), coff, csize, bool(flags & cls.CF_COMPRESSED), tn, td))
+         archives[fn] = _LNKIndexArchive(size, mtime, table_hash, chunks)
+      
+      if (off != len(data)):
+         raise LNKIndexError('Trailing garbage: Parsed {:d}/{:d} bytes.'.format(off, len(data)))
+      return cls(archives)
+   
+   @classmethod
+   def build_from_fn(cls, fn):
+      """Read index from file; return an empty one if that file is missing, outdated or damaged."""
+      try:
+         f = open(fn, 'rb')
+      except EnvironmentError:
+         return cls()
+      
+      try:
+         with f:
+            return cls.build_from_file(f)
+      except (ValueError, struct.error):
+         rv = cls()
+         rv.dirty = True
+         return rv
+   
+   def write(self, f_out):
+      f_out.write(struct.pack(self.hdr_fmt, self.MAGIC, self.VERSION, len(self._archives)))
+      for (fn, a) in sorted(self._archives.items()):
+         f_out.write(struct.pack(self.ahdr_fmt, len(fn), a.size, a.mtime, a.table_hash, len(a.chunks)))
+         f_out.write(fn)
+         for (name, off, size, is_compressed, tn, td) in a.chunks:
+            flags = is_compressed*self.CF_COMPRESSED
+            if (td is None):
+               td = ()
+            else:
+               flags |= self.CF_HAVE_DATA
+            tn = tn.encode('ascii')
+            f_out.write(struct.pack(self.chdr_fmt, name, off, size, flags, len(tn), len(td)))
+            f_out.write(tn)
+            f_out.write(struct.pack('<{:d}q'.format(len(td)), *td))
+   
+   def write_fn(self, fn):
+      """Atomically replace specified file with a serialization of this index."""
+      fn_tmp = fn + b'.tmp'
+      with open(fn_tmp, 'wb') as f:
+         self.write(f)
+      os.replace(fn_tmp, fn)
+      self.dirty = False
+   
+   @staticmethod
+   def _get_file_state(f):
+      st = os.fstat(f.fileno())
+      table_hash = hashlib.sha1(LNKParser.read_table(f)).digest()
+      return (st.st_size, st.st_mtime_ns, table_hash)
+   
+   def get_archive(self, fn, f):
+      """Return index entry for specified archive if it is up to date, else None."""
+      try:
+         a = self._archives[fn]
+      except KeyError:
+         return None
+      
+      if ((a.size, a.mtime, a.table_hash) != self._get_file_state(f)):
+         return None
+      return a
+   
+   def get_types(self, fn):
+      """Return dict mapping chunk names to (type name, type data) tuples for archive, or None if we have no entry."""
+      try:
+         a = self._archives[fn]
+      except KeyError:
+         return None
+      return a.get_types()
+   
+   def set_archive(self, fn, f, chunks):
+      """Store index data for archive.
+      
+      chunks must be a sequence of (LNKChunk, wrapped dref) pairs."""
+      (size, mtime, table_hash) = self._get_file_state(f)
+      cl = []
+      for (chunk, dref) in chunks:
+         (tn, td) = self.get_chunk_type(chunk, dref)
+         cl.append((chunk.name, chunk.off, chunk.size, chunk.is_compressed, tn, td))
+      self._archives[fn] = _LNKIndexArchive(size, mtime, table_hash, cl)
+      self.dirty = True
+   
+   def prune(self, fns):
+      """Discard entries for all archives not in fns."""
+      for fn in set(self._archives) - set(fns):
+         del(self._archives[fn])
+         self.dirty = True
+   
+   @staticmethod
+   def get_chunk_type(chunk, dref):
+      if (dref is chunk):
+         return ('', None)
+      cls = type(dref)
+      try:
+         get_idx_data = dref.get_idx_data
+      except AttributeError:
+         td = None
+      else:
+         td = get_idx_data()
+      return ('{}:{}'.format(cls.__module__, cls.__qualname__), td)
+   
+   @staticmethod
+   def _get_cls(tn):
+      import importlib
+      (mn, qn) = tn.split(':')
+      if (mn.split('.')[0] != __name__.split('.')[0]):
+         raise LNKIndexError('Refusing to load foreign type {!r}.'.format(tn))
+      rv = importlib.import_module(mn)
+      for n in qn.split('.'):
+         rv = getattr(rv, n)
+      return rv
+   
+   def build_chunk(self, chunk, tn, td):
+      """Rebuild wrapped dref for chunk from stored type data.
+      
+      Returns None if this isn't possible without reading the chunk."""
+      if (tn == ''):
+         return chunk
+      if (td is None):
+         return None
+      try:
+         cls = self._get_cls(tn)
+      except (ImportError, AttributeError, LNKIndexError):
+         return None
+      return cls.build_from_idx_data(chunk, td)
@@ -23,87 +23,425 @@ from ...base.file_data import DataRefFile
 from ...base.aif import AIFuncs
 _aifs = AIFuncs()
 
+# Opcode limits, as implied by the format.
+RLE_WINDOW = 1 << 10
+RLE_LEN_LIT = 1 << 13
+RLE_LEN_FILL = (1 << 13) + 1
+RLE_LEN_REF = 17
+RLE_LEN_SEQ = 65
+RLE_COUNT_SEQ = 256
+
+class E17RLEDecoder:
+   """Incremental E17 RLE decoder.
+   
+   Compressed data can be passed to feed() in pieces of arbitrary size; decoded output is returned in blocks of
+   block_size bytes. Apart from incomplete ops at the end of the input passed so far, only the back-reference window and
+   the current output block are kept in memory.
+   
+   If limit is specified, decoding stops as soon as at least that many bytes of output have been produced; the limit can
+   be raised later on to continue decoding."""
+   def __init__(self, out_sz, block_size=1 << 16, limit=None):
+      if (block_size < 1):
+         raise ValueError('Invalid block size {!r}.'.format(block_size))
+      self.out_sz = out_sz
+      self.block_size = block_size
+      self.set_limit(limit)
+      # Undecoded input
+      self._din = bytearray()
+      # Back-reference window, followed by output of current block
+      self._dout = bytearray()
+      self._bs = 0
+      # Output bytes decoded so far
+      self.i_o = 0
+   
+   def set_limit(self, limit):
+      if (limit is None):
+         limit = self.out_sz
+      self.limit = min(limit, self.out_sz)
+   
+   def is_done(self):
+      return (self.i_o >= self.limit)
+   
+   def feed(self, din):
+      """Decode more input data, and return list of completed output blocks."""
+      self._din += din
+      self._decode()
+      return self._get_blocks(self.block_size)
+   
+   def finish(self):
+      """Return remaining output; raise ValueError if decoding is incomplete."""
+      if not (self.is_done()):
+         raise ValueError('RLE decompression failed: Input exhausted at {:d}/{:d} bytes of output.'.format(self.i_o,
+            self.limit))
+      return b''.join(self._get_blocks(1))
+   
+   def _get_blocks(self, bl_min):
+      dout = self._dout
+      bs = self._bs
+      bsz = self.block_size
+      rv = []
+      while (len(dout) - bs >= bl_min):
+         rv.append(bytes(dout[bs:bs+bsz]))
+         bs += min(bsz, len(dout) - bs)
+      
+      trim = max(bs - RLE_WINDOW, 0)
+      del(dout[:trim])
+      self._bs = bs - trim
+      return rv
+   
+   def _decode(self):
+      din = self._din
+      dout = self._dout
+      i_i = 0
+      i_lim = len(din)
+      o_left = self.out_sz - self.i_o
+      # Stop once the output limit is reached; the last op may extend beyond it.
+      o_stop = self.out_sz - self.limit
+      l0 = len(dout)
+      
+      while ((o_left > o_stop) and (i_i < i_lim)):
+         op = din[i_i]
+         if (op & 0x80):
+            if (op & 0x40):
+               # Byte fill
+               run_length = (op & 0x1F) + 2
+               if (op & 0x20):
+                  if (i_i + 3 > i_lim):
+                     break
+                  run_length += din[i_i+1] << 5
+                  i_i += 1
+               elif (i_i + 2 > i_lim):
+                  break
+               if (run_length > o_left):
+                  raise ValueError('RLE decompression failed: Fill overruns output space.')
+               dout += din[i_i+1:i_i+2] * run_length
+               i_i += 2
+            else:
+               # Back-reference into the window
+               if (i_i + 2 > i_lim):
+                  break
+               run_length = ((op >> 2) & 0xF) + 2
+               off = ((op & 3) << 8) + din[i_i+1] + 1
+               if ((off > self.i_o + len(dout) - l0) or (run_length > o_left)):
+                  raise ValueError('RLE decompression failed: Invalid back-reference.')
+               i_s = len(dout) - off
+               if (run_length <= off):
+                  dout += dout[i_s:i_s+run_length]
+               else:
+                  # Overlapping reference: this repeats the referenced data.
+                  dout += (dout[i_s:] * (run_length // off + 1))[:run_length]
+               i_i += 2
+         elif (op & 0x40):
+            # Repeated multi-byte sequence
+            seq_len = (op & 0x3F) + 2
+            if (i_i + 2 + seq_len > i_lim):
+               break
+            count = din[i_i+1] + 1
+            # Some N7 files use sequences that overrun the output space; cut those short.
+            run_length = min(seq_len*count, o_left)
+            dout += (din[i_i+2:i_i+2+seq_len] * count)[:run_length]
+            i_i += 2 + seq_len
+         else:
+            # Literal sequence
+            run_length = (op & 0x1F) + 1
+            i_d = i_i + 1
+            if (op & 0x20):
+               if (i_i + 2 > i_lim):
+                  break
+               run_length += din[i_i+1] << 5
+               i_d += 1
+            if (i_d + run_length > i_lim):
+               break
+            if (run_length > o_left):
+               raise ValueError('RLE decompression failed: Literal overruns output space.')
+            dout += din[i_d:i_d+run_length]
+            i_i = i_d + run_length
+         o_left -= run_length
+      
+      del(din[:i_i])
+      self.i_o = self.out_sz - o_left
+
+
 @_aifs.add
 def e17_rle_unpack(din, out_sz):
-   dout = bytearray(out_sz)
+   dec = E17RLEDecoder(out_sz)
+   # Decode in one go, without splitting output into blocks.
+   dec._din += din
+   dec._decode()
+   if not (dec.is_done()):
+      raise ValueError('RLE decompression failed: Input exhausted at {:d}/{:d} bytes of output.'.format(dec.i_o, out_sz))
+   return dec._dout
+
+def e17_rle_unpack_iter(din_iter, out_sz, block_size=1 << 16):
+   """Decode compressed data from iterable of input pieces, yielding output in blocks of block_size bytes."""
+   dec = E17RLEDecoder(out_sz, block_size)
+   for din in din_iter:
+      for block in dec.feed(din):
+         yield block
+      if (dec.is_done()):
+         break
+   
+   rv = dec.finish()
+   if (rv):
+      yield rv
+
+# ---------------------------------------------------------------- Compression
+# Op kinds, as used by the encoder.
+_OP_LIT = 0
+_OP_FILL = 1
+_OP_REF = 2
+_OP_SEQ = 3
+
+def _rle_emit_lit(out, data, i, n):
+   while (n > 0):
+      l = min(n, RLE_LEN_LIT)
+      if (l > 32):
+         out += bytes(((0x20 | ((l-1) & 0x1F)), (l-1) >> 5))
+      else:
+         out.append(l-1)
+      out += data[i:i+l]
+      i += l
+      n -= l
+
+def _rle_emit(out, data, i, kind, l, par):
+   if (kind == _OP_FILL):
+      if (l > 33):
+         out += bytes((0xE0 | ((l-2) & 0x1F), (l-2) >> 5, data[i]))
+      else:
+         out += bytes((0xC0 | (l-2), data[i]))
+   elif (kind == _OP_REF):
+      out += bytes((0x80 | ((l-2) << 2) | ((par-1) >> 8), (par-1) & 0xFF))
+   elif (kind == _OP_SEQ):
+      out += bytes((0x40 | (par-2), l//par-1))
+      out += data[i:i+par]
+   else:
+      raise ValueError('Invalid op kind {!r}.'.format(kind))
+
+def _rle_op_cost(kind, l, par):
+   if (kind == _OP_FILL):
+      return 2 + (l > 33)
+   if (kind == _OP_REF):
+      return 2
+   return 2 + par
+
+def _match_len(data, a, b, lim):
+   """Return length of common prefix of data[a:] and data[b:], up to lim bytes."""
+   l = 0
+   s = 16
+   while (l < lim):
+      s = min(s, lim-l)
+      if (data[a+l:a+l+s] != data[b+l:b+l+s]):
+         break
+      l += s
+      s *= 2
+   else:
+      return l
+   
+   while (data[a+l] == data[b+l]):
+      l += 1
+   return l
+
+class _RLEMatcher:
+   """Hash chain based search for back-references and repeated sequences."""
+   def __init__(self, data, depth):
+      self.data = data
+      self.depth = depth
+      self.head = {}
+      self.prev = [-1]*len(data)
+      self.i_ins = 0
+   
+   def insert_to(self, i):
+      """Insert all positions up to (excluding) i into hash chains."""
+      data = self.data
+      head = self.head
+      prev = self.prev
+      for j in range(self.i_ins, min(i, len(data)-2)):
+         key = data[j:j+3]
+         prev[j] = head.get(key, -1)
+         head[key] = j
+      self.i_ins = max(self.i_ins, i)
+   
+   def get_ops(self, i):
+      """Return list of (kind, length, parameter) tuples for ops that could encode data at i."""
+      data = self.data
+      n = len(data)
+      rv = []
+      
+      lim_ref = min(n-i, RLE_LEN_REF)
+      self.insert_to(i)
+      # Byte fill
+      if (i + 2 < n):
+         l = _match_len(data, i, i+1, min(n-i-1, RLE_LEN_FILL-1)) + 1
+         if (l > 2):
+            rv.append((_OP_FILL, l, 0))
+            if (l >= lim_ref):
+               # Nothing else is going to beat this.
+               return rv
+      
+      j = self.head.get(data[i:i+3], -1)
+      best_ref = (0, 0)
+      best_seq = (0, 0)
+      depth = self.depth
+      while ((j >= 0) and (i - j <= RLE_WINDOW) and depth):
+         d = i - j
+         depth -= 1
+         # Skip candidates that can't improve on what we have, based on the first byte that would need to match.
+         if (best_ref[0] < lim_ref):
+            t = best_ref[0]
+         else:
+            t = n
+         is_seq = (1 < d <= RLE_LEN_SEQ)
+         if (is_seq):
+            lim_seq = min(n-i, d*RLE_COUNT_SEQ)
+            t_seq = max(2*d, (best_seq[0]//d + 1)*d) - 1
+            if (t_seq < lim_seq):
+               t = min(t, t_seq)
+         if ((t >= n-i) or (data[j+t] != data[i+t])):
+            j = self.prev[j]
+            continue
+         
+         if (is_seq):
+            # Data at i is periodic for as long as it matches; try to cover it with a repeated sequence.
+            l = _match_len(data, j, i, lim_seq)
+            c = l // d
+            if ((c > 1) and (c*d > best_seq[0])):
+               best_seq = (c*d, d)
+         else:
+            l = _match_len(data, j, i, lim_ref)
+         
+         l = min(l, lim_ref)
+         if (l > best_ref[0]):
+            best_ref = (l, d)
+         j = self.prev[j]
       
-   def read_data(num=1):
-      nonlocal i_i
-      rv = din[i_i:i_i+num]
-      i_i += 1
+      if (best_ref[0] > 2):
+         rv.append((_OP_REF,) + best_ref)
+      if (best_seq[0]):
+         rv.append((_OP_SEQ,) + best_seq)
       return rv
+
+def _rle_pack_greedy(data, depth=8):
+   n = len(data)
+   m = _RLEMatcher(data, depth)
+   out = bytearray()
+   i = 0
+   i_lit = 0
+   while (i < n):
+      best = None
+      # Rank candidate ops by input bytes covered per output byte; splitting a literal run costs an extra header byte.
+      penalty = (i > i_lit)
+      best_r = 1
+      for (kind, l, par) in m.get_ops(i):
+         r = l/(_rle_op_cost(kind, l, par) + penalty)
+         if ((r > best_r) or ((r == best_r) and best and (l > best[1]))):
+            best = (kind, l, par)
+            best_r = r
+      
+      if (best is None):
+         i += 1
+         continue
       
-   def read_u8():
-      return ord(read_data()[0])
+      _rle_emit_lit(out, data, i_lit, i-i_lit)
+      (kind, l, par) = best
+      _rle_emit(out, data, i, kind, l, par)
+      i += l
+      i_lit = i
+   
+   _rle_emit_lit(out, data, i_lit, i-i_lit)
+   return out
+
+def _rle_pack_optimal(data, depth=64):
+   from array import array
+   n = len(data)
+   m = _RLEMatcher(data, depth)
+   inf = float('inf')
+   
+   # Shortest path search over two states per position: at an op boundary (cost_b) or within a literal run (cost_l).
+   cost_b = [inf]*(n+1)
+   cost_l = [inf]*(n+1)
+   cost_b[0] = 0
+   # Back-pointers for op boundaries: op kind, length, parameter, and whether the op follows a literal run.
+   bp_kind = bytearray(n+1)
+   bp_len = array('L', (0,))*(n+1)
+   bp_par = array('H', (0,))*(n+1)
+   bp_from_l = bytearray(n+1)
+   # Back-pointers for literals: whether this literal byte continues a run.
+   lp_cont = bytearray(n+1)
+   
+   for i in range(n):
+      cb = cost_b[i]
+      cl = cost_l[i]
+      if (cl < cb):
+         c0 = cl
+         from_l = 1
+      else:
+         c0 = cb
+         from_l = 0
       
-   def copy_bytes(n):
-      nonlocal i_i, i_o
-      dout[i_o:i_o+n] = din[i_i:i_i+n]
-      i_i += n
-      i_o += n
+      # Literal byte; a new run costs an extra header byte.
+      if (cl + 1 < cb + 2):
+         cost_l[i+1] = cl + 1
+         lp_cont[i+1] = 1
+      else:
+         cost_l[i+1] = cb + 2
       
-   i_i = 0
-   i_o = 0
-   while (i_o < out_sz):
-      rt = read_u8()
-      #print(rt, len(din)-i_i, out_sz-i_o)
-      if (rt & 0x80):
-         if (rt & 0x40):
-            # RLE encoded byte sequence
-            run_length = (rt & 0x1F) + 2
-            if (rt & 0x20):
-               run_length += read_u8() << 5
-            run_length = max(run_length,1)   
-            data_byte = read_data()
-               
-            output_left = out_sz - i_o + 1
-            if (output_left < run_length):
-               run_length = output_left
-               
-            dout[i_o:i_o+run_length] = bytes(data_byte) * run_length
-            i_o += run_length
-            
+      for (kind, l, par) in m.get_ops(i):
+         if (kind == _OP_REF):
+            # Any shorter back-reference to the same place works, too.
+            ls = range(3, l+1)
+         elif (kind == _OP_FILL):
+            ls = (l, min(l, 33))
          else:
-            # Reference to an earlier version of the same byte sequence
-            rl_raw = (rt >> 2) & 0xF
-               
-            run_length = max(rl_raw + 2,1)
-            out_off = ((rt & 3) << 8) + read_u8() + 1
-            i_oi = i_o - out_off
-            for i in range(run_length):
-               dout[i_o+i] = dout[i_oi+i]
-            i_o += run_length
+            ls = (l,)
+         
+         for l in ls:
+            c = c0 + _rle_op_cost(kind, l, par)
+            if (c < cost_b[i+l]):
+               cost_b[i+l] = c
+               bp_kind[i+l] = kind
+               bp_len[i+l] = l
+               bp_par[i+l] = par
+               bp_from_l[i+l] = from_l
+   
+   # Walk back along the chosen path.
+   ops = []
+   i = n
+   in_lit = (cost_l[n] < cost_b[n])
+   lit_end = None
+   while (i > 0):
+      if (in_lit):
+         if (lit_end is None):
+            lit_end = i
+         in_lit = lp_cont[i]
+         i -= 1
+         if not (in_lit):
+            ops.append((_OP_LIT, i, lit_end-i, 0))
+            lit_end = None
+         continue
+      
+      l = bp_len[i]
+      in_lit = bp_from_l[i]
+      i -= l
+      ops.append((bp_kind[i+l], i, l, bp_par[i+l]))
+   
+   out = bytearray()
+   for (kind, i, l, par) in reversed(ops):
+      if (kind == _OP_LIT):
+         _rle_emit_lit(out, data, i, l)
       else:
-         if (rt & 0x40):
-            # Repeated byte sequence
-            iter_count = read_u8()+1
-            run_length = (rt & 0x3F) + 2
-            run_length = max(run_length,1)
-               
-            if (iter_count):
-               for _ in range(iter_count):
-                  output_left = out_sz - i_o + 1
-                  if (output_left < run_length):
-                     run_length = output_left
-                     
-                  dout[i_o:i_o+run_length] = din[i_i:i_i+run_length]
-                  i_o += run_length
-            else:
-               raise
-            i_i += run_length
-               
-         else:
-            # Literal multi-byte sequence
-            run_length = (rt & 0x1F) + 1
-            if (rt & 0x20):
-               run_length += read_u8() << 5
-            run_length = max(run_length,1)
-
-            output_left = out_sz - i_o + 1
-            if (output_left < run_length):
-               run_length = output_left
-            copy_bytes(run_length)
-   return dout
+         _rle_emit(out, data, i, kind, l, par)
+   return out
+
+@_aifs.add
+def e17_rle_pack(din, optimal=False):
+   """Compress data into E17 RLE format, as understood by e17_rle_unpack().
+   
+   By default this uses a fast greedy parse; optimal=True selects a (much slower) optimal parse, which produces somewhat
+   smaller output."""
+   data = bytes(din)
+   if (optimal):
+      return _rle_pack_optimal(data)
+   return _rle_pack_greedy(data)
 
 if (__name__ == '__main__'):
    _main()
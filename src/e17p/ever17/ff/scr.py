@@ -23,7 +23,7 @@ import optparse
 import re
 import struct
 
-from collections import deque
+from collections import deque, OrderedDict
 from ...base.file_data import *
 from ...base.text_fmt import *
 from ...base.text_markup import *
@@ -236,15 +236,33 @@ class _E17Label:
 #
 # The following classes are a best-effort attempt to parse this mess.
 
+def _const_func(val):
+   return lambda engine: val
+
 class E17ActiveValue:
+   __slots__ = ()
    def is_memop(self):
       return False
 
    def process(self, *args, **kwargs):
       """Dummy implementation: raise a useful error message."""
       raise ValueError("{} is missing process() implementation.".format(self))
+   
+   def _compile(self):
+      """Return (True, value) if our value is constant, and (False, func) otherwise; func(engine) computes our value.
+      
+      This default implementation just defers to process()."""
+      return (False, self.process)
+   
+   def compile(self):
+      """Return function computing our value for a given engine, with the same results as process()."""
+      (is_const, rv) = self._compile()
+      if (is_const):
+         return _const_func(rv)
+      return rv
 
 class E17AVInteger(E17ActiveValue):
+   __slots__ = ('val',)
    op_type = None
    precedence = None
    def __init__(self, val):
@@ -260,16 +278,22 @@ class E17AVInteger(E17ActiveValue):
       """Returns our static value."""
       return self.val
    
+   def _compile(self):
+      return (True, self.val)
+   
    def __repr__(self):
       return '{1}'.format(type(self).__name__, self.val)
 
 class E17AVOperator(E17ActiveValue):
+   __slots__ = ('op_type', 'precedence', 'val', 'data')
    import operator
    def _d1(func):
       def rv(_, *args, **kwargs):
          return func(*args, **kwargs)
       
       rv.__name__ == '_{}__d1'.format(func.__name__)
+      # Engine-independent; allows constant folding on compilation.
+      rv.func = func
       return rv
    
    def _get_gstate(engine, i):
@@ -337,6 +361,47 @@ class E17AVOperator(E17ActiveValue):
       op = self.op_map[self.op_type][0]
       return op(engine, *data)
    
+   def _compile(self):
+      data = self.data
+      try:
+         op = self.op_map[self.op_type][0]
+      except KeyError:
+         return (False, self.process)
+      if ((data is None) or not all(isinstance(e, E17ActiveValue) for e in data)):
+         # Missing data; leave it to process() to fail in the usual way.
+         return (False, self.process)
+      
+      args = [e._compile() for e in data]
+      func = getattr(op, 'func', None)
+      if (func is None):
+         if ((self.op_type == 0x28) and (len(args) == 1)):
+            # Memory reads
+            (is_const, addr) = args[0]
+            if (is_const):
+               return (False, lambda engine: engine.get_memory(addr))
+            return (False, lambda engine: engine.get_memory(addr(engine)))
+         
+         funcs = tuple((_const_func(v) if is_const else v) for (is_const, v) in args)
+         return (False, lambda engine: op(engine, *[f(engine) for f in funcs]))
+      
+      if (all(is_const for (is_const, _) in args)):
+         try:
+            return (True, func(*[v for (_, v) in args]))
+         except Exception:
+            # Don't fail on compilation; this is process()'s job.
+            return (False, self.process)
+      
+      if (len(args) == 2):
+         ((ac, a), (bc, b)) = args
+         if (ac):
+            return (False, lambda engine: func(a, b(engine)))
+         if (bc):
+            return (False, lambda engine: func(a(engine), b))
+         return (False, lambda engine: func(a(engine), b(engine)))
+      
+      funcs = tuple((_const_func(v) if is_const else v) for (is_const, v) in args)
+      return (False, lambda engine: func(*[f(engine) for f in funcs]))
+   
    @classmethod
    def build(cls, op_type, *args, **kwargs):
       is_memop = (20 <= op_type <= 33)
@@ -398,6 +463,7 @@ class E17AVOperator(E17ActiveValue):
 
 
 class E17AVMemop(E17AVOperator):
+   __slots__ = ('mo_type', 'mo_addr', 'mo_val')
    import operator
    op_map = {
       # Class 2: Memory manipulations
@@ -435,6 +501,42 @@ class E17AVMemop(E17AVOperator):
       mset(engine, addr, rv)
       
       return None
+   
+   def _compile(self):
+      mo_addr = getattr(self, 'mo_addr', None)
+      mo_val = getattr(self, 'mo_val', None)
+      try:
+         (mget, mset, _) = self.op2_map[self.mo_type]
+         (op,_) = self.op_map[self.op_type]
+      except (AttributeError, KeyError):
+         return (False, self.process)
+      if ((mget is None) or (mset is None) or not (isinstance(mo_addr, E17ActiveValue) and
+            isinstance(mo_val, E17ActiveValue))):
+         return (False, self.process)
+      
+      (ac, addr) = mo_addr._compile()
+      (vc, val) = mo_val._compile()
+      if (self.mo_type == 0x28):
+         # Plain memory access; call the engine's methods directly.
+         if (ac and vc):
+            def rv(engine):
+               engine.set_memory(addr, op(engine.get_memory(addr), val))
+         elif (ac):
+            def rv(engine):
+               engine.set_memory(addr, op(engine.get_memory(addr), val(engine)))
+         else:
+            val = _const_func(val) if vc else val
+            def rv(engine):
+               a = addr(engine)
+               engine.set_memory(a, op(engine.get_memory(a), val(engine)))
+         return (False, rv)
+      
+      addr = _const_func(addr) if ac else addr
+      val = _const_func(val) if vc else val
+      def rv(engine):
+         a = addr(engine)
+         mset(engine, a, op(mget(engine, a), val(engine)))
+      return (False, rv)
 
    def is_memop(self):
       return True
@@ -481,14 +583,26 @@ class E17AVMemop(E17AVOperator):
       return (0,0)
 
 class MissingData:
+   __slots__ = ()
    def __repr__(self):
       return 'MissingData'
 
 
 class E17ActiveValueSequence(list):
+   # _fn is our compiled evaluation function, built on first use.
+   __slots__ = ('_vals', '_fn')
    def __init__(self, *args, **kwargs):
       super().__init__(*args, **kwargs)
       self._vals = None
+      self._fn = None
+   
+   def __getstate__(self):
+      return {'_vals': self._vals}
+   
+   def __setstate__(self, state):
+      self._fn = None
+      for (name, val) in state.items():
+         setattr(self, name, val)
    
    @classmethod
    def build_from_ints(cls, ints):
@@ -586,12 +700,28 @@ class E17ActiveValueSequence(list):
             raise ValueError('{} was asked for {} values, but has {}.'.format(self, count, len(self._vals)))
       
       try:
-         rv = [v.process(engine) for v in self._vals]
+         fn = self._fn
+         if (fn is None):
+            fn = self._fn = self._compile()
+         rv = fn(engine)
       except Exception as exc:
          raise ValueError('{} failed to extract values.'.format(self)) from exc
       
       return rv
    
+   def _compile(self):
+      """Compile our values into one function returning a list of them for a given engine."""
+      vals = [v._compile() for v in self._vals]
+      if (all(is_const for (is_const, _) in vals)):
+         vals = [v for (_, v) in vals]
+         return lambda engine: list(vals)
+      
+      funcs = tuple((_const_func(v) if is_const else v) for (is_const, v) in vals)
+      if (len(funcs) == 1):
+         (func,) = funcs
+         return lambda engine: [func(engine)]
+      return lambda engine: [f(engine) for f in funcs]
+   
    def _find_memop(self, imax=None):
       if (imax is None):
          imax = len(self)
@@ -807,6 +937,7 @@ class E17Token(BaseToken):
       return cls(f)
 
 class E17NonTokenData(E17Token):
+   __slots__ = ('dref',)
    def __init__(self, dref):
       self.dref = dref
    
@@ -854,6 +985,8 @@ class E17TokenE00_00(E17TokenE00Nodata): # Extremely dubious.
 @_e17_reg_tt_00
 class E17TokenE00_01(E17TokenE00Nodata):
    type = 0x01
+   # Our base class hides the data slot behind a class attribute.
+   __slots__ = ('data',)
    def __init__(self, f):
       self.data = (f.read_av(), f.read_av(), f.read_esr())
    
@@ -922,6 +1055,7 @@ class E17TokenE00_06(E17TokenE00Nodata):
 class E17TokenE00_07(E17TokenE00):
    """00-07: Unconditional intra-file jump."""
    type = 0x07
+   __slots__ = ('jmp_target',)
    def __init__(self, f):
       self.jmp_target = f.read_esr()
       f.set_end()
@@ -942,6 +1076,7 @@ class E17TokenE00_07(E17TokenE00):
 class E17TokenE00_08(E17TokenE00):
    """00-08: Target-selecting jump? (system/startup only)"""
    type = 0x08
+   __slots__ = ('v1', 'val_ref')
    def __init__(self, f):
       self.v1 = f.read_av()
       self.val_ref = f.read_esr(True)
@@ -961,6 +1096,7 @@ class E17TokenE00_08(E17TokenE00):
 class E17TokenE00_0b(E17TokenE00):
    """00-0b: Intra-file jump that saves current position for return. System/startup only."""
    type = 0x0b
+   __slots__ = ('jmp_target',)
    def __init__(self, f):
       self.jmp_target = f.read_esr()
 
@@ -987,6 +1123,7 @@ class E17TokenE00_0D(E17TokenE00):
 class E17TokenE00_0aConditionalJump(E17TokenE00):
    """00-0a: Conditional jumps based on multi-type memory tests."""
    type = 0x0a
+   __slots__ = ('inverse', 'test_av', 'jmp_target')
    def __init__(self, f):
       # Always preceded by an \x00. Could be part of the sequence?
       self.inverse = not f.read_u8()
@@ -1073,6 +1210,7 @@ class E17TokenE00_13(E17TokenE00):
 class E17TokenE00_15_Jump(E17TokenE00):
    """00-15: Jumps of unknown conditionality."""
    type = 0x15
+   __slots__ = ('d1', 'v1', 'd2', 'jmp_target')
    def __init__(self, f):      
       self.d1 = f.read_u8()
       self.v1 = f.read_av()
@@ -1130,6 +1268,7 @@ class E17TokenE00_26(E17TokenE00):
    """00-26: Load value from specified memory address, and place in register?"""
    # If so, 1203 is apparently the conv-choice result register, and 1223 is used for ending selection ...
    type = 0x26
+   __slots__ = ('av',)
    def __init__(self, f):
       # Very dubious.
       self.av = f.read_av()
@@ -1148,6 +1287,7 @@ class E17TokenE00_26(E17TokenE00):
 class E17TokenE00_27(E17TokenE00):
    """00-27: Conditional intra-file jump based on register content equality test?"""
    type = 0x27
+   __slots__ = ('reg_val', 'jmp_target')
    def __init__(self, f):
       self.reg_val = f.read_av()
       self.jmp_target = f.read_esr()
@@ -1292,6 +1432,7 @@ class E17TokenE10_00(E17TokenE10Nodata):
 class E17Token_E10_01_Jump(E17TokenE10):
    """10-01: Inter-file jump."""
    type = 0x01
+   __slots__ = ('jmp_fn',)
    def __init__(self, f):
       self.jmp_fn = f.read_bytes_fixedterm(b'\x00')
       f.set_end()
@@ -1339,6 +1480,7 @@ class E17TokenE10_04_BGM_stop(E17TokenE10):
 class E17TokenE10_05_SoundEffect(E17TokenE10):
    """10-05: Sound Effects."""
    type = 0x05
+   __slots__ = ('fn', 'val')
    def __init__(self, f):
       self.fn = f.read_string_fixedterm(b'\x00')
       self.val = (f.read_av(),f.read_av())
@@ -1385,6 +1527,7 @@ class E17TokenE10_08(E17TokenE10):
 class E17TokenE10_0c_BackgroundImage(E17TokenE10):
    """10-0c: Background image display."""
    type = 0x0c
+   __slots__ = ('fnr',)
    def __init__(self, f):
       self.fnr = f.read_fnr()
       self.data = (f.read_av(),f.read_av())
@@ -1403,6 +1546,7 @@ class E17TokenE10_0c_BackgroundImage(E17TokenE10):
 class E17TokenE10_0d(E17TokenE10):
    """10-0d: Background fade to color"""
    type = 0x0d
+   __slots__ = ('color', 'aux')
    def __init__(self, f):
       # color table:
       # 0: Black
@@ -1459,6 +1603,7 @@ class E17CharImageSpec:
 class E17TokenE10_0f_CharArt(E17TokenE10):
    """10-0f: Single character art display."""
    type = 0x0f
+   __slots__ = ('img', 'v1')
    def __init__(self, f):
       img_slot = f.read_av()
       self.img = E17CharImageSpec(f.read_fnr(), img_slot, f.read_av())
@@ -1477,6 +1622,7 @@ class E17TokenE10_0f_CharArt(E17TokenE10):
 class E17TokenE10_10(E17TokenE10):
    """10-10: Charart clear?"""
    type = 0x10
+   __slots__ = ('img_slot', 'v1')
    def __init__(self, f):
       self.img_slot = f.read_av()
       self.v1 = f.read_av()
@@ -1497,6 +1643,7 @@ class E17TokenE10_10(E17TokenE10):
 class E17TokenE10_12_CharArt(E17TokenE10):
    """10-12: Double charart display"""
    type = 0x12
+   __slots__ = ('imgs', 'v1')
    def __init__(self, f):
       slot_1 = f.read_av()
       slot_2 = f.read_av()
@@ -1552,6 +1699,7 @@ class E17TokenE10_15(E17TokenE10):
 class E17TokenE10_16_CharArt(E17TokenE10):
    """10-16: Triple charart display"""
    type = 0x16
+   __slots__ = ('imgs', 'v1')
    def __init__(self, f):
       fnr_1 = f.read_fnr()
       fnr_2 = f.read_fnr()
@@ -1615,6 +1763,7 @@ class E17TokenE10_19(E17TokenE10):
 class E17TokenE10_1a(E17TokenE10):
    """10-1a: Choice result store."""
    type = 0x1a
+   __slots__ = ('addr', 'cidx')
    def __init__(self, f):
       self.addr = f.read_av()
       self.cidx = f.read_av()
@@ -1646,6 +1795,7 @@ class E17TokenE10_1b(E17TokenE10):
 class E17TokenE10_(E17TokenE10):
    """10-1d: Background image display."""
    type = 0x1d
+   __slots__ = ('fnr',)
    def __init__(self, f):
       self.fnr = f.read_fnr()
 
@@ -1662,6 +1812,7 @@ class E17TokenE10_(E17TokenE10):
 class E17TokenE10_1e(E17TokenE10):
    """10-1e: Delay."""
    type = 0x1e
+   __slots__ = ('td',)
    def __init__(self, f):
       self.td = f.read_av()
    
@@ -1675,6 +1826,7 @@ class E17TokenE10_1e(E17TokenE10):
 class E17TokenE10_1f(E17TokenE10):
    """10-1f: Time display"""
    type = 0x1f
+   __slots__ = ('hval', 'mval')
    def __init__(self, f):
       self.hval = f.read_av()
       self.mval = f.read_av()
@@ -1691,6 +1843,7 @@ class E17TokenE10_1f(E17TokenE10):
 class E17TokenE10_20(E17TokenE10):
    """10-20: Visual effect"""
    type = 0x20
+   __slots__ = ('etype',)
    op_map = {
        4:((), 'shortstrongshake'),
        5:((), 'shortshake'),
@@ -1730,6 +1883,7 @@ class E17TokenE10_20(E17TokenE10):
 class E17TokenE10_21(E17TokenE10):
    """10-21: Visual effect stop"""
    type = 0x21
+   __slots__ = ('val',)
    def __init__(self, f):
       self.val = f.read_av()
 
@@ -1769,6 +1923,7 @@ class E17TokenE10_26(E17TokenE10):
 class E17TokenE10_27_Background(E17TokenE10):
    """10-27: Background image display."""
    type = 0x27
+   __slots__ = ('fnr',)
    def __init__(self, f):
       self.fnr = f.read_fnr()
       self.data = (f.read_av(), f.read_av())
@@ -1814,6 +1969,7 @@ class E17TokenE10_2e(E17TokenE10):
 class E17TokenE10_37_WallpaperUnlock(E17TokenE10):
    """10-37: Wallpaper unlock."""
    type = 0x37
+   __slots__ = ('fn',)
    def __init__(self, f):
       self.fn = f.read_fnr()
 
@@ -1833,6 +1989,7 @@ class E17TokenE10_38(E17TokenE10Nodata):
 class E17TokenE10_39_Movie(E17TokenE10):
    """10-39: Movie specification"""
    type = 0x39
+   __slots__ = ('fn',)
    def __init__(self, f):
       self.fn = f.read_string_fixedterm(b'\x00').encode('ascii')
    
@@ -1870,6 +2027,7 @@ class E17TokenE10_3f(E17TokenE10):
 class E17TokenE10_40_Background(E17TokenE10):
    """10-40: Background image (partial) display."""
    type = 0x40
+   __slots__ = ('fnr', 'x0', 'y0', 'w', 'h')
    def __init__(self, f):
       self.fnr = f.read_fnr()
       self.data = (f.read_av(),f.read_av())
@@ -1898,6 +2056,7 @@ class E17TokenE10_40_Background(E17TokenE10):
 class E17TokenE10_41(E17TokenE10):
    """Background image pan/zoom."""
    type = 0x41
+   __slots__ = ('x0', 'y0', 'w', 'h', 'delay')
    def __init__(self, f):
       # (0,0) is the upper left corner; (800,600) is lower right.
       self.x0 = f.read_av()
@@ -1944,6 +2103,7 @@ class E17TokenE10_45(E17TokenE10):
 class E17TokenE10_46(E17TokenE10):
    """10-46: Perspective setter"""
    type = 0x46
+   __slots__ = ('p',)
    def __init__(self, f):
       # Perspective values:
       #  0: other   (grey)
@@ -1993,6 +2153,7 @@ class E17TokenE80_18(E17TokenE80):
 class E17TokenEfe(E17TokenE):
    """fe: A single ActiveValue memory operation"""
    type = 0xfe
+   __slots__ = ('av',)
    
    def __init__(self, f):
       self.av = f.read_av()   
@@ -2010,6 +2171,7 @@ class E17TokenEfe(E17TokenE):
 class E17TokenEff_Convref(E17TokenE):
    """ff: Load conversation script block."""
    type = 0xff
+   __slots__ = ('conv_ref',)
    def __init__(self, f):
       self.conv_ref = f.read_convr()
 
@@ -2097,6 +2259,7 @@ class E17TokenC05(E17TokenCNodata):
 class E17TokenC0b(E17TokenConvLike):
    """Choice list entry."""
    type = 0x0b
+   __slots__ = ('text', 'cid', 'av_display')
    def __init__(self, f):
       # Choice list entry designations appear once at the beginning of a choice sequence (with a two-byte parameter?), and
       # once again before each choice.
@@ -2203,6 +2366,7 @@ class E17TokenC0e(E17TokenCNodata):
       return TFC_BLUE
 
 class E17TokenCSynthTextblock(E17TokenConvLike):
+   __slots__ = ('text', 'voice_ref')
    def __init__(self, text, voice_ref):
       self.text = text
       self.voice_ref = voice_ref
@@ -2252,6 +2416,7 @@ class E17TokenC11(E17TokenConvLike):
       return (self.data,)
 
 class E17TokenCString(E17TokenConvLike):
+   __slots__ = ('val',)
    def __init__(self, v):
       self.val = v
    
@@ -2283,6 +2448,15 @@ class E17TokenCString(E17TokenConvLike):
 class E17ScriptDataRef(TokenizerDataRefLE):
    EL_EOLIST = _E17Label('EOLIST')
    TTYPE_STR = E17TokenCString
+   # Matches runs of bytes accepted by char_is_text(); subclasses overriding one need to override the other, too.
+   _re_text_run = re.compile(b'[\\t\\n\\x20-\\xff]*')
+   # The encoding of strings isn't pure shift-jis, but some extended variant. The EN version only uses three of the
+   # nonstandard codepoints, which follow a \x87 byte; we hardcode them here.
+   _sjis_ext = {
+      b'J': '\xf6',     # German umlaut oe.
+      b'K': '\xfc',     # ?German umlaut ue? TODO: Verify whether this is correct.
+      b'L': '\u2015',   # Wide dash.
+   }
    def __init__(self, *args, parser, chunk_blacklist, chunk_idx, **kwargs):
       super().__init__(*args, **kwargs)
       self._parser = parser
@@ -2346,34 +2520,73 @@ class E17ScriptDataRef(TokenizerDataRefLE):
          rv.extend(b)
       return bytes(rv)
    
+   def _find_text_run(self):
+      """Return (start, end) buffer offsets of text run at current offset, if its terminator is within the readable part of
+         the buffered data; otherwise, return None."""
+      buf = self._buf
+      if (buf is None):
+         return None
+      start = self._off - self._buf_off
+      # The byte at the domain wall is the last one read() allows us to access.
+      lim = min(self._off_lim + 1 - self._buf_off, len(buf))
+      if (start >= lim):
+         return None
+      end = self._re_text_run.match(buf, start, lim).end()
+      if (end >= lim):
+         return None
+      return (start, end)
+   
+   def _read_string_run(self, start, end):
+      """Decode text run between specified buffer offsets, and skip past it and its terminator. Returns None without
+         consuming any data if the slow path is needed to handle the data."""
+      run = self._buf[start:end].tobytes()
+      s_l = []
+      i = 0
+      while (True):
+         j = run.find(b'\x87', i)
+         if (j < 0):
+            s_l.append(run[i:])
+            break
+         c = self._sjis_ext.get(run[j+1:j+2])
+         if (c is None):
+            return None
+         s_l.append(run[i:j])
+         s_l.append(c)
+         i = j + 2
+      
+      try:
+         rv = ''.join((s if isinstance(s, str) else s.decode('shift-jis')) for s in s_l)
+      except UnicodeDecodeError:
+         return None
+      
+      b = self._buf[end:end+1].tobytes()
+      self._off = self._buf_off + end + 1
+      return (rv, b)
+   
    def read_string(self):
+      # Fast path: Scan buffered data for the end of the text run, and decode it in one go.
+      run = self._find_text_run()
+      if not (run is None):
+         rv = self._read_string_run(*run)
+         if not (rv is None):
+            return rv
+      
       s_l = [bytearray()]
       b = None
-      # TODO: Optimization?
       off_0 = self._off
       while (True):
          b = self.read(1)
          if (not self.char_is_text(b)):
             break
          if (b == b'\x87'):
-            # The encoding here isn't pure shift-jis, but some extended variant. The EN version only uses three of the
-            # nonstandard codepoints; we hardcode them here.
             b_n = self.read(1)
             if (not self.char_is_text(b_n)):
                self.seek_back(2)
                raise ValueError('Bogus shift-jis escape sequence: Follow value is non-text char {!r}.'.format(b_n))
-            if (b_n == b'J'):
-               # German umlaut oe.
-               c = '\xf6'
-            elif (b_n == b'K'):
-               # ?German umlaut ue?
-               # TODO: Verify whether this is correct.
-               c = '\xfc'
-            elif (b_n == b'L'):
-               # Wide dash.
-               c = '\u2015'
-            else:
-               raise ValueError('Unknown extended shift-jis sequence \\x87\\x{0:x}'.format(ord(b_n)))
+            try:
+               c = self._sjis_ext[b_n]
+            except KeyError:
+               raise ValueError('Unknown extended shift-jis sequence \\x87\\x{0:x}'.format(ord(b_n))) from None
             
             s_l.append(c)
             s_l.append(bytearray())
@@ -2495,12 +2708,21 @@ class E17ScriptParser:
    UINT_LEN = struct.calcsize(UINT_FMT.format(1))
    CST = E17ConvScriptTokenizer
    EST = E17ScriptTokenizer
+   # Maximum number of chunk token lists kept by get_es_tokens() / get_cs_tokens().
+   TOKEN_CACHE_SIZE = 64
+   # Persistent token cache (scrcache.ScriptTokenCache instance) used by get_es_tokens() / get_cs_tokens(), if any.
+   tok_store = None
+   # Version of our tokenization output, as far as persistent token caches are concerned. Bump this whenever tokenization
+   # results change.
+   TOKEN_VERSION = 2
    
    def __init__(self, f, base_off, off_lim=None, fn=None):
       self._f = f
       self._fn = fn
       self._base_off = base_off
       self._off = None
+      # Chunk -> token list, in LRU order.
+      self._tok_cache = OrderedDict()
       if (off_lim is None):
          self._f.seek(0,2)
          off_lim = self._f.tell()
@@ -2640,6 +2862,42 @@ class E17ScriptParser:
    def get_fn(self, idx):
       """Return filename"""
       return self._data_fn[idx]
+   def get_counts(self):
+      """Return (event script, conversation script, filename) chunk counts"""
+      return (len(self._data_es), len(self._data_cbc), len(self._data_fn))
+   
+   def _get_chunk_tokens(self, kind, chunk):
+      cache = self._tok_cache
+      try:
+         rv = cache[chunk]
+      except KeyError:
+         pass
+      else:
+         cache.move_to_end(chunk)
+         return rv
+      
+      if (self.tok_store is None):
+         rv = None
+      else:
+         rv = self.tok_store.get_tokens(self, kind, chunk)
+      if (rv is None):
+         rv = chunk.get_tokens()
+      cache[chunk] = rv
+      while (len(cache) > self.TOKEN_CACHE_SIZE):
+         cache.popitem(last=False)
+      return rv
+   
+   def get_es_tokens(self, idx):
+      """Return tokens of event script chunk.
+      
+      The returned list is cached and shared between callers; neither it nor its elements may be modified."""
+      return self._get_chunk_tokens('es', self._data_es[idx])
+   
+   def get_cs_tokens(self, idx):
+      """Return tokens of conversation script chunk.
+      
+      The returned list is cached and shared between callers; neither it nor its elements may be modified."""
+      return self._get_chunk_tokens('cs', self._data_cbc[idx])
    
    def write(self, f_out):
       from itertools import chain
@@ -0,0 +1,628 @@
+#!/usr/bin/env python3
+#Copyright 2010 Sebastian Hagen
+# This file is part of E17p.
+#
+# E17p is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# E17p is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Persistent cache of tokenized script chunks.
+#
+# Every entry is a file holding the tokens of the event and conversation script chunks of one script file. Entries are
+# named by a hash of the script data and the name and TOKEN_VERSION of the parser class that tokenized it.
+# Tokens are stored in a tagged binary encoding: each value is an opcode byte followed by its operands, with class names,
+# attribute names and text kept in a string table shared by all chunks of an entry. Entry files are read in full when
+# their script is first looked up, but individual chunks are only decoded when requested.
+#
+# The cache is filled by tokenizing whole script files ahead of time (see _main()); lookups never write to it.
+
+import hashlib
+import importlib
+import os
+import struct
+import weakref
+
+from ...base.file_data import DataRefFile
+
+class ScriptCacheError(ValueError):
+   pass
+
+# Value opcodes
+_OP_NONE = 0
+_OP_TRUE = 1
+_OP_FALSE = 2
+_OP_INT = 3      # zigzag varint
+_OP_FLOAT = 4    # 8 byte LE double
+_OP_STR = 5      # string table index
+_OP_BYTES = 6    # length, data
+_OP_TUPLE = 7    # count, values
+_OP_LIST = 8     # count, values
+_OP_DICT = 9     # count, key/value pairs
+_OP_OBJ = 10     # shape (class and attribute names) string index, base type payload, attribute values
+_OP_REF = 11     # index of previously decoded list, dict or object
+_OP_DREF = 12    # offset relative to script start, size
+
+# Chunk kinds, in order of their stored values.
+_KINDS = ('es', 'cs')
+
+# Top-level package name; only classes from there are encoded and instantiated.
+_PKG = __package__.split('.')[0]
+
+def _put_uvar(out, v):
+   while (v > 0x7f):
+      out.append((v & 0x7f) | 0x80)
+      v >>= 7
+   out.append(v)
+
+def _get_uvar(buf, off):
+   rv = 0
+   shift = 0
+   while (True):
+      b = buf[off]
+      off += 1
+      rv |= (b & 0x7f) << shift
+      if (b < 0x80):
+         return (rv, off)
+      shift += 7
+
+def _get_cls_name(cls):
+   return '{}:{}'.format(cls.__module__, cls.__qualname__)
+
+def _resolve_cls(name):
+   (mn, qn) = name.split(':')
+   if (mn.split('.')[0] != _PKG):
+      raise ScriptCacheError('Refusing to instantiate foreign class {!r}.'.format(name))
+   rv = importlib.import_module(mn)
+   for n in qn.split('.'):
+      rv = getattr(rv, n)
+   if not (isinstance(rv, type)):
+      raise ScriptCacheError('{!r} is not a class.'.format(name))
+   return rv
+
+def _get_state(val):
+   """Return dict of instance attributes of val, covering both __dict__ and __slots__ members."""
+   try:
+      rv = val.__getstate__()
+   except AttributeError:
+      pass
+   else:
+      if (isinstance(rv, dict)):
+         return rv
+   
+   rv = dict(getattr(val, '__dict__', ()))
+   for cls in type(val).__mro__:
+      slots = cls.__dict__.get('__slots__', ())
+      if (isinstance(slots, str)):
+         slots = (slots,)
+      for k in slots:
+         if ((k in ('__dict__', '__weakref__')) or (k in rv)):
+            continue
+         try:
+            rv[k] = cls.__dict__[k].__get__(val)
+         except AttributeError:
+            # Unset slot.
+            pass
+   return rv
+
+
+class _TokenEncoder:
+   def __init__(self, strings, f, base_off):
+      # Dict mapping strings to their index in the string table
+      self._strings = strings
+      self._f = f
+      self._base_off = base_off
+      # Dict mapping classes to their verified names
+      self._cls_names = {}
+   
+   def _put_str(self, out, s):
+      try:
+         i = self._strings[s]
+      except KeyError:
+         i = self._strings[s] = len(self._strings)
+      _put_uvar(out, i)
+   
+   def encode(self, val):
+      out = bytearray()
+      # id -> memo index; we keep the objects themselves alive in _memo_objs, to keep their ids unique.
+      self._memo = {}
+      self._memo_objs = []
+      self._put(out, val)
+      self._memo = self._memo_objs = None
+      return out
+   
+   def _memoize(self, out, val):
+      """Emit a back reference and return True if val has been emitted before; otherwise, register it."""
+      try:
+         i = self._memo[id(val)]
+      except KeyError:
+         self._memo[id(val)] = len(self._memo_objs)
+         self._memo_objs.append(val)
+         return False
+      out.append(_OP_REF)
+      _put_uvar(out, i)
+      return True
+   
+   def _put_seq(self, out, vals):
+      _put_uvar(out, len(vals))
+      for v in vals:
+         self._put(out, v)
+   
+   def _put(self, out, val):
+      t = type(val)
+      if (val is None):
+         out.append(_OP_NONE)
+      elif (t is bool):
+         out.append(_OP_TRUE if val else _OP_FALSE)
+      elif (t is int):
+         out.append(_OP_INT)
+         _put_uvar(out, (val << 1) if (val >= 0) else (((-val) << 1) - 1))
+      elif (t is str):
+         out.append(_OP_STR)
+         self._put_str(out, val)
+      elif (t is bytes):
+         out.append(_OP_BYTES)
+         _put_uvar(out, len(val))
+         out += val
+      elif (t is float):
+         out.append(_OP_FLOAT)
+         out += struct.pack('<d', val)
+      elif (t is tuple):
+         out.append(_OP_TUPLE)
+         self._put_seq(out, val)
+      elif (t is list):
+         if not (self._memoize(out, val)):
+            out.append(_OP_LIST)
+            self._put_seq(out, val)
+      elif (t is dict):
+         if not (self._memoize(out, val)):
+            out.append(_OP_DICT)
+            _put_uvar(out, len(val))
+            for (k, v) in val.items():
+               self._put(out, k)
+               self._put(out, v)
+      elif (t is DataRefFile):
+         if not (val.f is self._f):
+            raise ScriptCacheError('Unable to encode reference to foreign file {!r}.'.format(val.f))
+         out.append(_OP_DREF)
+         _put_uvar(out, val.off - self._base_off)
+         _put_uvar(out, val.size)
+      else:
+         self._put_obj(out, val)
+   
+   def _get_cls_name(self, cls):
+      try:
+         return self._cls_names[cls]
+      except KeyError:
+         pass
+      name = _get_cls_name(cls)
+      if ((name.split('.')[0] != _PKG) or ('<' in name) or issubclass(cls, (str, bytes, dict, DataRefFile))):
+         raise ScriptCacheError('Unable to encode instances of {!r}.'.format(cls))
+      # Classes can be shadowed by later ones of the same name; we'd silently get the wrong one back on decoding.
+      try:
+         rcls = _resolve_cls(name)
+      except (ImportError, AttributeError, ValueError) as exc:
+         raise ScriptCacheError('Unable to resolve class {!r}.'.format(name)) from exc
+      if not (rcls is cls):
+         raise ScriptCacheError('Class name {!r} resolves to a different class of the same name.'.format(name))
+      self._cls_names[cls] = name
+      return name
+   
+   def _put_obj(self, out, val):
+      name = self._get_cls_name(type(val))
+      if (self._memoize(out, val)):
+         return
+      d = _get_state(val)
+      out.append(_OP_OBJ)
+      # Class and attribute names are stored once per shape, instead of once per object.
+      self._put_str(out, '\x00'.join((name,) + tuple(d)))
+      if (isinstance(val, (list, tuple))):
+         self._put_seq(out, val)
+      elif (isinstance(val, int)):
+         self._put(out, int(val))
+      
+      for v in d.values():
+         self._put(out, v)
+
+
+# Object base types, as far as decoding is concerned.
+_BT_PLAIN = 0
+_BT_LIST = 1
+_BT_TUPLE = 2
+_BT_INT = 3
+
+class _TokenDecoder:
+   def __init__(self, buf, strings, shapes, f, base_off):
+      self._buf = buf
+      self._strings = strings
+      # Dict mapping string indices to (class, base type, attribute names, __setstate__) tuples
+      self._shapes = shapes
+      self._f = f
+      self._base_off = base_off
+      self._ops = (self._get_none, self._get_true, self._get_false, self._get_int, self._get_float, self._get_str,
+         self._get_bytes, self._get_tuple, self._get_list, self._get_dict, self._get_obj, self._get_ref, self._get_dref)
+   
+   def decode(self, off):
+      self._off = off
+      self._memo = []
+      try:
+         return self._get()
+      except (IndexError, KeyError, AttributeError, struct.error) as exc:
+         raise ScriptCacheError('Corrupt token data.') from exc
+      finally:
+         self._memo = None
+   
+   def _get_uvar(self):
+      off = self._off
+      b = self._buf[off]
+      if (b < 0x80):
+         self._off = off + 1
+         return b
+      (rv, self._off) = _get_uvar(self._buf, off)
+      return rv
+   
+   def _get(self):
+      off = self._off
+      self._off = off + 1
+      return self._ops[self._buf[off]]()
+   
+   def _get_seq(self):
+      get = self._get
+      return [get() for _ in range(self._get_uvar())]
+   
+   def _get_shape(self, i):
+      try:
+         return self._shapes[i]
+      except KeyError:
+         pass
+      (name, *attrs) = self._strings[i].split('\x00')
+      try:
+         cls = _resolve_cls(name)
+      except (ImportError, AttributeError, ValueError) as exc:
+         raise ScriptCacheError('Unable to resolve class {!r}.'.format(name)) from exc
+      
+      if (issubclass(cls, tuple)):
+         bt = _BT_TUPLE
+      elif (issubclass(cls, int)):
+         bt = _BT_INT
+      elif (issubclass(cls, list)):
+         bt = _BT_LIST
+      else:
+         bt = _BT_PLAIN
+      rv = self._shapes[i] = (cls, bt, tuple(attrs), getattr(cls, '__setstate__', None))
+      return rv
+   
+   def _get_none(self):
+      return None
+   
+   def _get_true(self):
+      return True
+   
+   def _get_false(self):
+      return False
+   
+   def _get_int(self):
+      v = self._get_uvar()
+      return -((v + 1) >> 1) if (v & 1) else (v >> 1)
+   
+   def _get_float(self):
+      off = self._off
+      self._off += 8
+      return struct.unpack_from('<d', self._buf, off)[0]
+   
+   def _get_str(self):
+      return self._strings[self._get_uvar()]
+   
+   def _get_bytes(self):
+      l = self._get_uvar()
+      off = self._off
+      self._off += l
+      return bytes(self._buf[off:off+l])
+   
+   def _get_tuple(self):
+      return tuple(self._get_seq())
+   
+   def _get_list(self):
+      rv = []
+      self._memo.append(rv)
+      rv.extend(self._get_seq())
+      return rv
+   
+   def _get_dict(self):
+      rv = {}
+      self._memo.append(rv)
+      for _ in range(self._get_uvar()):
+         k = self._get()
+         rv[k] = self._get()
+      return rv
+   
+   def _get_ref(self):
+      return self._memo[self._get_uvar()]
+   
+   def _get_dref(self):
+      off = self._get_uvar() + self._base_off
+      return DataRefFile(self._f, off, self._get_uvar())
+   
+   def _get_obj(self):
+      i = self._get_uvar()
+      (cls, bt, attrs, setstate) = (self._shapes.get(i) or self._get_shape(i))
+      memo = self._memo
+      if (bt == _BT_PLAIN):
+         rv = object.__new__(cls)
+         memo.append(rv)
+      elif (bt == _BT_LIST):
+         rv = list.__new__(cls)
+         memo.append(rv)
+         list.extend(rv, self._get_seq())
+      else:
+         # Immutable; base data has to be decoded first.
+         i = len(memo)
+         memo.append(None)
+         if (bt == _BT_TUPLE):
+            rv = tuple.__new__(cls, self._get_seq())
+         else:
+            rv = int.__new__(cls, self._get())
+         memo[i] = rv
+      
+      if (attrs):
+         get = self._get
+         state = [(k, get()) for k in attrs]
+         if (setstate is None):
+            for (k, v) in state:
+               setattr(rv, k, v)
+         else:
+            setstate(rv, dict(state))
+      return rv
+
+
+class _ScriptCacheEntry:
+   MAGIC = b'E17pSTC\x00'
+   VERSION = 2
+   
+   hdr_fmt = '<8sLLQQ'
+   hdr_sz = struct.calcsize(hdr_fmt)
+   idx_fmt = '<BLQQ'
+   idx_sz = struct.calcsize(idx_fmt)
+   
+   def __init__(self, data):
+      (magic, version, count, st_off, st_count) = struct.unpack_from(self.hdr_fmt, data)
+      if ((magic != self.MAGIC) or (version != self.VERSION)):
+         raise ScriptCacheError('Unsupported entry format {!r}/{!r}.'.format(magic, version))
+      
+      self._data = data
+      self._chunks = {}
+      off = self.hdr_sz
+      for _ in range(count):
+         (kind, idx, c_off, c_size) = struct.unpack_from(self.idx_fmt, data, off)
+         off += self.idx_sz
+         if (c_off + c_size > len(data)):
+            raise ScriptCacheError('Chunk data beyond end of entry.')
+         self._chunks[(_KINDS[kind], idx)] = c_off
+      
+      self._st_off = st_off
+      self._st_count = st_count
+      self._strings = None
+      self._shapes = {}
+   
+   def _get_strings(self):
+      if (self._strings is None):
+         data = self._data
+         off = self._st_off
+         rv = []
+         for _ in range(self._st_count):
+            (l, off) = _get_uvar(data, off)
+            rv.append(data[off:off+l].decode('utf-8', 'surrogatepass'))
+            off += l
+         self._strings = rv
+      return self._strings
+   
+   def __contains__(self, key):
+      return (key in self._chunks)
+   
+   def get_chunk_data(self, kind, chunk, f, base_off):
+      """Decode cached tokenization results for chunk; returns None if we don't have any.
+      
+      Returns (tokens, end_forced, size, blacklist additions) tuple."""
+      try:
+         off = self._chunks[(kind, chunk._chunk_idx)]
+      except KeyError:
+         return None
+      dec = _TokenDecoder(self._data, self._get_strings(), self._shapes, f, base_off)
+      try:
+         (end_forced, size, bl_add, tokens) = dec.decode(off)
+      except (TypeError, ValueError) as exc:
+         raise ScriptCacheError('Corrupt chunk data.') from exc
+      return (tokens, end_forced, size, bl_add)
+   
+   @classmethod
+   def build(cls, chunk_data, strings):
+      """Return entry file data for sequence of (kind, idx, encoded data) tuples and string table dict."""
+      st = bytearray()
+      for (s,_) in sorted(strings.items(), key=lambda e: e[1]):
+         b = s.encode('utf-8', 'surrogatepass')
+         _put_uvar(st, len(b))
+         st += b
+      
+      off = cls.hdr_sz + cls.idx_sz*len(chunk_data)
+      rv = bytearray()
+      body = bytearray()
+      for (kind, idx, data) in chunk_data:
+         rv += struct.pack(cls.idx_fmt, _KINDS.index(kind), idx, off + len(body), len(data))
+         body += data
+      st_off = off + len(body)
+      return b''.join((struct.pack(cls.hdr_fmt, cls.MAGIC, cls.VERSION, len(chunk_data), st_off, len(strings)), rv,
+         body, st))
+
+
+class ScriptTokenCache:
+   SUFFIX = '.stc'
+   
+   def __init__(self, path):
+      self.path = path
+      os.makedirs(path, exist_ok=True)
+      # Dict mapping parsers to entries (or None, if there is no usable one).
+      self._entries = weakref.WeakKeyDictionary()
+      # Dict mapping parsers to their cache keys
+      self._keys = weakref.WeakKeyDictionary()
+   
+   @staticmethod
+   def get_key(parser):
+      """Return cache key for specified script parser."""
+      h = hashlib.sha1()
+      h.update('{}:{:d}:{:d}\x00'.format(_get_cls_name(type(parser)), parser.TOKEN_VERSION,
+         _ScriptCacheEntry.VERSION).encode())
+      f = parser._f
+      off = parser._base_off
+      l = parser._off_lim - off
+      try:
+         gv = f.get_view
+      except AttributeError:
+         # Other drefs may share this file; leave its position alone.
+         pos = f.tell()
+         try:
+            f.seek(off)
+            h.update(f.read(l))
+         finally:
+            f.seek(pos)
+      else:
+         h.update(gv(l, off))
+      return h.hexdigest()
+   
+   def _get_key(self, parser):
+      try:
+         return self._keys[parser]
+      except KeyError:
+         pass
+      rv = self._keys[parser] = self.get_key(parser)
+      return rv
+   
+   def _get_fn(self, key):
+      return os.path.join(self.path, key + self.SUFFIX)
+   
+   def _get_entry(self, parser):
+      try:
+         return self._entries[parser]
+      except KeyError:
+         pass
+      
+      try:
+         with open(self._get_fn(self._get_key(parser)), 'rb') as f:
+            rv = _ScriptCacheEntry(f.read())
+      except (OSError, ScriptCacheError, struct.error):
+         rv = None
+      self._entries[parser] = rv
+      return rv
+   
+   def get_tokens(self, parser, kind, chunk):
+      """Return cached token list for chunk of specified kind ('es' or 'cs'), or None on a cache miss.
+      
+      On a hit, the side effects of tokenizing the chunk are applied to it and its parser just like get_tokens() would."""
+      if (chunk._chunk_idx in chunk._chunk_blacklist):
+         return None
+      entry = self._get_entry(parser)
+      if (entry is None):
+         return None
+      try:
+         rv = entry.get_chunk_data(kind, chunk, parser._f, parser._base_off)
+      except ScriptCacheError:
+         self._entries[parser] = None
+         return None
+      if (rv is None):
+         return None
+      
+      (tokens, end_forced, size, bl_add) = rv
+      chunk._end_forced = end_forced
+      chunk.size = size
+      chunk._off_lim = chunk.off + size
+      chunk._chunk_blacklist.update(bl_add)
+      return tokens
+   
+   def put(self, parser):
+      """Tokenize all chunks of script parser, and store the results.
+      
+      Chunks which can't be tokenized, or whose tokens can't be encoded, are skipped. Returns (stored chunk count,
+      skipped chunk count) tuple."""
+      strings = {}
+      enc = _TokenEncoder(strings, parser._f, parser._base_off)
+      chunk_data = []
+      skipped = 0
+      for (kind, chunks) in (('es', parser._data_es), ('cs', parser._data_cbc)):
+         for chunk in chunks:
+            bl = chunk._chunk_blacklist
+            if (chunk._chunk_idx in bl):
+               # Not tokenized at all.
+               skipped += 1
+               continue
+            bl_0 = set(bl)
+            try:
+               tokens = chunk.get_tokens()
+               data = enc.encode((chunk._end_forced, chunk.size, tuple(sorted(bl - bl_0)), tokens))
+            except Exception:
+               # Tokenization failures are left for the live tokenizer to report; this also covers ScriptCacheError.
+               skipped += 1
+               continue
+            chunk_data.append((kind, chunk._chunk_idx, data))
+      
+      fn = self._get_fn(self._get_key(parser))
+      fn_tmp = '{}.{:d}.tmp'.format(fn, os.getpid())
+      try:
+         with open(fn_tmp, 'wb') as f:
+            f.write(_ScriptCacheEntry.build(chunk_data, strings))
+         os.replace(fn_tmp, fn)
+      except OSError:
+         try:
+            os.unlink(fn_tmp)
+         except OSError:
+            pass
+         raise
+      self._entries.pop(parser, None)
+      return (len(chunk_data), skipped)
+
+
+def _main():
+   import optparse
+   import time
+   from .lnk import LNKParser
+   
+   op = optparse.OptionParser(usage='%prog [options] <script archive> ...')
+   op.add_option('-o', '--outdir', default='script_cache', help='Cache directory to store tokenized scripts in.')
+   op.add_option('--n7', default=False, action='store_true', help='Tokenize scripts as Never7 ones.')
+   (opts, args) = op.parse_args()
+   
+   if (opts.n7):
+      from ...never7.ff.scr import N7ScriptParser as parser_cls
+   else:
+      from .scr import E17ScriptParser as parser_cls
+   
+   cache = ScriptTokenCache(opts.outdir)
+   for fn in args:
+      print('-------------------------------- Processing {}.'.format(fn))
+      ts = time.time()
+      (fc, cc, cc_skip) = (0, 0, 0)
+      with open(fn, 'rb') as f:
+         lp = LNKParser.build_from_file(f)
+         for chunk in lp:
+            if not (chunk.name.lower().endswith(b'.scr')):
+               continue
+            try:
+               parser = parser_cls.build_from_dataref(chunk)
+            except ValueError as exc:
+               print('--->>> {!r}: Unable to parse: {!r}'.format(chunk.name, exc))
+               continue
+            (c, c_skip) = cache.put(parser)
+            print('--->>> {!r}: {} chunks ({} skipped)'.format(chunk.name, c, c_skip))
+            fc += 1
+            cc += c
+            cc_skip += c_skip
+      print('======== Stored {} chunks ({} skipped) of {} scripts in {:.2f}s.'.format(cc, cc_skip, fc, time.time() - ts))
+
+if (__name__ == '__main__'):
+   _main()
@@ -46,53 +46,273 @@ class _WAFData:
       self.fsd = fsd
       self.bits_per_sample = bits_per_sample
       self.uk1 = uk1
+   
+   def get_frame_count(self):
+      """Return number of samples per channel."""
+      hdr_sz = 7*self.channels
+      (blocks, rem) = divmod(self.body_dref.size, self.blockalign)
+      rv = blocks*((self.blockalign - hdr_sz)*2//self.channels + 2)
+      if (rem >= hdr_sz):
+         rv += (rem - hdr_sz)*2//self.channels + 2
+      return rv
+   
+   def get_duration(self):
+      return self.get_frame_count()/self.sfreq
 
 class WAFDataSegment:
+   # In-memory PCM wav file prepared by decode()
+   _wav_file = None
    def __init__(self, dref):
       self.d = dref
    
+   def get_idx_data(self):
+      return ()
+   
+   @classmethod
+   def build_from_idx_data(cls, src, data):
+      return cls(src)
+   
    def get_pygame_sound(self):
       from io import BytesIO
       from pygame.mixer import Sound
+      if not (self._wav_file is None):
+         (wav_file, self._wav_file) = (self._wav_file, None)
+         return Sound(wav_file)
+      
+      # SDL_mixer seeks around while parsing the file, so this needs a real file object; a lazy reader won't do.
       b = BytesIO()
-      wav = self.get_wav()
-      wav.write_to_file(b.write)
+      self.get_wav().write_to_fileobj(b)
       b.seek(0)
-      
       return Sound(b)
    
+   def get_detached(self):
+      """Return equivalent instance backed by an in-memory copy of the chunk data."""
+      rv = type(self)(self.d.get_detached())
+      rv.fn = getattr(self, 'fn', None)
+      return rv
+   
+   def decode(self):
+      """Decode audio data in advance; the next get_pygame_sound() call will use the result. Returns self."""
+      from io import BytesIO
+      b = BytesIO()
+      self.get_wav_pcm().write_to_file(b.write)
+      b.seek(0)
+      self._wav_file = b
+      return self
+   
    def get_data(self):
       return self.d.get_dref_plain()
    
    def get_waf_data(self):
       return _WAFData(self.d.get_dref_plain())
+   
+   def get_waf_header(self):
+      """Like get_waf_data(), but only decompresses the header. The body dref of the return value is not backed by data."""
+      from ...base.file_data import BufferFile
+      try:
+         iter_data_plain = self.d.iter_data_plain
+      except AttributeError:
+         return _WAFData(self.d)
+      
+      hdr = next(iter_data_plain(_WAFData.waf_hdr_sz), b'')
+      return _WAFData(DataRefFile(BufferFile(hdr), 0, len(hdr)))
       
-   def get_wav(self):
+   def get_wav(self, wd=None):
       from ...base.ff.wav import RIFFFile, RIFFChunk_Wave_fmt
-      wd = self.get_waf_data()
+      if (wd is None):
+         wd = self.get_waf_data()
       
       return RIFFFile.build_wav(wd.body_dref, fmt=RIFFChunk_Wave_fmt.FMT_MS_ADPCM, channels=wd.channels, sfreq=wd.sfreq,
          blockalign=wd.blockalign, abyterate=wd.ass, bits_per_sample=wd.bits_per_sample, fsd=wd.fsd)
       
-   def get_wav_pcm(self):
+   def get_wav_pcm(self, wd=None):
       from ...base.ff.wav import RIFFFile, RIFFChunk_Wave_fmt
-      wd = self.get_waf_data()
+      if (wd is None):
+         wd = self.get_waf_data()
       
       if (wd.bits_per_sample != 4):
          raise ValueError('Invalid WAF bits/sample value {!r}.'.format(wd.bits_per_sample))
       
-      return RIFFFile.build_wav(wd.body_dref.get_pcm_dref(), fmt=RIFFChunk_Wave_fmt.FMT_MS_PCM, channels=wd.channels,
-         sfreq=wd.sfreq, blockalign=4*wd.blockalign, abyterate=4*wd.ass, bits_per_sample=16, fsd=b'')
+      # 16-bit PCM frames; unlike the ADPCM values, these don't depend on the WAF block layout.
+      frame_size = 2*wd.channels
+      return RIFFFile.build_wav(wd.body_dref.get_pcm_stream_dref(), fmt=RIFFChunk_Wave_fmt.FMT_MS_PCM, channels=wd.channels,
+         sfreq=wd.sfreq, blockalign=frame_size, abyterate=frame_size*wd.sfreq, bits_per_sample=16, fsd=b'')
 
 data_handler_reg(b'waf')(WAFDataSegment)
 
+# ---------------------------------------------------------------- Batch conversion
+def _convert_chunk(name, is_compressed, data, ofn, pcm):
+   """Write wav file for raw LNK chunk data; returns (sample count, bytes written) tuple."""
+   import os
+   from ...base.file_data import BufferFile
+   from .lnk import LNKChunk
+   
+   waf = WAFDataSegment(LNKChunk(BufferFile(data), 0, len(data), name, is_compressed))
+   wd = waf.get_waf_data()
+   if (pcm):
+      wav = waf.get_wav_pcm(wd)
+   else:
+      wav = waf.get_wav(wd)
+   
+   ofn_tmp = ofn + b'.tmp'
+   with open(ofn_tmp, 'wb') as f:
+      size = wav.write_to_fileobj(f)
+   os.replace(ofn_tmp, ofn)
+   return (wd.get_frame_count()*wd.channels, size)
+
+class WAFConversionJournal:
+   """Record of chunks converted by a (possibly interrupted) batch conversion run.
+   
+   Every line of the journal file records one finished output file, and the source archive name, output mode (b'adpcm'
+   or b'pcm'), chunk name, offset and size it was written from. Later lines for the same output file override earlier
+   ones."""
+   def __init__(self, fn):
+      self.fn = fn
+      # Dict mapping output filenames to keys of the chunks they were last written from
+      self.done = {}
+      self._f = None
+   
+   @staticmethod
+   def _get_key(src, mode, chunk):
+      return (src, mode, chunk.name, chunk.off, chunk.size)
+   
+   def _get_ofn_rel(self, ofn):
+      """Return output filename relative to the journal's directory, so it doesn't depend on how that was specified."""
+      import os.path
+      return os.path.relpath(ofn, os.path.dirname(self.fn) or b'.')
+   
+   def load(self):
+      try:
+         f = open(self.fn, 'rb')
+      except FileNotFoundError:
+         return
+      with f:
+         for line in f:
+            # An interrupted run can leave a partial last line; ignore that.
+            if not (line.endswith(b'\n')):
+               continue
+            try:
+               (ofn, src, mode, name, off, size) = line[:-1].split(b'\t')
+               self.done[ofn] = (src, mode, name, int(off), int(size))
+            except ValueError:
+               continue
+   
+   def is_done(self, ofn, src, mode, chunk):
+      return (self.done.get(self._get_ofn_rel(ofn)) == self._get_key(src, mode, chunk))
+   
+   def add(self, ofn, src, mode, chunk):
+      key = self._get_key(src, mode, chunk)
+      ofn = self._get_ofn_rel(ofn)
+      if (self._f is None):
+         self._f = open(self.fn, 'ab')
+      self._f.write(b'%s\t%s\t%s\t%s\t%d\t%d\n' % ((ofn,) + key))
+      self._f.flush()
+      self.done[ofn] = key
+   
+   def close(self):
+      if not (self._f is None):
+         self._f.close()
+         self._f = None
+
+def convert_lnk(lp, get_ofn, pcm=False, jobs=None, journal=None, src=b''):
+   """Convert WAF chunks of LNK archive to wav files, in a pool of worker processes.
+   
+   If a journal is given, chunks it records as last written to their output file from the same source archive name and
+   in the same output mode are skipped if that file exists, and newly converted ones are added to it. Returns (converted chunk count, skipped chunk
+   count, sample count, bytes written) tuple."""
+   import collections
+   import os
+   import os.path
+   
+   chunks = sorted((c for c in lp if c.name.lower().endswith(b'.waf')), key=lambda c: c.off)
+   stats = [0, 0, 0, 0]
+   mode = (b'pcm' if pcm else b'adpcm')
+   
+   def finish(chunk, ofn, res):
+      (samples, size) = res
+      print('--->>> {!r} ({} samples, {} bytes)'.format(ofn, samples, size))
+      if not (journal is None):
+         journal.add(ofn, src, mode, chunk)
+      stats[0] += 1
+      stats[2] += samples
+      stats[3] += size
+   
+   todo = []
+   for chunk in chunks:
+      ofn = get_ofn(chunk)
+      if ((journal is not None) and journal.is_done(ofn, src, mode, chunk) and os.path.exists(ofn)):
+         stats[1] += 1
+         continue
+      todo.append((chunk, ofn))
+   
+   if (jobs == 1):
+      for (chunk, ofn) in todo:
+         finish(chunk, ofn, _convert_chunk(chunk.name, chunk.is_compressed, chunk.get_data(), ofn, pcm))
+      return tuple(stats)
+   
+   from concurrent.futures import ProcessPoolExecutor
+   pending = collections.deque()
+   with ProcessPoolExecutor(jobs) as ex:
+      # Keep the workers busy, but don't hold input data for more than a few chunks per worker in memory.
+      pending_lim = 4*(jobs or os.cpu_count() or 1)
+      for (chunk, ofn) in todo:
+         fut = ex.submit(_convert_chunk, chunk.name, chunk.is_compressed, chunk.get_data(), ofn, pcm)
+         pending.append((chunk, ofn, fut))
+         while (len(pending) > pending_lim):
+            (chunk, ofn, fut) = pending.popleft()
+            finish(chunk, ofn, fut.result())
+      
+      while (pending):
+         (chunk, ofn, fut) = pending.popleft()
+         finish(chunk, ofn, fut.result())
+   
+   return tuple(stats)
+
+
 def _main():
    import optparse
+   import os
+   import os.path
+   import time
    op = optparse.OptionParser()
    op.add_option('-w', '--wav', dest='wav', action='store_true', default=False, help='Dump data to wav files.')
    op.add_option('-p', '--pcm', dest='wav_attrname', default='get_wav', action='store_const', const='get_wav_pcm', help='Convert audio data to PCM codec before writing to wav files.')
+   op.add_option('-a', '--archive', action='store_true', default=False, help='Convert all WAF chunks in specified LNK archives (e.g. voice.dat).')
+   op.add_option('-o', '--outdir', default='.', help='Directory to write wav files to, in archive mode.')
+   op.add_option('-j', '--jobs', type=int, default=None, help='Number of worker processes to use in archive mode.')
+   op.add_option('-f', '--force', action='store_true', default=False, help='Reconvert chunks recorded as done in the conversion journal.')
    
    (opts, args) = op.parse_args()
+   if (opts.archive):
+      from .lnk import LNKParser
+      pcm = (opts.wav_attrname == 'get_wav_pcm')
+      outdir = opts.outdir.encode()
+      os.makedirs(outdir, exist_ok=True)
+      journal_fn = os.path.join(outdir, b'.e17p_waf_journal')
+      if (opts.force):
+         try:
+            os.unlink(journal_fn)
+         except FileNotFoundError:
+            pass
+      journal = WAFConversionJournal(journal_fn)
+      journal.load()
+      
+      def get_ofn(chunk):
+         return os.path.join(outdir, os.path.basename(chunk.name) + b'.wav')
+      
+      for fn in args:
+         print('-------------------------------- Processing {}.'.format(fn))
+         with open(fn, 'rb') as f:
+            lp = LNKParser.build_from_file(f)
+            ts = time.time()
+            (cc, cc_skip, samples, size) = convert_lnk(lp, get_ofn, pcm, opts.jobs, journal,
+               os.path.basename(fn.encode()))
+            td = max(time.time() - ts, 1E-6)
+         print('======== Converted {} chunks ({} skipped) in {:.2f}s: {} samples ({:.0f} samples/s), wrote {:.2f} MB.'.format(
+            cc, cc_skip, td, samples, samples/td, size/1E6))
+      journal.close()
+      return
+   
    for fn in args:
       fn = fn.encode()
       print('-------------------------------- Processing {}.'.format(fn))
@@ -105,7 +325,7 @@ def _main():
          fn2 = fn + b'.wav'
          print('-- Writing: {}.'.format(fn2))
          f2 = open(fn2, 'wb')
-         wav.write_to_file(f2.write)
+         wav.write_to_fileobj(f2)
 
 if (__name__ == '__main__'):
    _main()
@@ -0,0 +1,338 @@
+#!/usr/bin/env python3
+#Copyright 2010 Sebastian Hagen
+# This file is part of E17p.
+#
+# E17p is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# E17p is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Asset manifests: Inventories of all chunks in the LNK archives of a game install.
+#
+# Manifests are stored column-wise: every per-chunk attribute is an array with one element per chunk, and all strings
+# are kept in tables referenced by index. Attributes that don't apply to a chunk's type are 0.
+
+import hashlib
+import os
+import struct
+import sys
+from array import array
+
+class ManifestError(ValueError):
+   pass
+
+class AssetManifest:
+   MAGIC = b'E17pMANI'
+   VERSION = 1
+   
+   hdr_fmt = '<8sLLL'
+   hdr_sz = struct.calcsize(hdr_fmt)
+   col_hdr_fmt = '<B1sBQ'
+   col_hdr_sz = struct.calcsize(col_hdr_fmt)
+   
+   # (column name, array typecode) pairs
+   COLUMNS = (
+      ('archive', 'H'),     # index into archives table
+      ('name', 'I'),        # index into names table
+      ('type', 'H'),        # index into types table
+      ('off', 'I'),
+      ('size', 'I'),        # stored size in archive
+      ('compressed', 'B'),  # LNK compression flag
+      ('size_plain', 'I'),  # size after LNK decompression
+      ('size_content', 'I'),# size of decompressed CPS content
+      ('error', 'B'),       # set if the chunk couldn't be analyzed fully
+      ('width', 'I'),
+      ('height', 'I'),
+      ('color_depth', 'B'),
+      ('alpha', 'B'),
+      ('channels', 'B'),
+      ('sfreq', 'I'),
+      ('frames', 'I'),      # audio samples per channel
+      ('es_count', 'I'),    # SCR event script table size
+      ('cs_count', 'I'),    # SCR conversation script table size
+      ('fn_count', 'I'),    # SCR filename table size
+      ('hash', 'B'),        # SHA1 digests of stored chunk data, HASH_LEN bytes per chunk
+   )
+   HASH_LEN = 20
+   
+   def __init__(self, archives=None, names=None, types=None, columns=None):
+      self.archives = archives or []
+      self.names = names or []
+      self.types = types or []
+      if (columns is None):
+         columns = dict((cn, array(tc)) for (cn, tc) in self.COLUMNS)
+      self.columns = columns
+      self._type_idx = dict((tn, i) for (i, tn) in enumerate(self.types))
+   
+   def __len__(self):
+      return len(self.columns['archive'])
+   
+   def get_type_idx(self, tn):
+      try:
+         return self._type_idx[tn]
+      except KeyError:
+         rv = self._type_idx[tn] = len(self.types)
+         self.types.append(tn)
+         return rv
+   
+   def extend(self, other):
+      """Append all rows of other manifest to this one."""
+      a_map = []
+      for fn in other.archives:
+         try:
+            a_map.append(self.archives.index(fn))
+         except ValueError:
+            a_map.append(len(self.archives))
+            self.archives.append(fn)
+      t_map = [self.get_type_idx(tn) for tn in other.types]
+      n_base = len(self.names)
+      self.names.extend(other.names)
+      
+      for (cn, tc) in self.COLUMNS:
+         col = other.columns[cn]
+         if (cn == 'archive'):
+            col = array(tc, (a_map[i] for i in col))
+         elif (cn == 'type'):
+            col = array(tc, (t_map[i] for i in col))
+         elif (cn == 'name'):
+            col = array(tc, (n_base + i for i in col))
+         self.columns[cn].extend(col)
+   
+   def get_row(self, i):
+      """Return dict of attributes of chunk with specified index."""
+      rv = dict((cn, self.columns[cn][i]) for (cn, tc) in self.COLUMNS if (cn != 'hash'))
+      rv['archive'] = self.archives[rv['archive']]
+      rv['name'] = self.names[rv['name']]
+      rv['type'] = self.types[rv['type']]
+      rv['hash'] = self.columns['hash'][i*self.HASH_LEN:(i+1)*self.HASH_LEN].tobytes()
+      if (rv['sfreq']):
+         rv['duration'] = rv['frames']/rv['sfreq']
+      else:
+         rv['duration'] = 0
+      return rv
+   
+   def __iter__(self):
+      for i in range(len(self)):
+         yield self.get_row(i)
+   
+   @staticmethod
+   def _pack_strings(sl):
+      return b'\x00'.join(sl)
+   
+   @staticmethod
+   def _unpack_strings(data, count):
+      if (count == 0):
+         return []
+      rv = data.split(b'\x00')
+      if (len(rv) != count):
+         raise ManifestError('Expected {:d} strings, got {:d}.'.format(count, len(rv)))
+      return rv
+   
+   def write(self, f_out):
+      tables = (self.archives, self.names, [tn.encode('ascii') for tn in self.types])
+      f_out.write(struct.pack(self.hdr_fmt, self.MAGIC, self.VERSION, len(self), len(self.COLUMNS)))
+      for t in tables:
+         data = self._pack_strings(t)
+         f_out.write(struct.pack('<LQ', len(t), len(data)))
+         f_out.write(data)
+      
+      for (cn, tc) in self.COLUMNS:
+         col = self.columns[cn]
+         if (sys.byteorder != 'little'):
+            col = array(tc, col)
+            col.byteswap()
+         data = col.tobytes()
+         cnb = cn.encode('ascii')
+         f_out.write(struct.pack(self.col_hdr_fmt, len(cnb), tc.encode('ascii'), col.itemsize, len(data)))
+         f_out.write(cnb)
+         f_out.write(data)
+   
+   def write_fn(self, fn):
+      fn_tmp = fn + '.tmp'
+      with open(fn_tmp, 'wb') as f:
+         self.write(f)
+      os.replace(fn_tmp, fn)
+   
+   @classmethod
+   def build_from_file(cls, f):
+      data = memoryview(f.read())
+      (magic, version, rows, cc) = struct.unpack(cls.hdr_fmt, data[:cls.hdr_sz])
+      if (magic != cls.MAGIC):
+         raise ManifestError('Unexpected preamble {!r}.'.format(magic))
+      if (version != cls.VERSION):
+         raise ManifestError('Unsupported manifest version {!r}.'.format(version))
+      
+      off = cls.hdr_sz
+      tables = []
+      for i in range(3):
+         (count, dlen) = struct.unpack('<LQ', data[off:off+12])
+         off += 12
+         tables.append(cls._unpack_strings(data[off:off+dlen].tobytes(), count))
+         off += dlen
+      (archives, names, types) = tables
+      types = [tn.decode('ascii') for tn in types]
+      
+      columns = {}
+      for i in range(cc):
+         (cnl, tc, itemsize, dlen) = struct.unpack(cls.col_hdr_fmt, data[off:off+cls.col_hdr_sz])
+         off += cls.col_hdr_sz
+         cn = data[off:off+cnl].tobytes().decode('ascii')
+         off += cnl
+         col = array(tc.decode('ascii'))
+         if (col.itemsize != itemsize):
+            raise ManifestError('Column {!r}: Item size {:d} differs from native size {:d}.'.format(cn, itemsize,
+               col.itemsize))
+         col.frombytes(data[off:off+dlen])
+         off += dlen
+         if (sys.byteorder != 'little'):
+            col.byteswap()
+         columns[cn] = col
+      
+      for (cn, tc) in cls.COLUMNS:
+         if not (cn in columns):
+            raise ManifestError('Missing column {!r}.'.format(cn))
+         if (len(columns[cn]) != rows*(cls.HASH_LEN if (cn == 'hash') else 1)):
+            raise ManifestError('Column {!r} has unexpected length {:d}.'.format(cn, len(columns[cn])))
+      if (off != len(data)):
+         raise ManifestError('Trailing garbage: Parsed {:d}/{:d} bytes.'.format(off, len(data)))
+      return cls(archives, names, types, columns)
+   
+   @classmethod
+   def build_from_fn(cls, fn):
+      with open(fn, 'rb') as f:
+         return cls.build_from_file(f)
+   
+   def add_chunk(self, archive_idx, chunk):
+      """Analyze LNK chunk, and append a row for it."""
+      from .ff import get_full_dhd
+      cols = self.columns
+      vals = dict((cn, 0) for (cn, tc) in self.COLUMNS)
+      vals['archive'] = archive_idx
+      vals['name'] = len(self.names)
+      self.names.append(chunk.name)
+      vals['off'] = chunk.off
+      vals['size'] = chunk.size
+      vals['compressed'] = chunk.is_compressed
+      
+      tn = type(chunk).__name__
+      try:
+         vals['size_plain'] = chunk.get_size_plain()
+         ext = chunk.name.lower().split(b'.')[-1]
+         dref = get_full_dhd().build(ext, chunk)
+         if not (dref is None):
+            tn = type(dref).__name__
+            self._analyze_dref(dref, vals)
+      except Exception:
+         # Truncated or otherwise broken chunks can fail in all kinds of ways; note it, and keep going with the rest.
+         vals['error'] = 1
+      vals['type'] = self.get_type_idx(tn)
+      
+      for (cn, tc) in self.COLUMNS:
+         if (cn != 'hash'):
+            cols[cn].append(vals[cn])
+      cols['hash'].frombytes(hashlib.sha1(chunk.get_view()).digest())
+   
+   @staticmethod
+   def _analyze_dref(dref, vals):
+      from .ff.cps import DataRefCPSE17
+      from .ff.scr import E17ScriptParser
+      from .ff.waf import WAFDataSegment
+      if (isinstance(dref, DataRefCPSE17)):
+         hdr = dref.get_prt_header(palette=False)
+         vals['size_content'] = dref.size_plain
+         vals['width'] = hdr.width
+         vals['height'] = hdr.height
+         vals['color_depth'] = hdr.color_depth
+         vals['alpha'] = bool(hdr.alpha)
+      elif (isinstance(dref, WAFDataSegment)):
+         wd = dref.get_waf_header()
+         vals['channels'] = wd.channels
+         vals['sfreq'] = wd.sfreq
+         vals['frames'] = wd.get_frame_count()
+      elif (isinstance(dref, E17ScriptParser)):
+         (vals['es_count'], vals['cs_count'], vals['fn_count']) = dref.get_counts()
+   
+   def get_summary(self):
+      """Return list of (type name, chunk count, stored size, plain size) tuples."""
+      rv = {}
+      cols = self.columns
+      for i in range(len(self)):
+         (c, s, sp) = rv.get(cols['type'][i], (0, 0, 0))
+         rv[cols['type'][i]] = (c + 1, s + cols['size'][i], sp + cols['size_plain'][i])
+      return [(self.types[ti],) + v for (ti, v) in sorted(rv.items())]
+
+
+def _scan_chunks(dn, fn, start, stop):
+   """Return manifest covering specified slice of chunks of LNK archive."""
+   from .ff.lnk import LNKParser
+   rv = AssetManifest([fn])
+   with open(os.path.join(dn, fn), 'rb') as f:
+      lnk = LNKParser.build_from_file(f)
+      for chunk in list(lnk)[start:stop]:
+         rv.add_chunk(0, chunk)
+   return rv
+
+def build_manifest(dn, jobs=None, slice_len=256):
+   """Build manifest for all LNK archives in game directory, analyzing chunks in a pool of worker processes.
+   
+   Archives that can't be parsed are skipped, like E17VNMediaStorageLNK.build_from_dir() does."""
+   from concurrent.futures import ProcessPoolExecutor
+   from .ff.lnk import LNKParser
+   from .vn_backend import E17VNMediaStorageLNK
+   
+   if (isinstance(dn, str)):
+      dn = dn.encode()
+   
+   tasks = []
+   for fn in sorted(E17VNMediaStorageLNK.get_lnk_fns(dn)):
+      with open(os.path.join(dn, fn), 'rb') as f:
+         try:
+            cc = len(list(LNKParser.build_from_file(f)))
+         except ValueError:
+            continue
+      tasks.extend((dn, fn, i, i + slice_len) for i in range(0, cc, slice_len))
+   
+   rv = AssetManifest()
+   if (jobs == 1):
+      for task in tasks:
+         rv.extend(_scan_chunks(*task))
+      return rv
+   
+   with ProcessPoolExecutor(jobs) as ex:
+      for m in ex.map(_scan_chunks, *zip(*tasks)):
+         rv.extend(m)
+   return rv
+
+
+def _main():
+   import optparse
+   import time
+   op = optparse.OptionParser(usage='%prog [options] <game directory>')
+   op.add_option('-o', '--outfile', default='manifest.bin', help='File to write manifest to.')
+   op.add_option('-j', '--jobs', type=int, default=None, help='Number of worker processes to use.')
+   op.add_option('-l', '--list', default=False, action='store_true', help='List contents of existing manifest file instead.')
+   (opts, args) = op.parse_args()
+   
+   if (opts.list):
+      am = AssetManifest.build_from_fn(opts.outfile)
+      for row in am:
+         print('{archive!r:14} {name!r:28} {type:20} {size:9d} {size_plain:9d} {width:4d}x{height:<4d} {color_depth:2d} '
+            '{alpha:d} {channels:d} {sfreq:5d} {duration:7.2f}s {es_count:4d} {cs_count:4d} {fn_count:4d} {err}'.format(
+            err=('ERR' if row['error'] else ''), **row))
+   else:
+      (dn,) = args
+      ts = time.time()
+      am = build_manifest(dn, opts.jobs)
+      am.write_fn(opts.outfile)
+      print('Wrote manifest of {:d} chunks to {!r} in {:.2f}s.'.format(len(am), opts.outfile, time.time() - ts))
+   
+   for (tn, count, size, size_plain) in am.get_summary():
+      print('{:20} {:7d} chunks {:12d} bytes stored {:12d} bytes plain'.format(tn, count, size, size_plain))
@@ -26,20 +26,51 @@ import random
 from ..base.enum import Enum
 
 # ---------------------------------------------------------------- VN backend types
+class _ChunkDict(dict):
+   """Chunk dict which defers wrapping of pending chunks until their first access."""
+   def __init__(self, wrap):
+      super().__init__()
+      self._wrap = wrap
+      self.pending = {}
+   
+   def __missing__(self, cn):
+      chunk = self.pending.pop(cn)
+      rv = self[cn] = self._wrap(cn, chunk)
+      return rv
+   
+   def __contains__(self, cn):
+      return (super().__contains__(cn) or (cn in self.pending))
+
+
 class E17VNMediaStorageLNK:
    logger = logging.getLogger('E17VNMediaStorageLNK')
    log = logger.log
    
-   def __init__(self, lnks, movie_path):
+   def __init__(self, lnks, movie_path, index=None):
       self._lnks = lnks
       self._files = {}
       for (fn,lnk) in lnks:
-         d = self._files[fn] = {}
+         d = self._files[fn] = _ChunkDict(self.wrap_dref)
+         if (index is None):
+            types = None
+         else:
+            types = index.get_types(fn)
+         
          for chunk in lnk:
             cn = chunk.name.lower()
             if (cn in d):
-               raise ValueError('Duplicated chunk {!a} ({!a}, {!a}).'.format(cn, self._files[cn].f, dref.f))
-            d[cn] = self.wrap_dref(cn, chunk)
+               raise ValueError('Duplicated chunk {!a} ({!a}, {!a}).'.format(cn, d[cn].f, chunk.f))
+            if (types is None):
+               d[cn] = self.wrap_dref(cn, chunk)
+               continue
+            
+            (tn, td) = types[chunk.name]
+            rv = index.build_chunk(chunk, tn, td)
+            if (rv is None):
+               d.pending[cn] = chunk
+            else:
+               rv.fn = cn
+               d[cn] = rv
       
       try:
          fns = os.listdir(movie_path)
@@ -55,24 +86,74 @@ class E17VNMediaStorageLNK:
       from .ff import get_full_dhd
       return get_full_dhd()      
 
+   @staticmethod
+   def get_lnk_fns(dn):
+      """Return list of filenames of potential LNK archives in directory."""
+      return [fn for fn in os.listdir(dn) if fn.endswith(b'.dat')]
+   
    @classmethod
-   def build_from_dir(cls, dn, **kwargs):
+   def build_from_dir(cls, dn, use_mmap=False, index_fn=None, **kwargs):
+      """Build instance from LNK archives in directory.
+      
+      If index_fn is specified, chunk metadata is read from that index file as long as it is still valid for the
+      respective archive, and the index file is updated as necessary."""
+      from ..base.file_data import BufferFile
       from .ff.lnk import LNKParser
+      from .ff.lnkidx import LNKIndex
+      
       if (isinstance(dn, str)):
          dn = dn.encode('ascii')
-      fns = os.listdir(dn)
+      if (isinstance(index_fn, str)):
+         index_fn = index_fn.encode()
+      
+      if (index_fn is None):
+         index = None
+      else:
+         index = LNKIndex.build_from_fn(index_fn)
+      
       lnks = []
-      for fn in fns:
-         if not (fn.endswith(b'.dat')):
-            continue
+      lnks_new = []
+      for fn in cls.get_lnk_fns(dn):
          pn = os.path.join(dn, fn)
+         f = open(pn, 'rb')
          try:
-            lnk = LNKParser.build_from_file(open(pn, 'rb'))
+            if (index is None):
+               ia = None
+            else:
+               ia = index.get_archive(fn, f)
+            
+            if (use_mmap):
+               fd = BufferFile.map_file(f)
+            else:
+               fd = f
+            
+            if (ia is None):
+               lnk = LNKParser.build_from_file(fd)
+               lnks_new.append((fn, f, lnk))
+            else:
+               lnk = ia.get_lnk(fd)
          except ValueError:
             continue
          lnks.append((fn,lnk))
       
-      return cls(lnks, movie_path=os.path.join(dn, b'movie'), **kwargs)
+      if not (index is None):
+         # Drop entries for missing and outdated archives.
+         fns_new = set(fn for (fn, f, lnk) in lnks_new)
+         index.prune(fn for (fn,lnk) in lnks if not (fn in fns_new))
+      
+      rv = cls(lnks, movie_path=os.path.join(dn, b'movie'), index=index, **kwargs)
+      
+      if not (index is None):
+         for (fn, f, lnk) in lnks_new:
+            d = rv._files[fn]
+            index.set_archive(fn, f, [(chunk, d[chunk.name.lower()]) for chunk in lnk])
+         if (index.dirty):
+            try:
+               index.write_fn(index_fn)
+            except EnvironmentError as exc:
+               cls.log(30, 'Unable to write chunk index to {!r}: {!r}'.format(index_fn, exc))
+      
+      return rv
    
    def wrap_dref(self, cn, dref):
       ext = cn.split(b'.')[-1]
@@ -188,6 +269,75 @@ class ImageViewport:
 class VNBacklog(list):
    pass
 
+class VoicePrefetcher:
+   """Decodes upcoming voice clips in background threads.
+   
+   Clip data is read from the media storage in the calling thread; only decompression and decoding run in the pool, on
+   detached copies of the data. At most count clips are pending or held at any time."""
+   logger = logging.getLogger('VoicePrefetcher')
+   log = logger.log
+   
+   def __init__(self, media_storage, count=4, threads=1):
+      self._ms = media_storage
+      self.count = count
+      self.threads = threads
+      self._executor = None
+      # Ordered dict mapping voice references to futures
+      self._pending = collections.OrderedDict()
+   
+   def update(self, voice_refs):
+      """Prefetch the first count of the specified voice references (in order of expected use), and drop all others."""
+      wanted = []
+      for vr in voice_refs:
+         if (len(wanted) >= self.count):
+            break
+         if not (vr in wanted):
+            wanted.append(vr)
+      
+      for vr in list(self._pending):
+         if not (vr in wanted):
+            self._pending.pop(vr).cancel()
+      
+      for vr in wanted:
+         if (vr in self._pending):
+            continue
+         try:
+            vd = self._ms.getfile_voice(vr).get_detached()
+         except (KeyError, ValueError, AttributeError) as exc:
+            self.log(20, 'Unable to prefetch voice clip {!r}: {!r}'.format(vr, exc))
+            continue
+         
+         if (self._executor is None):
+            from concurrent.futures import ThreadPoolExecutor
+            self._executor = ThreadPoolExecutor(self.threads)
+         self._pending[vr] = self._executor.submit(vd.decode)
+   
+   def get(self, vr):
+      """Return prefetched voice data for reference, or None if it isn't available.
+      
+      Waits for the decoding to finish if it's already in progress."""
+      fut = self._pending.pop(vr, None)
+      if ((fut is None) or fut.cancel()):
+         return None
+      try:
+         return fut.result()
+      except Exception as exc:
+         self.log(30, 'Prefetching voice clip {!r} failed: {!r}'.format(vr, exc))
+         return None
+   
+   def clear(self):
+      """Drop all prefetched data and cancel pending operations, e.g. after the script position changed unpredictably."""
+      for fut in self._pending.values():
+         fut.cancel()
+      self._pending.clear()
+   
+   def close(self):
+      self.clear()
+      if not (self._executor is None):
+         self._executor.shutdown(wait=False)
+         self._executor = None
+
+
 class E17VNBackend:
    logger = logging.getLogger('E17VNBackend')
    log = logger.log
@@ -204,6 +354,8 @@ class E17VNBackend:
    
    SCR_START_DEFAULT = b'op00'
    VP_CLS = ImageViewport
+   # Maximum number of event script tokens to scan for upcoming conversation scripts, for voice prefetching.
+   VOICE_LOOKAHEAD_ES_TOKENS = 32
    
    STATE_NAMES = ('_mem', '_r1', '_rng',
       '_scr_fn', '_es_i', '_es_n', '_cs_i', '_cs_n', '_callstack',
@@ -211,11 +363,16 @@ class E17VNBackend:
       '_charart',
       '_choice', '_cptrc'
    )
-   def init_backend(self, media_storage, rng=E17VNRNGSimple(), scr_start=None, continue_on_error=False, *, debug_color=False):
+   def init_backend(self, media_storage, rng=E17VNRNGSimple(), scr_start=None, continue_on_error=False, *, debug_color=False,
+         voice_prefetch=0):
       if (scr_start is None):
          scr_start = self.SCR_START_DEFAULT
       
       self._ms = media_storage
+      if (voice_prefetch > 0):
+         self._voice_pf = VoicePrefetcher(media_storage, voice_prefetch)
+      else:
+         self._voice_pf = None
       self._rng = rng
       self._cs = None
       self._cs_i = None
@@ -246,6 +403,7 @@ class E17VNBackend:
       ace('quiet', shortopt='-q', default=False, const=True, help='Suppress script processing log output.')
       ace('nocont', default=True, const=False, dest='continue_on_error', help='Do not continue on errors.')
       ace('choice_f0', longopt='--choice-fix0', default=False, const=True, dest='choice_f0', help='Always choose first option in choices.')
+      ace('voice_prefetch', longopt='--voice-prefetch', default=0, converter=int, metavar='COUNT', help='Decode up to this many upcoming voice clips in the background.')
    
    @staticmethod
    def __new_choice_f0(choice):
@@ -287,19 +445,20 @@ class E17VNBackend:
       """Restore saved VN path state."""
       for (key, val) in state.items():
          setattr(self, key, val)
+      self._clear_voice_prefetch()
       self._scr = self._ms.getfile_script(self._scr_fn)
       # Restore ES state
       if (self._es_n is None):
          self._es = None
       else:
          self._es_i -= 1
-         self._es = self._scr.get_es(self._es_n).get_tokens()
+         self._es = self._scr.get_es_tokens(self._es_n)
       # Restore CS state
       if (self._cs_n is None):
          self._cs = None
       else:
          self._cs_i -= 1
-         self._cs = self._scr.get_cs(self._cs_n).get_tokens()
+         self._cs = self._scr.get_cs_tokens(self._cs_n)
       
       # Restore BGI
       self.clear_charart_all(0)
@@ -347,15 +506,16 @@ class E17VNBackend:
       idx = int(idx)
       if not (self._cs is None):
          raise VNStateError('I already have an active conv script.')
-      self._cs = self._scr.get_cs(idx).get_tokens()
+      self._cs = self._scr.get_cs_tokens(idx)
       self._cs_i = 0
       self._cs_n = idx
+      self._update_voice_prefetch()
    
    def set_es(self, idx):
       """Set event script."""
       self.log(20, 'Loading event script {:d}.'.format(idx))
       idx = int(idx)
-      self._es = self._scr.get_es(idx).get_tokens()
+      self._es = self._scr.get_es_tokens(idx)
       self._es_n = idx
       self._es_i = 0
    
@@ -363,6 +523,7 @@ class E17VNBackend:
       """Set active scriptfile."""
       self.log(20, 'Switching to script file {!a}.'.format(scr_fn))
       scr = self._ms.getfile_script(scr_fn)
+      self._clear_voice_prefetch()
       self._scr = scr
       self._scr_fn = scr_fn
       self.set_es(i)
@@ -372,6 +533,7 @@ class E17VNBackend:
       if not (self._choice is None):
          raise ValueError('{} already has an active choice {}.'.format(self, self._choice))
 
+      self._clear_voice_prefetch()
       rv = E17VNChoice(*args, **kwargs)
       self._choice = rv
       return rv
@@ -385,13 +547,16 @@ class E17VNBackend:
    
    def _new_textblock(self, text, voice_fn):
       """Make new textblock."""
-      if (voice_fn is None):
-         vd = None
-      else:
-         vd = self._ms.getfile_voice(voice_fn)
+      vd = None
+      if not (voice_fn is None):
+         if not (self._voice_pf is None):
+            vd = self._voice_pf.get(voice_fn)
+         if (vd is None):
+            vd = self._ms.getfile_voice(voice_fn)
       
       tb = VNTextblock(text, vd)
       self.new_textblock(tb)
+      self._update_voice_prefetch()
       self.backlog.append(tb)
       self._unfade_textbox()
       # FIXME: Do this more efficiently.
@@ -501,6 +666,36 @@ class E17VNBackend:
          self.log(20, 'Processed token {}.'.format(tok.format_hr(self._scr, color=self._debug_color)))
    
    # ------ UI input methods
+   def _iter_voice_refs(self):
+      """Yield voice references of upcoming textblocks, in order, assuming no jumps are taken."""
+      def scan(tokens):
+         for tok in tokens:
+            vr = getattr(tok, 'voice_ref', None)
+            if not (vr is None):
+               yield vr
+      
+      if (self._cs):
+         yield from scan(self._cs[self._cs_i:])
+      
+      for tok in self._es[self._es_i:self._es_i+self.VOICE_LOOKAHEAD_ES_TOKENS]:
+         conv_ref = getattr(tok, 'conv_ref', None)
+         if (conv_ref is None):
+            continue
+         idx = int(conv_ref)
+         try:
+            tokens = self._scr.get_cs_tokens(idx)
+         except (ValueError, IndexError):
+            return
+         yield from scan(tokens)
+   
+   def _update_voice_prefetch(self):
+      if not (self._voice_pf is None):
+         self._voice_pf.update(self._iter_voice_refs())
+   
+   def _clear_voice_prefetch(self):
+      if not (self._voice_pf is None):
+         self._voice_pf.clear()
+   
    def jump_back(self, idx):
       m = self.backlog[idx]
       # FIXME: Do this more efficiently.
@@ -622,6 +817,11 @@ def main(vn_backend, vn_frontend=None, ms_cls=E17VNMediaStorageLNK):
    
    op = optparse.OptionParser()
    conf.setup_optparse(op)
+   op.add_option('--mmap', action='store_true', default=False, help='Access LNK archives through memory mappings.')
+   op.add_option('--index', default=None, help='Cache LNK chunk metadata in specified index file.')
+   op.add_option('--img-cache', default=None, metavar='PATH', help='Cache decoded images in specified directory.')
+   op.add_option('--img-cache-size', type=int, default=256, metavar='MB', help='Size limit for image cache.')
+   op.add_option('--script-cache', default=None, metavar='PATH', help='Read tokenized scripts from specified cache directory.')
    
    (opts, args) = op.parse_args()
    (ddir,) = args
@@ -629,7 +829,17 @@ def main(vn_backend, vn_frontend=None, ms_cls=E17VNMediaStorageLNK):
    logging.getLogger().setLevel(10)
    logging.basicConfig(format='%(asctime)s %(levelno)s %(message)s', stream=sys.stdout)
    
-   ms = ms_cls.build_from_dir(ddir)
+   if not (opts.img_cache is None):
+      from .ff.cps import DataRefCPSE17
+      from .ff.imgcache import CPSImageCache
+      DataRefCPSE17.img_cache = CPSImageCache(opts.img_cache, opts.img_cache_size << 20)
+   
+   if not (opts.script_cache is None):
+      from .ff.scr import E17ScriptParser
+      from .ff.scrcache import ScriptTokenCache
+      E17ScriptParser.tok_store = ScriptTokenCache(opts.script_cache)
+   
+   ms = ms_cls.build_from_dir(ddir, use_mmap=opts.mmap, index_fn=opts.index)
    
    vnp = vn_cls.build_from_config(conf)
    vnp.init_backend_from_config(conf, media_storage=ms)
@@ -91,6 +91,8 @@ class N7TokenE01Nodata(N7TokenE01):
 class N7TokenE00_04(N7TokenE00Nodata):
    """00-04: special-purpose inter-file jump."""
    type = 0x04
+   # Our base class hides the data slot behind a class attribute.
+   __slots__ = ('data',)
    def __init__(self, f):
       self.data = (f.read_u8(), f.read_av(), f.read_esr(True))
       
@@ -181,6 +183,7 @@ class N7TokenE10_00(N7TokenE10Nodata):
 class N7TokenE10_01(N7TokenE10):
    """10-01: Visual effect"""
    type = 0x01
+   __slots__ = ('effect_type',)
    def __init__(self, f):
       # effect types:
       #  0: ?none?
@@ -210,6 +213,7 @@ class N7TokenE10_02(N7TokenE10):
 class N7TokenE10_03(N7TokenE10):
    """10-03: Choice result store."""
    type = 0x03
+   __slots__ = ('addr',)
    def __init__(self, f):
       self.addr = f.read_av()
    
@@ -228,6 +232,7 @@ class N7TokenE10_03(N7TokenE10):
 class N7TokenE10_04(N7TokenE10):
    """10-04: Inter-file jump."""
    type = 0x04
+   __slots__ = ('fn',)
    def __init__(self, f):
       self.fn = f.read_bytes_fixedterm(b'\x00')
       f.set_end()
@@ -245,6 +250,7 @@ class N7TokenE10_04(N7TokenE10):
 class N7TokenE10_05(N7TokenE10):
    """10-05: Inter-file jump that saves current position for return."""
    type = 0x05
+   __slots__ = ('aux', 'fn')
    def __init__(self, f):
       self.aux = f.read_av()
       self.fn = f.read_bytes_fixedterm(b'\x00')
@@ -275,6 +281,7 @@ class N7TokenE10_07(N7TokenE10Nodata):
 class N7TokenE10_08(N7TokenE10):
    """10-03: Sound effect."""
    type = 0x08
+   __slots__ = ('fn',)
    def __init__(self, f):
       self.fn = f.read_bytes_fixedterm(b'\x00')
       self.data = f.read_av()
@@ -297,6 +304,7 @@ class N7TokenE10_0a(N7TokenE10Nodata):
 class N7TokenE10_0b(N7TokenE10):
    """10-0b: VA reference."""
    type = 0x0b
+   __slots__ = ('fn',)
    def __init__(self, f):
       self.fn  = f.read_bytes_fixedterm(b'\x00')
    
@@ -313,6 +321,7 @@ class N7TokenE10_0b(N7TokenE10):
 class N7TokenE10_0c(N7TokenE10):
    """10-0c: set panzoomed bgi"""
    type = 0x0c
+   __slots__ = ('fnr', 'ivp', 'te')
    def __init__(self, f):
       self.fnr = f.read_fnr()
       self.ivp = f.read_av()
@@ -339,6 +348,7 @@ class N7TokenE10_0d(N7TokenE10):
 class N7TokenE10_0e(N7TokenE10):
    """10-0e: bgi panzoom"""
    type = 0x0e
+   __slots__ = ('vp', 'delay')
    def __init__(self, f):
       self.vp = f.read_av()
       self.delay = f.read_av()
@@ -359,6 +369,7 @@ class N7TokenE10_0e(N7TokenE10):
 @_n7_reg_tt_10
 class N7TokenE10_0f(N7TokenE10Nodata):
    type = 0x0f
+   __slots__ = ('data',)
    def __init__(self, f):
       self.data = (f.read_av(), f.read_av(), f.read_av())
 
@@ -372,6 +383,7 @@ class N7TokenE10_0f(N7TokenE10Nodata):
 class N7TokenE10_10(N7TokenE10Nodata):
    """10-10: set BGI"""
    type = 0x10
+   __slots__ = ('fnr', 'te', 'data')
    def __init__(self, f):
       self.fnr = f.read_fnr()
       # transition effects:
@@ -394,6 +406,7 @@ class N7TokenE10_10(N7TokenE10Nodata):
 class N7TokenE10_11(N7TokenE10):
    """10-11: Charart display"""
    type = 0x11
+   __slots__ = ('slot', 'fnr', 'pos')
    def __init__(self, f):
       self.slot = f.read_av()
       self.fnr = f.read_fnr()
@@ -416,6 +429,7 @@ class N7TokenE10_11(N7TokenE10):
 class N7TokenE10_12(N7TokenE10):
    """10-12: Charart clear"""
    type = 0x12
+   __slots__ = ('slot',)
    def __init__(self, f):
       self.slot = f.read_av()
       self.data = f.read_av()
@@ -488,6 +502,7 @@ class N7TokenE10_1a(N7TokenE10):
 @_n7_reg_tt_10
 class N7TokenE10_1b(N7TokenE10):
    type = 0x1b
+   __slots__ = ('fnr',)
    def __init__(self, f):
       self.fnr = f.read_fnr()
    
@@ -509,6 +524,7 @@ class N7TokenE10_1e(N7TokenE10Nodata):
 class N7TokenE10_22(N7TokenE10Nodata):
    """10-22: Movie playback"""
    type = 0x22
+   __slots__ = ('fn',)
    def __init__(self, f):
       self.fn = f.read_bytes_fixedterm(b'\x00')
 
@@ -538,6 +554,7 @@ class N7TokenE10_2d(N7TokenE10Nodata):
 @_n7_reg_tt_10
 class N7TokenE10_2e(N7TokenE10Nodata):
    type = 0x2e
+   __slots__ = ('data',)
    def __init__(self, f):
       self.data = f.read_av()
 
@@ -595,7 +612,7 @@ class N7TokenCNodata(N7TokenC):
       pass
 
 @_n7_reg_ctt
-class N7TokenC_01(N7TokenCNodata):
+class N7TokenC_00(N7TokenCNodata):
    # End of block marker?
    type = 0x00
    def _get_color(self):
@@ -625,7 +642,7 @@ class N7TokenC_03(N7TokenCNodata):
       return False
 
 @_n7_reg_ctt
-class N7TokenC_03(N7TokenC):
+class N7TokenC_04(N7TokenC):
    type = 0x04
    def __init__(self, f):
       self.data = f.read_av()
@@ -640,6 +657,7 @@ class N7TokenC_05(N7TokenC):
 class N7TokenC_0b(N7TokenC):
    """C0b: Choice option."""
    type = 0x0b
+   __slots__ = ('opt_idx', 'text')
    def __init__(self, f):
       self.opt_idx = f.read_u8()
       (self.text, _) = f.read_string()
@@ -672,8 +690,8 @@ class N7TokenCSynthTextblock(E17TokenCSynthTextblock):
       self.voice_ref = None
    
    def process(self, engine):
-      self.voice_ref = engine._pop_vad()
-      engine._new_textblock(self.text, self.voice_ref)
+      # Tokens are shared between script runs; don't store the popped voice ref on them.
+      engine._new_textblock(self.text, engine._pop_vad())
    
    def do_tokendisplay_linebreak(self):
       return False
@@ -730,6 +748,18 @@ class N7CSTokenizer(E17ConvScriptTokenizer):
             
    
    def read_string(self):
+      run = self._find_text_run()
+      if not (run is None):
+         (start, end) = run
+         try:
+            rv = str(self._buf[start:end], 'shift_jisx0213')
+         except UnicodeDecodeError:
+            pass
+         else:
+            b = self._buf[end:end+1].tobytes()
+            self._off = self._buf_off + end + 1
+            return (rv, b)
+      
       data = bytearray()
       while (True):
          b = self.read(1)
@@ -180,6 +180,9 @@ class X7LNKScriptPatcher(LNKParser):
    logger = logging.getLogger('X7LNKScriptPatcher')
    log = logger.log
    prepatch_verify = True
+   # Recompress patched chunks that were compressed originally.
+   compress = True
+   compress_optimal = False
    
    def patch_by_dir(self, path):
       from os import listdir
@@ -252,10 +255,8 @@ class X7LNKScriptPatcher(LNKParser):
          tcbc_have_patch += have_patch
          
          sp_dref = sp.build_dref()
-         chunk.f = sp_dref.f
-         chunk.off = sp_dref.off
-         chunk.size = sp_dref.size
-         chunk.is_compressed = False
+         chunk.set_data_plain(sp_dref.get_data(), compress=(self.compress and chunk.is_compressed),
+            optimal=self.compress_optimal)
          
          self.log(20, '-------- {!r:16}: {:5d} / {:5d} / {:5d}'.format(chunk.name, lines_patched, have_patch, cbc))
       
@@ -273,6 +274,8 @@ def _main():
    op = optparse.OptionParser()
    op.add_option('-f', '--force', action='store_true', default=False, help='Force patching of mismatched lines.')
    op.add_option('-o', '--outfile', default=None, help='Filename to write output to.')
+   op.add_option('-u', '--uncompressed', dest='compress', action='store_false', default=True, help='Store patched chunks uncompressed.')
+   op.add_option('--optimal', action='store_true', default=False, help='Use (slow) optimal parsing when recompressing chunks.')
    (opts, args) = op.parse_args()
    
    logging.getLogger().setLevel(10)
@@ -283,6 +286,8 @@ def _main():
    
    lnk = X7LNKScriptPatcher.build_from_file(open(fn,'rb'))   
    lnk.prepatch_verify = (not opts.force)
+   lnk.compress = opts.compress
+   lnk.compress_optimal = opts.optimal
    
    lnk.patch_by_dir(cache_dir)
    fno = opts.outfile
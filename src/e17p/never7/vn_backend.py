@@ -64,6 +64,18 @@ class N7VNBackend(E17VNBackend):
       rv = self._va_tdata
       self._va_tdata = None
       return rv
+   
+   def _iter_voice_refs(self):
+      """Yield voice clip names of upcoming VA reference tokens, in order, assuming no jumps are taken.
+      
+      Never7 textblocks don't carry voice references themselves; they're set by preceding event script tokens."""
+      from .ff.scr import N7TokenE10_0b
+      if not (self._va_tdata is None):
+         yield self._va_tdata
+      
+      for tok in self._es[self._es_i:self._es_i+self.VOICE_LOOKAHEAD_ES_TOKENS]:
+         if (isinstance(tok, N7TokenE10_0b)):
+            yield tok.fn
 
 class N7VNMediaStorageLNK(E17VNMediaStorageLNK):
    @staticmethod
@@ -81,6 +81,7 @@ class R11ESToken01(R11ESToken):
 class R11ESToken02(R11ESToken):
    """02: Conditional jumps."""
    type = 0x02
+   __slots__ = ('d0', 'jmp_target', 'arg0', 'arg1', 'op')
    op_map = {
       # Solid.
       0x00:(None, '=='),
@@ -115,6 +116,7 @@ class R11ESToken02(R11ESToken):
 class R11ESToken03(R11ESToken):
    """03: Unconditional jump?"""
    type = 0x03
+   __slots__ = ('d0', 'jmp_target')
    def __init__(self, f):
       self.d0 = f.read_u8()
       self.jmp_target = f.read_jmp_target(self.d0 == 0)
@@ -160,6 +162,7 @@ class R11ESToken06(R11ESTokenNodata):
 class R11ESToken09(R11ESToken):
    """09: Memory manipulation"""
    type = 0x09
+   __slots__ = ('op', 'arg0', 'arg1')
    op_map = {
       # Fairly solid.
       0x00:(None,'{} = {}'),
@@ -205,6 +208,7 @@ class R11ESToken0c(R11ESToken):
 class R11ESToken0c(R11ESToken):
    """0b: Enforced time delays (end of Kokoro arc only)?"""
    type = 0x0b
+   __slots__ = ('v0',)
    def __init__(self, f):
       f.eat_nulls(1)
       self.v0 = f.read_u16()
@@ -243,6 +247,7 @@ class R11ESToken12(R11ESToken):
 class R11ESToken13(R11ESToken):
    """13: Fullscreen text mode set."""
    type = 0x13
+   __slots__ = ('mode',)
    def __init__(self, f):
       self.mode = f.read_u8()
    
@@ -255,6 +260,7 @@ class R11ESToken13(R11ESToken):
 @_r11esth_reg_tt
 class R11ESToken16(R11ESToken):
    type = 0x16
+   __slots__ = ('chr_id',)
    def __init__(self, f):
       # 0: misc
       # 1: Kokoro
@@ -292,6 +298,7 @@ class R11ESToken16(R11ESToken):
 class R11ESToken25(R11ESToken):
    """25: Jump-choice combo."""
    type = 0x25
+   __slots__ = ('addr',)
    def __init__(self, f):
       count = f.read_u8()
       self.addr = f.read_smval()
@@ -422,6 +429,7 @@ class R11ESToken40(R11ESToken):
 class R11ESToken41(R11ESToken):
    """41: Sound effect."""
    type = 0x41
+   __slots__ = ('sid', 'val')
    def __init__(self, f):
       self.sid = f.read_u8()
       self.val = f.read_smval()
@@ -435,6 +443,7 @@ class R11ESToken41(R11ESToken):
 @_r11esth_reg_tt
 class R11ESToken42(R11ESToken):
    type = 0x42
+   __slots__ = ('sid', 'val')
    def __init__(self, f):
       self.sid = f.read_u8()
       self.val = f.read_u16()
@@ -467,6 +476,7 @@ class R11ESToken49(R11ESToken):
 class R11ESToken4a(R11ESToken):
    """4a: Text display mode switch?"""
    type = 0x4a
+   __slots__ = ('mode',)
    def __init__(self, f):
       # 0: Normal display?
       # 1: Centred?
@@ -507,6 +517,7 @@ class R11ESToken53(R11ESToken):
 class R11ESToken60(R11ESToken):
    """60: Play movie."""
    type = 0x60
+   __slots__ = ('mv_idx',)
    def __init__(self, f):
       # See DBG_MENU.BIP:0x10e for most of the list for these.
       # TODO: Figure out how the game does this mapping. There's probably something in init.bin for that.
@@ -627,6 +638,7 @@ class R11ESToken70(R11ESToken):
 class R11ESToken73Text(R11ESToken):
    """73: Conversation text."""
    type = 0x73
+   __slots__ = ('text_ref', 'idx', 'va_idx', 'cid')
    def __init__(self, f):
       f.eat_nulls(1)
       self.text_ref = f.get_text()
@@ -655,6 +667,7 @@ class R11ESToken73Text(R11ESToken):
 class R11ESToken74(R11ESToken):
    """74: Choice spec."""
    type = 0x74
+   __slots__ = ('addr', 'opts')
    def __init__(self, f):
       option_count = f.read_u8()
       self.addr = f.read_smval()
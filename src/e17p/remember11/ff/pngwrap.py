@@ -44,7 +44,7 @@ class R11ImagePNG(DataRefFile):
       # reference.
       return load(open(self.f.fileno(), 'rb', closefd=False))
    
-   def write_png(self, out):
+   def write_png(self, out, writer=None):
       out(self.get_data_image())
    
    def write_bmp(self, out):
@@ -89,6 +89,7 @@ def _main():
    op.add_option('-a', '--afs', dest='afs_in', default=False, action='store_true', help='Extract image data from AFS files instead of pre-splitted T2P ones.')
    op.add_option('-b', '--bmp', dest='bmp_out', default=False, action='store_true', help='Write image data to BMP files.')
    op.add_option('-p', '--png', dest='png_out', default=False, action='store_true', help='Write image data to PNG files.')
+   op.add_option('--imconvert', default=False, action='store_true', help='Use external convert(1) binary for PNG output.')
    op.add_option('-o', '--outdir', dest='outdir', default=None, help='Directory to write output files to.')
    op.add_option('-u', '--unpack', dest='unpack', default=False, action='store_true', help='Unpack pre-split T2P files before attempting to parse them.')
    
@@ -137,7 +138,10 @@ def _main():
          
          if (opts.png_out):
             f2 = get_of(fn, b'.png')
-            img.write_png(f2.write)
+            if (opts.imconvert and isinstance(img, BMPImage)):
+               img.write_png_imconvert(f2.write)
+            else:
+               img.write_png(f2.write)
          
 
 
@@ -35,6 +35,7 @@ class R12Token(BaseToken):
       return True
 
 class R12TokenUnknown(R12Token):
+   __slots__ = ('type',)
    def __init__(self, f, tt, data):
       self.type = tt
       super().__init__(f, tt, data)
@@ -84,6 +85,7 @@ class R12Token1a(R12Token):
 class R12Token18(R12Token):
    """18: Conversation text block"""
    type = 0x18
+   __slots__ = ('text_ref', 'va_idx', 'idx', 'cid')
    def __init__(self, f, tt, data):
       (uk0, va_idx, text_off, idx, cid) = struct.unpack(b'<HhHhH', data[:10])
       uk_r = LE16Sequence(data[10:]).unpack_u()
@@ -249,6 +251,7 @@ class R12Tokena1(R12Token):
 class R12Tokenc9(R12Token):
    """c9: Audio"""
    type = 0xc9
+   __slots__ = ('at',)
    def __init__(self, f, tt, data):
       (at, *data) = data.unpack_u(5)
       # Audio types: